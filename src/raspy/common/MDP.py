@@ -1,12 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import zlib
 logger = logging.getLogger("MDP")
 
 """Majordomo Protocol definitions"""
 #  This is the version of MDP/Client we implement
 C_CLIENT = "MDPC01"
 
+#  Client header with quality of service : it's followed by the
+#  timeout (msecs, empty for none) and priority (empty for 0) frames
+#  before the service name. Replies are sent with C_CLIENT.
+C_CLIENT_QOS = "MDPC01Q"
+
+#  Client header of the chunks of a streamed reply :
+#  [MDPC01S][service][stream id][sequence][final][data]
+#  final is empty, except for the last chunk (without data) : T_OK when
+#  the stream is complete, T_ERROR when the worker abandoned it.
+#  It's also the header of the credits given back by the client :
+#  [MDPC01S][service][stream id][credit]
+C_STREAM = "MDPC01S"
+
 #  This is the version of MDP/Worker we implement
 W_WORKER = "MDPW01"
 
@@ -16,8 +30,15 @@ W_REQUEST = "\002"
 W_REPLY = "\003"
 W_HEARTBEAT = "\004"
 W_DISCONNECT = "\005"
+W_STREAM = "\006"
+W_CREDIT = "\007"
 
-commands = [None, "READY", "REQUEST", "REPLY", "HEARTBEAT", "DISCONNECT"]
+commands = [None, "READY", "REQUEST", "REPLY", "HEARTBEAT", "DISCONNECT", "STREAM", "CREDIT"]
+
+#  Chunks sent ahead of the client by a streaming worker
+STREAM_CREDIT = 4
+#  Size of the chunks read from files
+STREAM_CHUNK = 65536
 
 T_OK = '200'
 T_PENDING = '300'
@@ -25,10 +46,29 @@ T_UNKNOWN = '400'
 T_NOTFOUND = '404'
 T_ERROR = '500'
 T_NOTIMPLEMENTED = '501'
+T_OVERLOAD = '503'
+
+#  Subtree of the titanic completion events in the key/value proxy
+TITANIC_SUBTREE = "/titanic/"
 
 def routing_key(hostname, service):
     return "%s.%s"%(hostname, service)
 
+def service_shard(name, shards):
+    """Return the shard of a sharded broker owning the service name : the range of the hash it falls in"""
+    return ((zlib.crc32(name) & 0xffffffff) * shards) >> 32
+
+def client_header(service, deadline=None, priority=None):
+    """Return the client header frames of a request to service.
+
+    :parameter deadline: the broker drops the request if it's still queued after deadline msecs
+    :parameter priority: the requests with higher priority are dispatched first
+    """
+    if deadline is None and priority is None:
+        return [C_CLIENT, service]
+    return [C_CLIENT_QOS, "" if deadline is None else "%d" % deadline, \
+        "" if priority is None else "%d" % priority, service]
+
 class GenericError(Exception):
     """Generic exception
     """
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+"""asyncio front-ends for the Majordomo client, worker and key/value subscriber.
+
+They use the same wire format as :mod:`raspy.common.mdcliapi`, :mod:`raspy.common.mdwrkapi`
+and :mod:`raspy.common.kvcliapi` but never block : many clients, workers and subscribers
+can share one event loop in one thread.
+
+.. code-block:: python
+
+    client = AsyncMajorDomoClient("tcp://127.0.0.1:5514")
+    reply = await client.send("mmi.service", ["titanic.request"])
+
+    worker = AsyncMajorDomoWorker("tcp://127.0.0.1:5514", "localhost.worker.devices")
+    async for request in worker:
+        worker.reply([MDP.T_OK])
+
+    subscriber = AsyncKvSubscriberClient(subtree="/device/")
+    async for kvmsg in subscriber:
+        print(kvmsg.key, kvmsg.body)
+
+Needs python 3.7 and pyzmq >= 15 (zmq.asyncio). Frames are sent as bytes :
+text frames are encoded to utf-8. Create them in a coroutine of the event loop,
+or give them the loop.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__copyright__ = "Copyright © 2013-2014 Sébastien GALLET aka bibi21000"
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import time
+import collections
+import asyncio
+import zmq
+import zmq.asyncio
+
+import raspy.common.MDP as MDP
+from raspy.common.kvsimple import KVMsg
+
+def _loop(loop):
+    """Return loop, or the running event loop"""
+    if loop is not None:
+        return loop
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        raise RuntimeError("No running event loop : give the loop or create it in a coroutine")
+
+def _b(frame):
+    """Return frame as bytes"""
+    if isinstance(frame, bytes):
+        return frame
+    return frame.encode('utf-8')
+
+def _frames(msg):
+    """Return the frames of msg as bytes"""
+    return [_b(frame) for frame in msg]
+
+class _AsyncReceiver(object):
+    """Receive messages of a zmq.asyncio socket and pass them to a callback
+    """
+
+    def __init__(self, socket, callback):
+        self.socket = socket
+        self.callback = callback
+        self.future = None
+        self.stopped = False
+        self.arm()
+
+    def arm(self):
+        """Wait for the next message"""
+        self.future = self.socket.recv_multipart()
+        self.future.add_done_callback(self.done)
+
+    def done(self, future):
+        """A message was received (or the socket was closed)"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.callback(future.result())
+        if not self.stopped and not self.socket.closed:
+            self.arm()
+
+    def cancel(self):
+        """Stop receiving"""
+        self.stopped = True
+        if self.future is not None and not self.future.done():
+            self.future.cancel()
+
+class AsyncMajorDomoClient(object):
+    """Majordomo Protocol asyncio Client API.
+
+    Like :class:`raspy.common.mdcliapi.MajorDomoAsyncClient`, use a DEALER socket and a request id
+    frame so that many requests can be outstanding.
+    """
+    timeout = 500
+    retries = 5
+
+    def __init__(self, broker, loop=None):
+        self.broker = broker
+        self.loop = _loop(loop)
+        self.ctx = zmq.asyncio.Context()
+        self.sequence = 0
+        self.pending = {}
+        self.client = self.ctx.socket(zmq.DEALER)
+        self.client.linger = 0
+        self.client.connect(self.broker)
+        self.receiver = _AsyncReceiver(self.client, self.on_reply)
+        MDP.logger.info("CLIENT - Connecting to broker at %s...", self.broker)
+
+    def send(self, service, request):
+        """Send request to broker.
+
+        Returns an awaitable for the reply message. Its result is None if there was no reply.
+        """
+        if not isinstance(request, list):
+            request = [request]
+        self.sequence += 1
+        request_id = _b("%x" % self.sequence)
+        future = self.loop.create_future()
+        msg = _frames([request_id, '', MDP.C_CLIENT, service] + request)
+        self.pending[request_id] = [future, msg, self.retries, None]
+        self.transmit(request_id)
+        return future
+
+    def transmit(self, request_id):
+        """Send (or resend) a pending request and arm its timer"""
+        pending = self.pending[request_id]
+        self.client.send_multipart(pending[1])
+        pending[3] = self.loop.call_later(1e-3*self.timeout, self.expire, request_id)
+
+    def expire(self, request_id):
+        """No reply for request_id after timeout : resend or abandon it"""
+        pending = self.pending.get(request_id)
+        if pending is None:
+            return
+        pending[2] -= 1
+        if pending[2] > 0:
+            MDP.logger.warn("CLIENT - No reply for request %s, resending...", request_id)
+            self.transmit(request_id)
+        else:
+            MDP.logger.warn("CLIENT - Permanent error for request %s, abandoning", request_id)
+            del self.pending[request_id]
+            if not pending[0].done():
+                pending[0].set_result(None)
+
+    def on_reply(self, msg):
+        """Handle a reply from broker"""
+        # Don't try to handle errors, just assert noisily
+        assert len(msg) >= 4
+        request_id = msg[0]
+        assert msg[1] == b''
+        assert msg[2] == _b(MDP.C_CLIENT)
+        pending = self.pending.pop(request_id, None)
+        if pending is None:
+            return
+        pending[3].cancel()
+        if not pending[0].done():
+            pending[0].set_result(msg[4:])
+
+    def destroy(self):
+        """ Destroy object
+        """
+        self.receiver.cancel()
+        for pending in self.pending.values():
+            pending[3].cancel()
+            if not pending[0].done():
+                pending[0].cancel()
+        self.pending = {}
+        self.ctx.destroy(0)
+
+class AsyncMajorDomoWorker(object):
+    """Majordomo Protocol asyncio Worker API.
+
+    Iterate on the worker to get the requests (async for) and call
+    :meth:`reply` to send back the reply of the current request.
+    The broker doesn't send another request to the worker before the reply.
+    """
+    HEARTBEAT_LIVENESS = 5 # 3-5 is reasonable
+    heartbeat = 3500 # Heartbeat delay, msecs
+    reconnect = 3500 # Reconnect delay, msecs
+    timeout = 2500 # Liveness check, msecs
+
+    status = True
+    """The status of the worker. Should be update by callback in the future
+    """
+
+    def __init__(self, broker, service, loop=None):
+        self.broker = broker
+        self.service = service
+        self.loop = _loop(loop)
+        self.ctx = zmq.asyncio.Context()
+        self.worker = None
+        self.receiver = None
+        self.reply_to = None
+        self.requests = collections.deque()
+        self.waiter = None
+        self.stopped = False
+        self.received = False
+        self.liveness = self.HEARTBEAT_LIVENESS
+        self.heartbeat_at = 0
+        self.reconnect_to_broker()
+        self.timer = self.loop.call_later(1e-3*self.timeout, self.tick)
+
+    def reconnect_to_broker(self):
+        """Connect or reconnect to broker"""
+        if self.worker is not None:
+            self.receiver.cancel()
+            self.worker.close()
+        self.worker = self.ctx.socket(zmq.DEALER)
+        self.worker.linger = 0
+        self.worker.connect(self.broker)
+        self.receiver = _AsyncReceiver(self.worker, self.on_message)
+        MDP.logger.info("WORKER - Connecting to broker at %s...", self.broker)
+        # Register service with broker
+        self.send_to_broker(MDP.W_READY, self.service, [])
+        self.liveness = self.HEARTBEAT_LIVENESS
+        self.heartbeat_at = time.time() + 1e-3*self.heartbeat
+
+    def send_to_broker(self, command, option=None, msg=None):
+        """Send message to broker."""
+        if msg is None:
+            msg = []
+        if option:
+            msg = [option] + msg
+        self.worker.send_multipart(_frames(['', MDP.W_WORKER, command] + msg))
+
+    def on_message(self, msg):
+        """Handle a message from broker"""
+        self.received = True
+        self.liveness = self.HEARTBEAT_LIVENESS
+        # Don't try to handle errors, just assert noisily
+        assert len(msg) >= 3
+        assert msg[0] == b''
+        assert msg[1] == _b(MDP.W_WORKER)
+        command = msg[2]
+        if command == _b(MDP.W_REQUEST):
+            head = msg.index(b'', 3)
+            self.requests.append((msg[3:head], msg[head+1:]))
+            self.wake()
+        elif command == _b(MDP.W_HEARTBEAT) or command == _b(MDP.W_CREDIT):
+            # Do nothing for heartbeats and late credits (the worker doesn't stream)
+            pass
+        elif command == _b(MDP.W_DISCONNECT):
+            self.reconnect_to_broker()
+        else:
+            MDP.logger.error("WORKER - Invalid input message: %s", msg)
+
+    def tick(self):
+        """Check liveness of broker and send heartbeats"""
+        if self.stopped:
+            return
+        if not self.received:
+            self.liveness -= 1
+            if self.liveness == 0:
+                MDP.logger.warn("WORKER - Disconnected from broker - retrying...")
+                self.timer = self.loop.call_later(1e-3*self.reconnect, self.restart)
+                return
+        self.received = False
+        if time.time() > self.heartbeat_at:
+            self.send_to_broker(MDP.W_HEARTBEAT)
+            self.heartbeat_at = time.time() + 1e-3*self.heartbeat
+        self.timer = self.loop.call_later(1e-3*self.timeout, self.tick)
+
+    def restart(self):
+        """Reconnect after a broker failure"""
+        if self.stopped:
+            return
+        self.reconnect_to_broker()
+        self.timer = self.loop.call_later(1e-3*self.timeout, self.tick)
+
+    def wake(self):
+        """Give the next request to the waiting iteration, if any"""
+        if self.waiter is None or self.waiter.done():
+            return
+        if self.stopped:
+            self.waiter.set_exception(StopAsyncIteration())
+        elif self.requests:
+            self.reply_to, request = self.requests.popleft()
+            self.waiter.set_result(request)
+
+    def recv(self):
+        """Return an awaitable for the next request"""
+        self.waiter = self.loop.create_future()
+        self.wake()
+        return self.waiter
+
+    def reply(self, reply):
+        """Send the reply of the current request to broker"""
+        assert self.reply_to is not None
+        if not isinstance(reply, list):
+            reply = [reply]
+        self.send_to_broker(MDP.W_REPLY, msg=self.reply_to + [''] + reply)
+        self.reply_to = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.recv()
+
+    def shutdown(self):
+        """Shutdown the worker : stop the iteration.
+        """
+        self.stopped = True
+        self.timer.cancel()
+        self.wake()
+
+    def destroy(self):
+        """ Destroy object
+        """
+        self.shutdown()
+        self.receiver.cancel()
+        self.ctx.destroy(0)
+
+class AsyncKvSubscriberClient(object):
+    """KeyValue Protocol asyncio subscriber.
+
+    Request a snapshot of the subtree then iterate (async for) on the updates
+    published by the proxy. Updates received before the end of the snapshot
+    are queued, like in the clone pattern.
+    """
+
+    def __init__(self, hostname='localhost', subtree="subtree", broker_ip='127.0.0.1', broker_port=5514, loop=None, credit=500):
+        self.loop = _loop(loop)
+        self.credit = credit
+        self.received = 0
+        self.ctx = zmq.asyncio.Context()
+        self.subtree = subtree
+        self.kvmap = {}
+        self.sequence = None
+        self.updates = collections.deque()
+        self.waiter = None
+        self.stopped = False
+        self.snapshot = self.ctx.socket(zmq.DEALER)
+        self.snapshot.linger = 0
+        self.snapshot.connect("tcp://%s:%s" % (broker_ip, broker_port+1))
+        self.subscriber = self.ctx.socket(zmq.SUB)
+        self.subscriber.linger = 0
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, _b(self.subtree))
+        self.subscriber.connect("tcp://%s:%s" % (broker_ip, broker_port+2))
+        self.snapshot_receiver = _AsyncReceiver(self.snapshot, self.on_snapshot)
+        self.subscriber_receiver = _AsyncReceiver(self.subscriber, self.on_update)
+        self.snapshot.send_multipart(_frames(["ICANHAZ?", self.subtree, "%s" % self.credit]))
+
+    def on_snapshot(self, msg):
+        """Handle a message of the snapshot"""
+        kvmsg = KVMsg.from_msg(msg)
+        if kvmsg.key == b"KTHXBAI":
+            self.sequence = kvmsg.sequence
+            self.snapshot_receiver.cancel()
+            MDP.logger.debug("PROXY - Client received snaphot for subtree %s with sequence %s", self.subtree, self.sequence)
+            self.wake()
+        else:
+            kvmsg.store(self.kvmap)
+            self.received += 1
+            grant = max(1, self.credit // 2)
+            if self.received % grant == 0:
+                self.snapshot.send_multipart(_frames(["CREDIT", "%s" % grant, self.subtree]))
+
+    def on_update(self, msg):
+        """Handle an update from the publisher"""
+        self.updates.append(KVMsg.from_msg(msg))
+        self.wake()
+
+    def wake(self):
+        """Give the next update to the waiting iteration, if any"""
+        if self.waiter is None or self.waiter.done():
+            return
+        if self.stopped:
+            self.waiter.set_exception(StopAsyncIteration())
+            return
+        if self.sequence is None:
+            # Snapshot not finished
+            return
+        while self.updates:
+            kvmsg = self.updates.popleft()
+            if kvmsg.sequence > self.sequence:
+                self.sequence = kvmsg.sequence
+                kvmsg.store(self.kvmap)
+                self.waiter.set_result(kvmsg)
+                return
+
+    def recv(self):
+        """Return an awaitable for the next update"""
+        self.waiter = self.loop.create_future()
+        self.wake()
+        return self.waiter
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.recv()
+
+    def shutdown(self):
+        """Shutdown the subscriber : stop the iteration.
+        """
+        self.stopped = True
+        self.wake()
+
+    def destroy(self):
+        """ Destroy object
+        """
+        self.shutdown()
+        self.snapshot_receiver.cancel()
+        self.subscriber_receiver.cancel()
+        self.ctx.destroy(0)
@@ -85,14 +85,23 @@ class Command(object):
     def __init__(self, **kwargs):
         """Initialize the Command
         """
-        if 'json ' in kwargs:
+        if 'json' in kwargs:
             self.from_json(kwargs['json'])
         for field in self._fields:
             if field in kwargs:
                 setattr(self, field, kwargs[field])
-        if 'callback ' in kwargs:
+        if 'callback' in kwargs:
             self.callback = kwargs["callback"]
 
+    def __call__(self, value=None):
+        """Execute the command : call its callback with value
+
+        :returns: the result of the callback. None if there's no callback
+        """
+        if self.callback is None:
+            return None
+        return self.callback(value)
+
     def from_json(self, json=None):
         """Create the command from JSON
         """
@@ -164,10 +173,10 @@ class BaseDevice(object):
     """
 
     subdevices = None
-    """The subdevices of this device
+    """The subdevices of this device, by name
     """
 
-    commands = {}
+    commands = None
     """The commands available on the device
     """
 
@@ -189,11 +198,28 @@ class BaseDevice(object):
         else:
             config = {'name' : None}
             self._name = None
-        self.commands['commands'] = Command(readonly=True, writeonly=False, type='List', info="All commands available on this device", callback=self.cmd_commands)
-        self.commands['config'] = Command(readonly=False, writeonly=False, type='Dict', info="Configure device", callback=self.cmd_config)
-        self.commands['poll'] = Command(readonly=False, writeonly=False, type='Int', info="Define polling for this device", callback=self.cmd_poll)
-        self.commands['log'] = Command(readonly=False, writeonly=False, type='Bool', info="Define logging for this device", callback=self.cmd_log)
-        self.commands['reset'] = Command(readonly=False, writeonly=True, type='Bool', info="Rsett the device to factory settings", callback=self.cmd_reset)
+        self.commands = {}
+        self.subdevices = {}
+        self._dispatch = {None : {}}
+        """The callables of the commands by name, by subdevice name (None for the device)"""
+        self.add_command('commands', Command(readonly=True, writeonly=False, type='List', info="All commands available on this device", callback=self.cmd_commands))
+        self.add_command('config', Command(readonly=False, writeonly=False, type='Dict', info="Configure device", callback=self.cmd_config))
+        self.add_command('poll', Command(readonly=False, writeonly=False, type='Int', info="Define polling for this device", callback=self.cmd_poll))
+        self.add_command('log', Command(readonly=False, writeonly=False, type='Bool', info="Define logging for this device", callback=self.cmd_log))
+        self.add_command('reset', Command(readonly=False, writeonly=True, type='Bool', info="Rsett the device to factory settings", callback=self.cmd_reset))
+
+    def add_command(self, name, command):
+        """Add a command to the device and to its dispatch table
+        """
+        self.commands[name] = command
+        self._dispatch[None][name] = command.callback or command
+
+    def add_subdevice(self, name, device):
+        """Add a subdevice : its commands are executed with the oid {device}-{name}
+        """
+        self.subdevices[name] = device
+        # Share the dispatch table of the subdevice : it sees the commands added later
+        self._dispatch[name] = device._dispatch[None]
 
     def cmd_commands(self, value=None):
         """Command fof retrieving all commands supported by this device
@@ -258,20 +284,30 @@ class BaseDevice(object):
     def exec_cmd(self, oid, command, value=None):
         """Execute a command
 
-        :parameter oid: the oid device
+        :parameter oid: the oid device. The commands of a subdevice are executed with {device}-{subdevice}
         :parameter command: the cid device
         :parameter value: the value
         :returns: a value if the command succeed. None if it fails
         """
-        subdev = oid.split("-", 1)
-        if len(subdev) > 0:
-            if self.subdevices is not None and subdev in self.subdevices:
-                if command in self.subdevices[subdev].commands and self.subdevices[subdev].commands[command] is not None:
-                    return self.subdevices[subdev].commands[command](value)
-        else:
-            if command in self.commands:
-                return self.commands[command](value)
-        return None
+        sep = oid.find('-')
+        callback = self._dispatch.get(None if sep < 0 else oid[sep+1:], {}).get(command)
+        if callback is None:
+            return None
+        return callback(value)
+
+    def exec_many(self, commands):
+        """Execute a batch of commands
+
+        :parameter commands: a list of (oid, command, value)
+        :returns: the list of the results (None for the commands which fail)
+        """
+        dispatch = self._dispatch
+        res = []
+        for oid, command, value in commands:
+            sep = oid.find('-')
+            callback = dispatch.get(None if sep < 0 else oid[sep+1:], {}).get(command)
+            res.append(None if callback is None else callback(value))
+        return res
 
     def new(self, json=None):
         """Create a new device and return it
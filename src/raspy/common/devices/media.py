@@ -23,7 +23,8 @@ __email__ = 'bibi21000@gmail.com'
 
 import sys, os
 import time
-from raspy.common.devices.device import BaseDevice, DReg
+from raspy.common.devices.device import BaseDevice, DReg, Command
+from raspy.common.mdwrkapi import file_chunks
 import logging
 import json as mjson
 
@@ -50,6 +51,9 @@ class MediaDevice(BaseDevice):
 
 class MediaCamera(MediaDevice):
     """The camera device object
+
+    The image command returns the chunks of the last image, to send them
+    with MajorDomoWorker.stream() : the image is never fully in memory.
     """
 
     oid = "media.camera"
@@ -63,6 +67,17 @@ class MediaCamera(MediaDevice):
         """
         MediaDevice.__init__(self, **kwargs)
         self.templates[self.oid] = self._base_template
+        self.add_command('image', Command(readonly=True, writeonly=False, type='Str', info="Stream the last image", callback=self.cmd_image))
+
+    def cmd_image(self, value=None):
+        """Command for retrieving the last image (its filename is in config['image'])
+
+        :returns: an iterator over the chunks of the image. None if there's no image.
+        """
+        filename = self.config.get('image')
+        if filename is None or not os.path.isfile(filename):
+            return None
+        return file_chunks(filename)
 
     def new(self, **kwargs):
         """Create a new device and return it
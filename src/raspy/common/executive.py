@@ -25,6 +25,49 @@ import multiprocessing
 import time
 import threading
 import logging
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:
+    from configparser import SafeConfigParser
+
+class WorkerPool(object):
+    """A pool of concurrent workers for a single MDP service
+
+    Each thread of the pool runs target, which creates its own MajorDomoWorker
+    for the service. The broker balances the requests between them, so a slow
+    request does not block the others.
+
+    The pool is started with the active threads of the executive.
+    """
+
+    def __init__(self, target, name, size=1):
+        """Initialize the pool
+        """
+        self.target = target
+        self.name = name
+        self.size = size
+        self.daemon = True
+        self.threads = []
+
+    def start(self):
+        """Start the threads of the pool
+        """
+        for i in range(self.size):
+            thr = threading.Thread(target=self.target, name="%s-%s" % (self.name, i))
+            thr.daemon = self.daemon
+            thr.start()
+            self.threads.append(thr)
+
+    def join(self, timeout=None):
+        """Wait for the threads of the pool
+        """
+        for thr in self.threads:
+            thr.join(timeout)
+
+    def is_alive(self):
+        """Return True if a thread of the pool is alive
+        """
+        return any([thr.is_alive() for thr in self.threads])
 
 class Executive(object):
     """The Executive mother class for all workers
@@ -36,8 +79,11 @@ class Executive(object):
     #HB_INTERVAL = 1000  # in milliseconds
     #__metaclass__ = AutoSlots
 
-    def __init__(self, hostname='localhost', service="executive", broker_ip='127.0.0.1', broker_port=5514):
+    def __init__(self, hostname='localhost', service="executive", broker_ip='127.0.0.1', broker_port=5514, conffile=None):
         """Initialize the executive.
+
+        :parameter conffile: the configuration file of the service (the conffile_path of its runner).
+            The size of the pools is read from it when the executive starts. None to keep the default sizes.
         """
         self.service = service
         self.hostname = hostname
@@ -48,8 +94,47 @@ class Executive(object):
         self.update_in_progress = False
         self._active_workers = []
         self._active_threads = []
+        self._pools = {}
+        self.conffile = conffile
+        self.worker_monitor = None
+        """Called with (worker, elapsed, reply) by the registered workers after each request"""
         self.speed = 1.0
 
+    def register_worker(self, worker):
+        """Add a worker to the active ones. It reports its requests to worker_monitor.
+        """
+        worker.monitor = self.worker_monitor
+        self._active_workers.append(worker)
+
+    def add_worker_pool(self, target, name, size=1):
+        """Create a pool of workers running target and add it to the active threads.
+
+        :parameter target: the method running the worker
+        :parameter name: the name of the pool, ie the suffix of the service (devices, mmi, ...)
+        :parameter size: the number of concurrent workers
+        :returns: the pool
+        """
+        pool = WorkerPool(target, name, size=size)
+        self._pools[name] = pool
+        self._active_threads.append(pool)
+        return pool
+
+    def configure_pools(self, conffile):
+        """Read the size of the pools from the [Pools] section of the configuration file.
+        Called by run() with conffile.
+
+        .. code-block:: ini
+
+            [Pools]
+            devices = 4
+        """
+        parser = SafeConfigParser()
+        parser.read(conffile)
+        if parser.has_section('Pools'):
+            for name in self._pools:
+                if parser.has_option('Pools', name):
+                    self._pools[name].size = max(1, parser.getint('Pools', name))
+
     def shutdown(self):
         """Shutdown executive.
         """
@@ -59,8 +144,10 @@ class Executive(object):
             wrk.shutdown()
 
     def _start_active_threads(self):
-        """Wait for threads and destroy contexts.
+        """Configure the pools and start the active threads.
         """
+        if self.conffile is not None:
+            self.configure_pools(self.conffile)
         for thr in self._active_threads:
             thr.start()
 
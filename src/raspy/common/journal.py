@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""A segmented append-only journal.
+
+Records are appended to numbered segment files. Compaction writes the live
+records to a snapshot file and removes the segments it covers, so the size on
+disk depends on the live data, not on the history.
+
+Files in the journal directory :
+
+    - snapshot : the compacted records. Its first record holds the number of
+      the last segment it covers.
+    - 00000001.log, 00000002.log, ... : the segments, replayed after the snapshot.
+
+Each record is framed with its length and crc32, so a record torn by a crash is
+detected and dropped at replay.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__copyright__ = "Copyright © 2013-2014 Sébastien GALLET aka bibi21000"
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import os
+import struct
+import zlib
+import threading
+import raspy.common.MDP as MDP
+
+FRAME = struct.Struct('!II') # length, crc32
+SEGMENT = struct.Struct('!Q') # last segment covered by the snapshot
+
+class Journal(object):
+    """A segmented append-only journal of records (byte strings)
+    """
+
+    def __init__(self, path, sync=False):
+        """Initialize the journal
+
+        :parameter path: the directory of the journal
+        :parameter sync: fsync after each append
+        """
+        self.path = path
+        self.sync = sync
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.lock = threading.Lock()
+        self.segment = max([0] + self.segments())
+        self.current = None
+        self.appended = 0
+        """Records appended since the last rotation"""
+
+    def segments(self):
+        """Return the numbers of the segments on disk, sorted"""
+        res = []
+        for name in os.listdir(self.path):
+            if name.endswith('.log'):
+                try:
+                    res.append(int(name[:-4]))
+                except ValueError:
+                    pass
+        return sorted(res)
+
+    def segment_filename(self, number):
+        """Return the filename of the segment number"""
+        return os.path.join(self.path, "%08d.log" % number)
+
+    @property
+    def snapshot_filename(self):
+        """The filename of the snapshot"""
+        return os.path.join(self.path, "snapshot")
+
+    def read_records(self, filename, truncate=False):
+        """Yield the records of a file. Stop at the first torn record
+        and remove it from the file if truncate is True.
+        """
+        with open(filename, 'rb') as f:
+            good = 0
+            while True:
+                header = f.read(FRAME.size)
+                if len(header) < FRAME.size:
+                    break
+                length, crc = FRAME.unpack(header)
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    break
+                good = f.tell()
+                yield data
+            torn = f.tell() != good or f.read(1) != b''
+        if torn:
+            MDP.logger.warning("JOURNAL - Drop torn record at end of %s", filename)
+            if truncate:
+                with open(filename, 'r+b') as f:
+                    f.truncate(good)
+
+    def replay(self):
+        """Yield all the records of the journal : the snapshot's ones then the segments' ones.
+        """
+        covered = 0
+        if os.path.isfile(self.snapshot_filename):
+            records = self.read_records(self.snapshot_filename)
+            for data in records:
+                covered = SEGMENT.unpack(data)[0]
+                break
+            for data in records:
+                yield data
+        segments = self.segments()
+        for number in segments:
+            if number > covered:
+                for data in self.read_records(self.segment_filename(number), truncate=number == segments[-1]):
+                    yield data
+            else:
+                # Already in the snapshot : the compaction was interrupted
+                os.unlink(self.segment_filename(number))
+
+    def open(self):
+        """Open a new segment for appending"""
+        self.segment += 1
+        self.current = open(self.segment_filename(self.segment), 'ab')
+        self.appended = 0
+
+    def append(self, data):
+        """Append a record to the current segment"""
+        with self.lock:
+            if self.current is None:
+                self.open()
+            self.current.write(FRAME.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+            self.current.flush()
+            if self.sync:
+                os.fsync(self.current.fileno())
+            self.appended += 1
+
+    def rotate(self):
+        """Close the current segment and open a new one.
+
+        :returns: the number of the last closed segment
+        """
+        with self.lock:
+            if self.current is not None:
+                self.current.close()
+            closed = self.segment
+            self.open()
+            return closed
+
+    def compact(self, records, upto):
+        """Write records to a new snapshot replacing the current one and the segments up to upto.
+
+        The caller must rotate() before collecting the records : the new
+        segment is left untouched and may be written meanwhile.
+        """
+        tmp = self.snapshot_filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            data = SEGMENT.pack(upto)
+            f.write(FRAME.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+            for data in records:
+                f.write(FRAME.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.snapshot_filename)
+        for number in self.segments():
+            if number <= upto:
+                os.unlink(self.segment_filename(number))
+
+    def close(self):
+        """Close the journal"""
+        with self.lock:
+            if self.current is not None:
+                self.current.close()
+                self.current = None
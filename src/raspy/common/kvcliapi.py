@@ -13,9 +13,12 @@ import random
 import time
 import threading
 import raspy.common.MDP as MDP
+from raspy.common import tracing
 import zmq
 from raspy.common.kvsimple import KVMsg
 
+TRACER = tracing.Tracer("PROXY")
+
 SUBTREE = "/client/"
 
 class KvPublisherClient(object):
@@ -37,17 +40,20 @@ class KvPublisherClient(object):
         self.kvmap = {}
         self.sequence = 0
 
-    def send(self, subtree='subtree', key='key', body='body'):
+    def send(self, subtree='subtree', key='key', body='body', ttl=0):
         """Send the update
+
+        :parameter ttl: the proxy deletes the key after ttl seconds, 0 to keep it
         """
         if subtree[0] != "/":
             subtree = "/" + subtree
         if subtree[len(subtree)-1] != "/":
             subtree = subtree + "/"
-        kvmsg = KVMsg(0)
+        kvmsg = KVMsg(0, ttl=ttl)
         kvmsg.key = subtree + "%s" % key
         kvmsg.body = "%s" % body
-        MDP.logger.debug("PROXY - Client publish update under %s for %s : %s", subtree, kvmsg.key, kvmsg.body)
+        if TRACER.enabled:
+            TRACER.trace("publish", [kvmsg.key, kvmsg.body])
         kvmsg.send(self.publisher)
         kvmsg.store(self.kvmap)
 
@@ -64,8 +70,11 @@ class KvSubscriberClient(object):
 
     """
 
-    def __init__(self, hostname='localhost', subtree="subtree", broker_ip='127.0.0.1', broker_port=5514, speed=1.0):
+    def __init__(self, hostname='localhost', subtree="subtree", broker_ip='127.0.0.1', broker_port=5514, speed=1.0, credit=500):
         """Insitalize the client
+
+        The snapshot is received by chunks : the proxy sends at most credit
+        entries before we grant it more.
         """
         self.ctx = zmq.Context()
         self.snapshot = self.ctx.socket(zmq.DEALER)
@@ -79,7 +88,10 @@ class KvSubscriberClient(object):
         self.kvmap = {}
         self.speed = speed
         self._stopevent = threading.Event()
-        self.snapshot.send_multipart(["ICANHAZ?", self.subtree])
+        self.credit = credit
+        grant = max(1, self.credit // 2)
+        self.snapshot.send_multipart(["ICANHAZ?", self.subtree, "%s" % self.credit])
+        received = 0
         while not self._stopevent.isSet():
             kvmsg = KVMsg.recv(self.snapshot)
             if kvmsg.key == "KTHXBAI":
@@ -87,6 +99,9 @@ class KvSubscriberClient(object):
                 MDP.logger.debug("PROXY - Client received snaphot for subtree %s with sequence %s", self.subtree, self.sequence)
                 break          # Done
             kvmsg.store(self.kvmap)
+            received += 1
+            if received % grant == 0:
+                self.snapshot.send_multipart(["CREDIT", "%s" % grant, self.subtree])
 
     def run(self):
         """Run the poller
@@ -101,16 +116,13 @@ class KvSubscriberClient(object):
                     raise exc
                 else:
                     items = {}
-            MDP.logger.debug("PROXY - Subscriber received items %s" % items)
-            MDP.logger.debug("PROXY - kvmap %s" % self.kvmap)
             if self.subscriber in items:
-                #MDP.logger.debug("PROXY - Subscriber received data")
                 kvmsg = KVMsg.recv(self.subscriber)
+                if TRACER.enabled:
+                    TRACER.trace("received", [kvmsg.key or '', kvmsg.body or ''])
                 if kvmsg.sequence > self.sequence:
                     self.sequence = kvmsg.sequence
                     kvmsg.store(self.kvmap)
-                    action = "update" if kvmsg.body else "delete"
-                    MDP.logger.debug("PROXY - Client received action %s with sequence %s", action, self.sequence)
 
     def destroy(self):
         """ Destroy object
@@ -11,50 +11,99 @@ From : http://zguide.zeromq.org/py:kvsimple
 """
 
 import struct # for packing integers
+import numbers
 import sys
 
 import zmq
 
+SEQUENCE = struct.Struct('!Q') # unsigned 64 bits sequence
+PROPERTIES = struct.Struct('!dI16s') # timestamp, ttl, uuid
+JOURNAL = struct.Struct('!QIdI16s') # sequence, key size, timestamp, ttl, uuid
+NO_UUID = b'\0' * 16
+
 class KVMsg(object):
     """
-    Message is formatted on wire as 3 frames:
+    Message is formatted on wire as 3 or 4 frames:
         - frame 0: key (0MQ string)
-        - frame 1: sequence (8 bytes, network order)
+        - frame 1: sequence (8 bytes, unsigned, network order)
         - frame 2: body (blob)
+        - frame 3: properties (optional, 28 bytes, network order) :
+          timestamp (double), ttl (4 bytes, unsigned, in seconds, 0 for none)
+          and uuid (16 bytes)
+
+    The properties frame is only sent if one of them is set.
     """
     key = None # key (string)
     sequence = 0 # int
     body = None # blob
+    timestamp = 0.0 # float, 0 for none
+    ttl = 0 # int, in seconds, 0 for none
+    uuid = None # 16 bytes
 
-    def __init__(self, sequence, key=None, body=None):
+    def __init__(self, sequence, key=None, body=None, timestamp=0.0, ttl=0, uuid=None):
         """Initialize the Key/value Message
         """
-        assert isinstance(sequence, int)
+        assert isinstance(sequence, numbers.Integral)
         self.sequence = sequence
         self.key = key
         self.body = body
+        self.timestamp = timestamp
+        self.ttl = ttl
+        self.uuid = uuid
 
     def store(self, dikt):
-        """Store me in a dict if I have anything to store"""
-        # this seems weird to check, but it's what the C example does
-        if self.key is not None and self.body is not None:
-            dikt[self.key] = self
+        """Store me in a dict if I have anything to store,
+        remove my key from the dict if my body is empty"""
+        if self.key is not None:
+            if self.body is not None:
+                dikt[self.key] = self
+            else:
+                dikt.pop(self.key, None)
+
+    @property
+    def has_properties(self):
+        """True if one of the properties is set"""
+        return self.ttl or self.timestamp or self.uuid is not None
 
     def send(self, socket):
         """Send key-value message to socket; any empty frames are sent as such."""
         key = '' if self.key is None else self.key
-        seq_s = struct.pack('!l', self.sequence)
         body = '' if self.body is None else self.body
-        socket.send_multipart([key, seq_s, body])
+        if self.has_properties:
+            socket.send_multipart([key, SEQUENCE.pack(self.sequence), body, \
+                PROPERTIES.pack(self.timestamp, self.ttl, NO_UUID if self.uuid is None else self.uuid)])
+        else:
+            socket.send_multipart([key, SEQUENCE.pack(self.sequence), body])
 
     @classmethod
     def recv(cls, socket):
         """Reads key-value message from socket, returns new kvmsg instance."""
-        key, seq_s, body = socket.recv_multipart()
-        key = key if key else None
-        seq = struct.unpack('!l', seq_s)[0]
-        body = body if body else None
-        return cls(seq, key=key, body=body)
+        return cls.from_msg(socket.recv_multipart())
+
+    @classmethod
+    def from_msg(cls, msg):
+        """Decode a received multipart message, returns new kvmsg instance."""
+        kvmsg = cls(SEQUENCE.unpack(msg[1])[0], key=msg[0] if msg[0] else None, body=msg[2] if msg[2] else None)
+        if len(msg) > 3:
+            kvmsg.timestamp, kvmsg.ttl, uuid = PROPERTIES.unpack(msg[3])
+            kvmsg.uuid = None if uuid == NO_UUID else uuid
+        return kvmsg
+
+    def pack(self):
+        """Pack me in a string to store me (ie in a journal)"""
+        key = '' if self.key is None else self.key
+        body = '' if self.body is None else self.body
+        return JOURNAL.pack(self.sequence, len(key), self.timestamp, self.ttl, \
+            NO_UUID if self.uuid is None else self.uuid) + key + body
+
+    @classmethod
+    def unpack(cls, data):
+        """Unpack a string made by pack(), returns new kvmsg instance."""
+        seq, size, timestamp, ttl, uuid = JOURNAL.unpack_from(data)
+        key = data[JOURNAL.size:JOURNAL.size+size]
+        body = data[JOURNAL.size+size:]
+        return cls(seq, key=key if key else None, body=body if body else None, \
+            timestamp=timestamp, ttl=ttl, uuid=None if uuid == NO_UUID else uuid)
 
     def dump(self):
         """Dump me to a string"
@@ -65,9 +114,10 @@ class KVMsg(object):
         else:
             size = len(self.body)
             data = repr(self.body)
-        return "[seq:{seq}][key:{key}][size:{size}] {data}".format(
+        return "[seq:{seq}][key:{key}][size:{size}][ttl:{ttl}] {data}".format(
             seq=self.sequence,
             key=self.key,
             size=size,
+            ttl=self.ttl,
             data=data,
         )
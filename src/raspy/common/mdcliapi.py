@@ -13,10 +13,57 @@ import zmq
 from raspy.common.executive import Executive
 from raspy.common.zhelpers import zpipe
 import raspy.common.MDP as MDP
+from raspy.common.kvsimple import KVMsg
+from raspy.common import tracing
 import threading
 import time
+import os
+from collections import deque
 import logging
 
+def _monotonic_clock():
+    """Return a monotonic clock : a callable returning seconds
+
+    Python 2 has no monotonic clock in the standard library : use
+    clock_gettime(CLOCK_MONOTONIC) from the C library. Fall back to
+    time.time only if it is not available.
+    """
+    try:
+        from time import monotonic
+        return monotonic
+    except ImportError:
+        pass
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        for name in ('rt', 'c'):
+            path = ctypes.util.find_library(name)
+            if path is None:
+                continue
+            try:
+                clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+            except (OSError, AttributeError):
+                continue
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            CLOCK_MONOTONIC = 1
+            def monotonic():
+                ts = timespec()
+                if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(ts)) != 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+                return ts.tv_sec + ts.tv_nsec * 1e-9
+            monotonic()
+            return monotonic
+    except (ImportError, OSError):
+        pass
+    MDP.logger.warning("CLIENT - No monotonic clock, deadlines use the wall clock")
+    return time.time
+
+monotonic = _monotonic_clock()
+
+TRACER = tracing.Tracer("CLIENT")
+
 class MajorDomoClient(object):
     """Majordomo Protocol Client API, Python version.
 
@@ -47,15 +94,19 @@ class MajorDomoClient(object):
         self.poller.register(self.client, zmq.POLLIN)
         MDP.logger.info("CLIENT - Connecting to broker at %s...", self.broker)
 
-    def send(self, service, request):
+    def send(self, service, request, deadline=None, priority=None):
         """Send request to broker and get reply by hook or crook.
 
         Takes ownership of request message and destroys it when sent.
         Returns the reply message or None if there was no reply.
+
+        Use deadline=self.timeout so that the broker drops the request
+        instead of dispatching it when we have already given up. The reply
+        is [T_OVERLOAD] when the queue of the service is full.
         """
         if not isinstance(request, list):
             request = [request]
-        request = [MDP.C_CLIENT, service] + request
+        request = MDP.client_header(service, deadline, priority) + request
         MDP.logger.debug("Send request to '%s' service: ", service)
         reply = None
         retries = self.retries
@@ -67,7 +118,8 @@ class MajorDomoClient(object):
                 break                 # pragma: no cover
             if items:
                 msg = self.client.recv_multipart()
-                MDP.logger.debug("CLIENT - Received reply: %s", msg)
+                if TRACER.enabled:
+                    TRACER.trace("recv", msg)
                 # Don't try to handle errors, just assert noisily
                 assert len(msg) >= 3
                 header = msg.pop(0)
@@ -91,23 +143,397 @@ class MajorDomoClient(object):
         """
         self.ctx.destroy(0)
 
+def shard_endpoints(client):
+    """Return the endpoints of the shards of the broker of client, [] if it's not sharded"""
+    reply = client.send("mmi.shards", [""])
+    if reply is None or reply[-1] != MDP.T_OK:
+        return []
+    host = client.broker.rsplit(":", 1)[0]
+    return ["%s:%s" % (host, port) for port in reply[:-1]]
+
+def shard_endpoint(broker, service):
+    """Return the endpoint of the shard of a sharded broker owning service, broker if it's not sharded.
+
+    The workers of service connect to it.
+    """
+    client = MajorDomoClient(broker)
+    try:
+        endpoints = shard_endpoints(client)
+    finally:
+        client.destroy()
+    if not endpoints:
+        return broker
+    return endpoints[MDP.service_shard(service, len(endpoints))]
+
+class ShardedMajorDomoClient(object):
+    """Majordomo Protocol Client API for a sharded broker.
+
+    It asks the endpoints of the shards to the front and sends the requests
+    directly to the shard of their service. The mmi requests go to the front,
+    which merges the replies of the shards. If the broker is not sharded,
+    all the requests go to it.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.front = MajorDomoClient(broker)
+        self.clients = [MajorDomoClient(endpoint) for endpoint in shard_endpoints(self.front)]
+
+    def send(self, service, request, deadline=None, priority=None):
+        """Send request to the shard of service and get reply. See MajorDomoClient.send"""
+        if self.clients and not service.startswith("mmi."):
+            client = self.clients[MDP.service_shard(service, len(self.clients))]
+        else:
+            client = self.front
+        return client.send(service, request, deadline, priority)
+
+    def destroy(self):
+        """ Destroy object
+        """
+        for client in self.clients:
+            client.destroy()
+        self.front.destroy()
+
+class MajorDomoFuture(object):
+    """The pending reply of an asynchronous request
+
+    The reply is retrieved by pumping the client which sent the request.
+    """
+
+    def __init__(self, client, service, request_id):
+        self.client = client
+        self.service = service
+        self.request_id = request_id
+        self.reply = None
+        self.finished = False
+        self.callbacks = []
+
+    def done(self):
+        """Return True if the request got a reply or was abandonned
+        """
+        return self.finished
+
+    def add_done_callback(self, callback):
+        """Call callback(future) when the request is done
+        """
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, reply):
+        """Set the reply (None when abandonned) and call the callbacks
+        """
+        self.reply = reply
+        self.finished = True
+        for callback in self.callbacks:
+            callback(self)
+        self.callbacks = []
+
+    def result(self, timeout=None):
+        """Wait for the reply and return it.
+
+        Returns None if there was no reply. timeout is in msecs.
+        """
+        end_at = None if timeout is None else monotonic() + 1e-3*timeout
+        while not self.finished:
+            wait = self.client.timeout
+            if end_at is not None:
+                wait = min(wait, max(0, 1e3*(end_at - monotonic())))
+            if self.client.process(wait) == False:
+                break
+            if end_at is not None and monotonic() >= end_at:
+                break
+        return self.reply
+
+class MajorDomoStream(object):
+    """The streamed reply of a request (see MajorDomoWorker.stream())
+
+    Iterate over it to get the data of the chunks, in order. A credit is
+    given back to the worker for each chunk consumed, so no more chunks
+    than the credit of the worker are buffered.
+
+    The iteration raises MDP.ClientError if the request got a plain reply
+    (ie [T_OVERLOAD]) or no reply, or if the stream is interrupted. The
+    reply, if any, is in the reply attribute.
+    """
+
+    def __init__(self, client, service, request_id):
+        self.client = client
+        self.service = service
+        self.request_id = request_id
+        self.stream_id = None
+        self.sequence = 0
+        self.chunks = deque()
+        self.final = None
+        self.reply = None
+        self.finished = False
+
+    def done(self):
+        """Return True if no more chunk will come
+        """
+        return self.finished
+
+    def set_result(self, reply):
+        """The request got a plain reply, or was abandonned (None)
+        """
+        self.reply = reply
+        self.finished = True
+
+    def add_chunk(self, msg):
+        """Queue a chunk : [stream id][sequence][final][data]
+        """
+        if self.stream_id is None:
+            self.stream_id = msg[0]
+        elif msg[0] != self.stream_id:
+            # The stream of a resent request
+            MDP.logger.debug("CLIENT - Drop chunk of stream %s", msg[0])
+            return
+        if int(msg[1]) != self.sequence:
+            MDP.logger.warn("CLIENT - Missing chunk %s of stream %s", self.sequence, self.stream_id)
+            self.final = MDP.T_ERROR
+            self.finished = True
+            return
+        self.sequence += 1
+        if msg[2]:
+            self.final = msg[2]
+            self.finished = True
+        else:
+            self.chunks.append(msg[3] if len(msg) > 3 else '')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        end_at = monotonic() + 1e-3*self.client.timeout*self.client.retries
+        while not self.chunks:
+            if self.finished:
+                if self.final == MDP.T_OK:
+                    raise StopIteration
+                if self.stream_id is None:
+                    raise MDP.ClientError("No stream for request %s : %s" % (self.request_id, self.reply))
+                raise MDP.ClientError("Stream %s interrupted" % self.stream_id)
+            if self.stream_id is not None and monotonic() > end_at:
+                self.client.streams.pop(self.request_id, None)
+                raise MDP.ClientError("No chunk from stream %s" % self.stream_id)
+            if self.client.process(self.client.timeout) == False:
+                raise StopIteration
+        chunk = self.chunks.popleft()
+        if not self.finished:
+            self.client.send_credit(self.service, self.stream_id, 1)
+        return chunk
+
+    next = __next__
+
+class MajorDomoAsyncClient(object):
+    """Majordomo Protocol asynchronous Client API, Python version.
+
+    Use a DEALER socket so that many requests can be outstanding.
+    Each request is sent with a request id frame in its envelope. The broker
+    and the workers send it back with the reply, so replies are matched
+    to their requests whatever the order they come back in.
+
+    A request without reply after timeout is sent again (with the same
+    request id), without reconnecting the socket. After retries, it's
+    abandonned and its result is None.
+
+    Like MajorDomoClient, an instance must be used by one thread only.
+
+      Credits : https://github.com/imatix/zguide/blob/master/examples/Python/mdcliapi2.py
+    """
+    broker = None
+    ctx = None
+    client = None
+    poller = None
+    timeout = 500
+    retries = 5
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.ctx = zmq.Context()
+        self.poller = zmq.Poller()
+        self.sequence = 0
+        self.pending = {}
+        self.streams = {}
+        self.connect_to_broker()
+
+    def connect_to_broker(self):
+        """Connect to broker"""
+        self.client = self.ctx.socket(zmq.DEALER)
+        self.client.linger = 0
+        self.client.connect(self.broker)
+        self.poller.register(self.client, zmq.POLLIN)
+        MDP.logger.info("CLIENT - Connecting to broker at %s...", self.broker)
+
+    def send_async(self, service, request, deadline=None, priority=None):
+        """Send request to broker and return a MajorDomoFuture for the reply.
+
+        See MajorDomoClient.send() for deadline and priority.
+        """
+        if not isinstance(request, list):
+            request = [request]
+        self.sequence += 1
+        request_id = "%x" % self.sequence
+        future = MajorDomoFuture(self, service, request_id)
+        msg = [request_id, ''] + MDP.client_header(service, deadline, priority) + request
+        if TRACER.enabled:
+            TRACER.trace("send", msg)
+        self.pending[request_id] = [future, msg, monotonic() + 1e-3*self.timeout, self.retries]
+        self.client.send_multipart(msg)
+        return future
+
+    def send(self, service, request, deadline=None, priority=None):
+        """Send request to broker and get reply by hook or crook.
+
+        Returns the reply message or None if there was no reply.
+        """
+        return self.send_async(service, request, deadline, priority).result()
+
+    def stream(self, service, request, deadline=None, priority=None):
+        """Send request to a service replying with a stream of chunks and
+        return a MajorDomoStream to iterate over them.
+
+        The request is sent again until the first chunk comes, like the
+        ones of send_async().
+        """
+        future = self.send_async(service, request, deadline, priority)
+        stream = MajorDomoStream(self, service, future.request_id)
+        self.pending[future.request_id][0] = stream
+        return stream
+
+    def send_credit(self, service, stream_id, credit):
+        """Give back credit to the worker of a stream"""
+        msg = ['', MDP.C_STREAM, service, stream_id, "%d" % credit]
+        if TRACER.enabled:
+            TRACER.trace("send", msg)
+        self.client.send_multipart(msg)
+
+    def process(self, timeout=0):
+        """Wait up to timeout msecs for replies and handle them.
+        Also resend or abandon the requests that timed out.
+
+        Returns False if interrupted.
+        """
+        try:
+            items = self.poller.poll(timeout)
+        except KeyboardInterrupt: # pragma: no cover
+            return False          # pragma: no cover
+        if items:
+            while True:
+                try:
+                    msg = self.client.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if TRACER.enabled:
+                    TRACER.trace("recv", msg)
+                # Don't try to handle errors, just assert noisily
+                assert len(msg) >= 5
+                request_id = msg.pop(0)
+                empty = msg.pop(0)
+                assert empty == ''
+                header = msg.pop(0)
+                reply_service = msg.pop(0)
+                if MDP.C_STREAM == header:
+                    self.process_chunk(request_id, msg)
+                    continue
+                assert MDP.C_CLIENT == header
+                pending = self.pending.pop(request_id, None)
+                if pending is None:
+                    # A late reply for a request already done
+                    MDP.logger.debug("CLIENT - Drop reply for request %s", request_id)
+                    continue
+                future = pending[0]
+                assert future.service == reply_service
+                future.set_result(msg)
+        now = monotonic()
+        for request_id in [rid for rid in self.pending if self.pending[rid][2] < now]:
+            pending = self.pending[request_id]
+            pending[3] -= 1
+            if pending[3] > 0:
+                MDP.logger.warn("CLIENT - No reply for request %s, resending...", request_id)
+                pending[2] = now + 1e-3*self.timeout
+                self.client.send_multipart(pending[1])
+            else:
+                MDP.logger.warn("CLIENT - Permanent error for request %s, abandoning", request_id)
+                del self.pending[request_id]
+                pending[0].set_result(None)
+        return True
+
+    def process_chunk(self, request_id, msg):
+        """Handle a chunk of a streamed reply"""
+        stream = self.streams.get(request_id)
+        if stream is None:
+            pending = self.pending.get(request_id)
+            if pending is None or not isinstance(pending[0], MajorDomoStream):
+                MDP.logger.debug("CLIENT - Drop chunk for request %s", request_id)
+                return
+            # The stream has started : don't send the request again
+            del self.pending[request_id]
+            stream = self.streams[request_id] = pending[0]
+        stream.add_chunk(msg)
+        if stream.finished:
+            del self.streams[request_id]
+
+    def destroy(self):
+        """ Destroy object
+        """
+        self.ctx.destroy(0)
+
 class TitanicClient(object):
     """The titanic client
 
+    Titanic publishes the completion of the requests under MDP.TITANIC_SUBTREE
+    through the key/value proxy. The client subscribes to them and fetches the
+    replies of the completed requests only, with one titanic.reply for many
+    uuids.
+
+    As events may be lost (ie before the subscription is done), the pending
+    requests are also polled : poll msecs after the submission, then with
+    an exponential backoff up to recheck msecs.
+
+    All delays are measured with a monotonic clock, a callable returning
+    secs, which can be replaced for tests.
+
+    Metrics (see stats()) :
+
+        - polls : titanic.reply sent
+        - empty_polls : polled requests which were still pending
+        - events : completion events received for our requests
+        - completed : requests completed
+        - latency_avg, latency_max : from the submission to the reply, in secs
+
     Credits: https://github.com/imatix/zguide/blob/master/examples/Python/ticlient.py
 
     """
 
-    def __init__(self, broker_ip='localhost', broker_port=5514, poll=1500, ttl=900):
+    MAX_WAIT = 1000 # Max wait of the loop in msecs
+
+    def __init__(self, broker_ip='localhost', broker_port=5514, poll=100, ttl=900, recheck=30000, clock=monotonic):
         """Initialize the client
+
+        :parameter poll: first poll of a request, msecs after its submission
+        :parameter ttl: forget the requests in error after secs
+        :parameter recheck: max delay between the polls of a request in msecs
+        :parameter clock: the clock, a callable returning secs
         """
         self.broker_ip = broker_ip
         self.broker_port = broker_port
         self._stopevent = threading.Event()
         self.client = MajorDomoClient("tcp://%s:%s" % (broker_ip, broker_port))
+        self.ctx = zmq.Context()
+        self.subscriber = self.ctx.socket(zmq.SUB)
+        self.subscriber.linger = 0
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, MDP.TITANIC_SUBTREE)
+        self.subscriber.connect("tcp://%s:%s" % (broker_ip, broker_port+2))
+        self.poller = zmq.Poller()
+        self.poller.register(self.subscriber, zmq.POLLIN)
         self.poll = poll
         self.ttl = ttl
+        self.recheck = recheck
+        self.clock = clock
         self.requests = {}
+        self.metrics = {'polls' : 0, 'empty_polls' : 0, 'events' : 0, 'completed' : 0, \
+            'latency_total' : 0.0, 'latency_max' : 0.0}
 
     def shutdown(self):
         """Shutdown executive.
@@ -129,14 +555,7 @@ class TitanicClient(object):
             status = reply.pop(0)
             if status == MDP.T_OK:
                 uuid = reply.pop(0)
-                self.requests[uuid] = { \
-                        'callback' : callback, \
-                        'args' : args, \
-                        'kwargs' : kwargs, \
-                        'status' : MDP.T_PENDING, \
-                        'data' : None, \
-                        'req_date' : time.time(), \
-                        }
+                self.track(uuid, callback, args, kwargs)
                 logging.debug("CLIENT - Request UUID %s", uuid)
             elif status == MDP.T_UNKNOWN:
                 logging.error("CLIENT - MDP.ClientError in titanic.request : routing_key=%s data=%s", req, data)
@@ -146,6 +565,51 @@ class TitanicClient(object):
                 raise MDP.ServerError("titanic.request : routing_key=%s data=%s" % (req, data))
         return uuid
 
+    def track(self, uuid, callback=None, args=(), kwargs={}):
+        """Track a request submitted to titanic
+        """
+        now = self.clock()
+        self.requests[uuid] = { \
+                'callback' : callback, \
+                'args' : args, \
+                'kwargs' : kwargs, \
+                'status' : MDP.T_PENDING, \
+                'data' : None, \
+                'req_date' : now, \
+                'check_at' : now + self.poll/1000.0, \
+                'interval' : self.poll/1000.0, \
+                }
+
+    def due(self, now):
+        """Return the pending requests to poll and schedule their next poll
+        """
+        uuids = []
+        for uuid in list(self.requests.keys()):
+            request = self.requests[uuid]
+            if request['status'] == MDP.T_PENDING and request['check_at'] <= now:
+                request['interval'] = min(2*request['interval'], self.recheck/1000.0)
+                request['check_at'] = now + request['interval']
+                uuids.append(uuid)
+        return uuids
+
+    def timeout(self, now):
+        """Return the time to wait for the next poll in msecs
+        """
+        wait = self.MAX_WAIT
+        for request in list(self.requests.values()):
+            if request['status'] == MDP.T_PENDING:
+                wait = min(wait, 1000.0*(request['check_at'] - now))
+        return max(0, wait)
+
+    def stats(self):
+        """Return the metrics of the client
+        """
+        stats = dict(self.metrics)
+        latency_total = stats.pop('latency_total')
+        stats['latency_avg'] = latency_total / stats['completed'] if stats['completed'] else 0.0
+        stats['pending'] = len([uid for uid in list(self.requests.keys()) if self.requests[uid]['status'] == MDP.T_PENDING])
+        return stats
+
     def status(self, uuid):
         """Retrieve the status of a work from titanic
         """
@@ -158,49 +622,108 @@ class TitanicClient(object):
                 return [status]
         return [MDP.T_UNKNOWN]
 
+    def completed(self):
+        """Return the uuids of our pending requests whose completion was published
+        """
+        uuids = set()
+        while True:
+            try:
+                kvmsg = KVMsg.from_msg(self.subscriber.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+            uuid = kvmsg.key[len(MDP.TITANIC_SUBTREE):]
+            if kvmsg.body is not None and uuid in self.requests and self.requests[uuid]['status'] == MDP.T_PENDING:
+                uuids.add(uuid)
+                self.metrics['events'] += 1
+        return list(uuids)
+
+    def replies(self, uuids):
+        """Fetch the replies of many requests with one titanic.reply
+
+        Returns a dict uuid -> [status] + reply, empty if titanic didn't reply.
+        """
+        self.metrics['polls'] += 1
+        reply = self.client.send("titanic.reply", uuids)
+        if not reply:
+            return {}
+        if len(uuids) == 1:
+            return {uuids[0] : reply}
+        res = {}
+        while reply:
+            uuid = reply.pop(0)
+            status = reply.pop(0)
+            count = int(reply.pop(0))
+            res[uuid] = [status] + reply[:count]
+            del reply[:count]
+        return res
+
+    def fetch(self, uuids):
+        """Fetch the replies of requests, call the callbacks and close the requests on titanic
+        """
+        to_close = []
+        replies = self.replies(uuids)
+        for uuid in replies:
+            reply = replies[uuid]
+            status = reply.pop(0)
+            if uuid not in self.requests:
+                continue
+            self.requests[uuid]['status'] = status
+            if status == MDP.T_PENDING:
+                self.metrics['empty_polls'] += 1
+            elif status == MDP.T_OK:
+                latency = self.clock() - self.requests[uuid]['req_date']
+                self.metrics['completed'] += 1
+                self.metrics['latency_total'] += latency
+                self.metrics['latency_max'] = max(self.metrics['latency_max'], latency)
+                self.requests[uuid]['data'] = reply
+                if self.requests[uuid]['callback']:
+                    self.requests[uuid]['callback'](reply, self.requests[uuid]['args'], self.requests[uuid]['kwargs'])
+                    del self.requests[uuid]
+                logging.debug("CLIENT - Titanic received: %s", reply)
+                to_close.append(uuid)
+            elif status == MDP.T_UNKNOWN:
+                logging.error("CLIENT - MDP.ClientError in titanic.reply : uuid=%s", uuid)
+            elif status == MDP.T_ERROR:
+                logging.error("CLIENT - MDP.ServerError in titanic.reply : uuid=%s", uuid)
+        if to_close:
+            reply = self.client.send("titanic.close", to_close)
+            if reply:
+                status = reply.pop(0)
+                if status == MDP.T_UNKNOWN:
+                    logging.error("CLIENT - MDP.ClientError in titanic.close : uuids=%s", to_close)
+                    raise MDP.ClientError("titanic.close : uuids=%s" % (to_close))
+                elif status == MDP.T_ERROR:
+                    logging.error("CLIENT - MDP.ServerError in titanic.close : uuids=%s", to_close)
+                    raise MDP.ServerError("titanic.close : uuids=%s" % (to_close))
+
     def run(self):
         """Run the client in a loop
         """
         while not self._stopevent.isSet():
-            start_at = time.clock()
-            uuids = [uid for uid in self.requests.keys() if self.requests[uid]['status'] == MDP.T_PENDING]
-            for uuid in uuids:
-                logging.debug("CLIENT - titanic.reply for uuid %s", uuid)
-                reply = self.client.send("titanic.reply", [uuid])
-                if reply:
-                    status = reply.pop(0)
-                    self.requests[uuid]['status'] = status
-                    if status == MDP.T_OK:
-                        self.requests[uuid]['data'] = reply
-                        if self.requests[uuid]['callback']:
-                            self.requests[uuid]['callback'](reply, self.requests[uuid]['args'], self.requests[uuid]['kwargs'])
-                            del self.requests[uuid]
-                        logging.debug("CLIENT - Titanic received: %s", reply)
-                        reply = self.client.send("titanic.close", [uuid])
-                        if reply:
-                            status = reply.pop(0)
-                            if status == MDP.T_UNKNOWN:
-                                logging.error("CLIENT - MDP.ClientError in titanic.close : uuid=%s", uuid)
-                                raise MDP.ClientError("titanic.close : uuid=%s" % (uuid))
-                            elif status == MDP.T_ERROR:
-                                logging.error("CLIENT - MDP.ServerError in titanic.close : uuid=%s", uuid)
-                                raise MDP.ServerError("titanic.close : uuid=%s" % (uuid))
-                    elif status == MDP.T_UNKNOWN:
-                        logging.error("CLIENT - MDP.ClientError in titanic.reply : uuid=%s", uuid)
-                        raise MDP.ClientError("titanic.reply : uuid=%s" %(uuid))
-                    elif status == MDP.T_ERROR:
-                        logging.error("CLIENT - MDP.ServerError in titanic.reply : uuid=%s", uuid)
-                        raise MDP.ServerError("titanic.reply : uuid=%s" %(uuid))
-            now = time.time()
+            try:
+                items = dict(self.poller.poll(self.timeout(self.clock())))
+            except zmq.ZMQError as exc:
+                if not self._stopevent.isSet():
+                    raise exc
+                else:
+                    items = {}
+            uuids = []
+            if self.subscriber in items:
+                uuids = self.completed()
+            now = self.clock()
+            uuids += [uuid for uuid in self.due(now) if uuid not in uuids]
+            if uuids:
+                logging.debug("CLIENT - titanic.reply for uuids %s", uuids)
+                self.fetch(uuids)
             uuids_to_del = [uid for uid in self.requests.keys() if (self.requests[uid]['status'] == MDP.T_UNKNOWN or \
-                                                                     self.requests[uid]['status'] == MDP.T_ERROR or \
                                                                      self.requests[uid]['status'] == MDP.T_ERROR) and \
                                                                      (now-self.requests[uid]['req_date']) > self.ttl]
             for uuid in uuids_to_del:
                 logging.info("CLIENT - Titanic remove uuid %s because of ttl", uuid)
                 del self.requests[uuid]
-            sleep_time = self.poll - (time.clock() - start_at)
-            if sleep_time > 0:
-                self._stopevent.wait(sleep_time/500.0)
-            else:
-                logging.warning("CLIENT - Not enough time to sleep with current poll : %s ", sleep_time)
+
+    def destroy(self):
+        """ Destroy object
+        """
+        self.client.destroy()
+        self.ctx.destroy(0)
@@ -9,10 +9,23 @@ Based on Java example by Arkadiusz Orzechowski
 """
 
 import time
+import uuid
 import zmq
 import threading
 from raspy.common.zhelpers import zpipe
 import raspy.common.MDP as MDP
+from raspy.common import tracing
+
+TRACER = tracing.Tracer("WORKER")
+
+def file_chunks(filename, size=MDP.STREAM_CHUNK):
+    """Yield the content of a file by chunks of size bytes, to stream it with MajorDomoWorker.stream()"""
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            yield data
 
 class MajorDomoWorker(object):
     """Majordomo Protocol Worker API, Python version
@@ -27,6 +40,7 @@ class MajorDomoWorker(object):
 
     worker = None # Socket to broker
     heartbeat_at = 0 # When to send HEARTBEAT (relative to time.time(), so in seconds)
+    sent_at = 0 # When we sent the last message. Any message counts as a heartbeat for the broker
     liveness = 0 # How many attempts left
     heartbeat = 3500 # Heartbeat delay, msecs
     reconnect = 3500 # Reconnect delay, msecs
@@ -37,13 +51,22 @@ class MajorDomoWorker(object):
     timeout = 2500 # poller timeout
     verbose = False # Print activity to stdout
 
-    # Return address, if any
+    # Return envelope (list of addresses), if any
     reply_to = None
 
     status = True
     """The status of the worker. Should be update by callback in the future
     """
 
+    monitor = None
+    """Called with (worker, elapsed secs, reply) when a request is replied"""
+    request_at = None
+
+    copy = True
+    """False to get the body frames of the requests as zmq.Frame, without copy (frame.buffer is a view of their data).
+    The messages are always received without copy : only the envelope and the command are copied.
+    """
+
     def __init__(self, broker, service):
         self.broker = broker
         self.service = service
@@ -80,8 +103,11 @@ class MajorDomoWorker(object):
         if option:
             msg = [option] + msg
         msg = ['', MDP.W_WORKER, command] + msg
-        MDP.logger.debug("WORKER - Sending %s to broker", msg)
-        self.worker.send_multipart(msg)
+        if TRACER.enabled:
+            TRACER.trace("send", msg)
+        # Large replies are sent without copy
+        self.worker.send_multipart(msg, copy=False)
+        self.sent_at = time.time()
 
     def recv(self, reply=None):
         """Send reply, if any, to broker and wait for next request."""
@@ -89,7 +115,9 @@ class MajorDomoWorker(object):
         assert reply is not None or not self.expect_reply
         if reply is not None:
             assert self.reply_to is not None
-            reply = [self.reply_to, ''] + reply
+            if self.monitor is not None and self.request_at is not None:
+                self.monitor(self, time.time() - self.request_at, reply)
+            reply = self.reply_to + [''] + reply
             self.send_to_broker(MDP.W_REPLY, msg=reply)
         self.expect_reply = True
         while not self._stopevent.isSet():
@@ -99,30 +127,35 @@ class MajorDomoWorker(object):
             except KeyboardInterrupt: # pragma: no cover
                 break                 # pragma: no cover
             if items:
-                msg = self.worker.recv_multipart()
-                MDP.logger.debug("WORKER - Received message %s from broker: ", msg)
+                msg = self.worker.recv_multipart(copy=False)
+                if TRACER.enabled:
+                    TRACER.trace("recv", msg)
                 self.liveness = self.HEARTBEAT_LIVENESS
                 # Don't try to handle errors, just assert noisily
                 assert len(msg) >= 3
-                empty = msg.pop(0)
-                assert empty == ''
-                header = msg.pop(0)
-                assert header == MDP.W_WORKER
-                command = msg.pop(0)
+                assert len(msg[0]) == 0
+                assert msg[1].bytes == MDP.W_WORKER
+                command = msg[2].bytes
                 if command == MDP.W_REQUEST:
-                    # We should pop and save as many addresses as there are
-                    # up to a null part, but for now, just save one...
-                    self.reply_to = msg.pop(0)
-                    # pop empty
-                    assert msg.pop(0) == ''
-                    return msg # We have a request to process
-                elif command == MDP.W_HEARTBEAT:
-                    # Do nothing for heartbeats
+                    # Save as many addresses as there are
+                    # up to a null part
+                    empty = 4
+                    while len(msg[empty]) != 0:
+                        empty += 1
+                    self.reply_to = [frame.bytes for frame in msg[3:empty]]
+                    if self.monitor is not None:
+                        self.request_at = time.time()
+                    # We have a request to process
+                    if self.copy:
+                        return [frame.bytes for frame in msg[empty+1:]]
+                    return msg[empty+1:]
+                elif command == MDP.W_HEARTBEAT or command == MDP.W_CREDIT:
+                    # Do nothing for heartbeats and late credits
                     pass
                 elif command == MDP.W_DISCONNECT:
                     self.reconnect_to_broker()
                 else:
-                    MDP.logger.error("WORKER - Invalid input message: %s", msg)
+                    MDP.logger.error("WORKER - Invalid input message: %s", [frame.bytes for frame in msg])
             else:
                 self.liveness -= 1
                 if self.liveness == 0:
@@ -132,13 +165,97 @@ class MajorDomoWorker(object):
                     except KeyboardInterrupt:
                         break
                     self.reconnect_to_broker()
-            # Send HEARTBEAT if it's time
-            if time.time() > self.heartbeat_at:
-                self.send_to_broker(MDP.W_HEARTBEAT)
-                self.heartbeat_at = time.time() + 1e-3*self.heartbeat
+            self.check_heartbeat()
         MDP.logger.warn("WORKER - Interrupt received, killing worker...")
         return None
 
+    def check_heartbeat(self):
+        """Send HEARTBEAT if it's time and we sent nothing since the last one"""
+        if time.time() > self.heartbeat_at:
+            if self.sent_at < self.heartbeat_at - 1e-3*self.heartbeat:
+                self.send_to_broker(MDP.W_HEARTBEAT)
+            self.heartbeat_at = time.time() + 1e-3*self.heartbeat
+            # Follow the changes of the log level
+            tracing.refresh()
+
+    def stream(self, chunks, credit=None):
+        """Stream the reply to the current request, instead of replying
+        it with recv(reply). chunks is an iterable of strings, ie
+        file_chunks(filename) or a generator.
+
+        Each chunk is sent with W_STREAM : [stream id][sequence][''][data].
+        No more than credit chunks are sent ahead of the client, which
+        gives back a credit for each chunk it consumes. So a chunk is
+        only read from chunks when it can be sent and the memory is
+        bounded on both ends. The last chunk has no data and its final
+        frame is T_OK, or T_ERROR if the client gave no credit in time.
+
+        Call recv() without reply after it to wait for the next request.
+
+        :parameter credit: the chunks sent ahead. None for MDP.STREAM_CREDIT.
+        :returns: True if all the chunks were sent
+        """
+        assert self.reply_to is not None and self.expect_reply
+        stream_id = uuid.uuid4().hex
+        credit = MDP.STREAM_CREDIT if credit is None else credit
+        sequence = 0
+        final = MDP.T_OK
+        chunks = iter(chunks)
+        while final == MDP.T_OK:
+            while sequence >= credit:
+                given = self.wait_credit(stream_id)
+                if given == 0:
+                    MDP.logger.warn("WORKER - No credit from client, abandon stream %s", stream_id)
+                    final = MDP.T_ERROR
+                    break
+                credit += given
+            chunk = next(chunks, None) if final == MDP.T_OK else None
+            if chunk is None:
+                break
+            self.send_to_broker(MDP.W_STREAM, msg=self.reply_to + ['', stream_id, "%d" % sequence, '', chunk])
+            sequence += 1
+            self.check_heartbeat()
+        if self.reply_to is not None:
+            self.send_to_broker(MDP.W_STREAM, msg=self.reply_to + ['', stream_id, "%d" % sequence, final])
+        if self.monitor is not None and self.request_at is not None:
+            self.monitor(self, time.time() - self.request_at, [final])
+        self.expect_reply = False
+        return final == MDP.T_OK
+
+    def wait_credit(self, stream_id):
+        """Wait for the client of the stream to give back credit.
+
+        :returns: the credit given, 0 if the client or the broker is gone
+        """
+        while not self._stopevent.isSet():
+            try:
+                items = self.poller.poll(self.timeout)
+            except KeyboardInterrupt: # pragma: no cover
+                break                 # pragma: no cover
+            if items:
+                msg = self.worker.recv_multipart(copy=False)
+                if TRACER.enabled:
+                    TRACER.trace("recv", msg)
+                self.liveness = self.HEARTBEAT_LIVENESS
+                assert len(msg) >= 3
+                command = msg[2].bytes
+                if command == MDP.W_CREDIT:
+                    if len(msg) >= 5 and msg[3].bytes == stream_id:
+                        return int(msg[4].bytes)
+                elif command == MDP.W_DISCONNECT:
+                    # The broker forgot us, and the stream
+                    self.reply_to = None
+                    self.reconnect_to_broker()
+                    return 0
+            else:
+                # The broker doesn't send heartbeats to busy workers
+                self.liveness -= 1
+                if self.liveness == 0:
+                    self.liveness = self.HEARTBEAT_LIVENESS
+                    return 0
+            self.check_heartbeat()
+        return 0
+
     def destroy(self):
         """ Destroy object
         """
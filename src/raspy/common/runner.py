@@ -149,6 +149,8 @@ class Runner(object):
     def app_run(self):
         """
         The running process of the application
+
+        Create its executive with conffile=self.options['conffile_path'] : it reads the size of its pools in it.
         """
         raise RunnerInvalidActionError("Action: %(action)r is not implemented" % vars(self))
 
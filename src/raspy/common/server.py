@@ -37,20 +37,18 @@ class Server(Executive, Statistics):
 
     """
 
-    def __init__(self, hostname='localhost', service="worker", broker_ip='127.0.0.1', broker_port=5514):
+    def __init__(self, hostname='localhost', service="worker", broker_ip='127.0.0.1', broker_port=5514, conffile=None):
         """Initialize the worker
         """
-        Executive.__init__(self, hostname, service, broker_ip, broker_port)
-        self.worker_mmi_thread = threading.Thread(target=self.worker_mmi)
-        self.worker_mmi_thread.daemon = True
-        self._active_threads.append(self.worker_mmi_thread)
+        Executive.__init__(self, hostname, service, broker_ip, broker_port, conffile=conffile)
+        self.worker_mmi_pool = self.add_worker_pool(self.worker_mmi, "mmi")
         Statistics.__init__(self)
 
     def worker_mmi(self):
         """Retrieve mmi informations of the worker
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "%s.mmi" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s.mmi"%MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
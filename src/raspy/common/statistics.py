@@ -23,6 +23,7 @@ __email__ = 'bibi21000@gmail.com'
 import traceback
 import time
 import threading
+import json
 
 import raspy.common.MDP as MDP
 from raspy.common.executive import Executive
@@ -31,21 +32,32 @@ import logging
 
 class Statistics(object):
     """The statistics manager
+
+    A registry of SNMP objects, indexed by oid. The registered workers are
+    monitored : for each of them, the statistics <service>.requests,
+    <service>.errors (replies ending with T_ERROR) and <service>.latency
+    (the time spent in the handler) are updated after each request.
+
+    The <hostname>.<service>.statistics service replies to :
+
+        - all : [json dict oid -> value][T_OK]
+        - list_keys : [json list of oids][T_OK]
     """
 
     def __init__(self):
         """Initialize the worker
         """
-        self.worker_statistics_thread = threading.Thread(target=self.worker_statistics)
-        self.worker_statistics_thread.daemon = True
-        self._active_threads.append(self.worker_statistics_thread)
+        self.worker_statistics_pool = self.add_worker_pool(self.worker_statistics, "statistics")
         self._statistics = {}
+        self._statistics_lock = threading.Lock()
+        self._monitored = {}
+        self.worker_monitor = self.monitor_request
 
     def worker_statistics(self):
         """Send statistics via mmi
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "%s.statistics" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s.statistics"%MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -58,9 +70,9 @@ class Statistics(object):
                 logging.debug("worker_statistics received action %s", action)
                 reply = [MDP.T_ERROR]
                 if "all" == action:
-                    reply = [MDP.T_OK]
+                    reply = [json.dumps(self.get_statistics())] + [MDP.T_OK]
                 elif "list_keys" == action:
-                    reply = [json.dumps(self._statistics.keys())] + [MDP.T_OK]
+                    reply = [json.dumps(sorted(self._statistics.keys()))] + [MDP.T_OK]
                 else:
                     reply = [MDP.T_NOTIMPLEMENTED]
                     logging.debug("worker_statistics send [%s][%s]", action, MDP.T_NOTIMPLEMENTED)
@@ -68,24 +80,52 @@ class Statistics(object):
                 logging.exception("Exception in worker_statistics")
                 reply = [MDP.T_ERROR]
 
-    def add_statistic(self):
+    def add_statistic(self, snmp):
         """Add a new statistic to the manager
+
+        :parameter snmp: a SNMP object
+        :returns: the registered statistic : snmp or the one already registered with the same oid
         """
-        pass
+        with self._statistics_lock:
+            return self._statistics.setdefault(snmp.oid, snmp)
 
     def remove_statistic(self, oid):
         """Remove a statistic from the manager
         """
-        if oid in self._statistics:
-            del self._statistics[oid]
+        with self._statistics_lock:
+            self._statistics.pop(oid, None)
 
-    def update_statistic(self, oid="", ):
-        """Add a new statistic to the manager
+    def update_statistic(self, oid, value=1):
+        """Update a statistic : add value to a counter, set a gauge, record a latency, ...
+        """
+        self._statistics[oid].set(value)
+
+    def get_statistics(self):
+        """Return the values of all the statistics : a dict oid -> value
+        """
+        with self._statistics_lock:
+            statistics = list(self._statistics.values())
+        return dict((snmp.oid, snmp.get()) for snmp in statistics)
+
+    def monitor_request(self, worker, elapsed, reply):
+        """Update the statistics of a worker after a request
         """
-        pass
+        monitored = self._monitored.get(worker.service)
+        if monitored is None:
+            monitored = self._monitored[worker.service] = (
+                self.add_statistic(SNMPCounter(oid="%s.requests" % worker.service, doc="Requests processed")),
+                self.add_statistic(SNMPCounter(oid="%s.errors" % worker.service, doc="Requests in error")),
+                self.add_statistic(SNMPHistogram(oid="%s.latency" % worker.service, doc="Time spent in the handler")),
+            )
+        monitored[0].set()
+        if reply and reply[-1] == MDP.T_ERROR:
+            monitored[1].set()
+        monitored[2].set(elapsed)
 
 class SNMP(object):
     '''Abstract statistic item
+
+    The updates are thread safe.
     '''
     def __init__(self, oid="module.snmp.key", doc="A statistic integer value", initial=0):
         """Init the object
@@ -93,16 +133,23 @@ class SNMP(object):
         self.value = initial
         self.oid = oid
         self.doc = doc
+        self.lock = threading.Lock()
 
     def set(self, value):
         """ Set a value to the snmp object
         """
-        self.value += value
+        with self.lock:
+            self.value += value
+
+    def get(self):
+        """Return the value, json serializable
+        """
+        return self.value
 
     def __str__(self):
         """Return a string representation of the value
         """
-        return repr(self.value)
+        return repr(self.get())
 
 class SNMPCounter(SNMP):
     '''Long (32bits) with overflow
@@ -116,9 +163,110 @@ class SNMPCounter(SNMP):
     def set(self, value=1):
         """Add value (default=1) to current value. Also manage overflow.
         """
-        self.value += value
-        if self.value > self.overflow:
-            self.value -= self.overflow
+        with self.lock:
+            self.value += value
+            if self.value > self.overflow:
+                self.value -= self.overflow
+
+class SNMPGauge(SNMP):
+    '''Gauge : the last value set
+    '''
+    def __init__(self, oid="module.snmp.key", doc="A statistic gauge value", initial=0):
+        """Init the object
+        """
+        SNMP.__init__(self, oid=oid, doc=doc, initial=initial)
+
+    def set(self, value):
+        """Replace the current value
+        """
+        self.value = value
+
+class SNMPHistogram(SNMP):
+    '''Histogram of latencies
+
+    The latencies are counted in usecs, like HdrHistogram : exactly under
+    2**SUB_BITS usecs, then each power of 2 is split in 2**(SUB_BITS-1) linear
+    sub-buckets. So a percentile is at most 1/2**(SUB_BITS-1) above the
+    recorded latency (about 3%), whatever its magnitude.
+    '''
+    UNIT = 1e-6
+    SUB_BITS = 6
+
+    def __init__(self, oid="module.snmp.key", doc="A statistic histogram of latencies"):
+        """Init the object
+        """
+        SNMP.__init__(self, oid=oid, doc=doc, initial=0)
+        self.buckets = {}
+        self.total = 0.0
+        self.max = 0.0
+
+    def bucket(self, value):
+        """Return the index of the bucket of a latency in secs
+        """
+        units = int(value / self.UNIT)
+        if units < 2**self.SUB_BITS:
+            return max(units, 0)
+        shift = units.bit_length() - self.SUB_BITS
+        return shift * 2**(self.SUB_BITS-1) + (units >> shift)
+
+    def upper_bound(self, index):
+        """Return the highest latency in secs counted in a bucket
+        """
+        if index < 2**self.SUB_BITS:
+            return (index + 1) * self.UNIT
+        half = 2**(self.SUB_BITS-1)
+        shift = index // half - 1
+        return ((index - shift * half + 1) << shift) * self.UNIT
+
+    def set(self, value):
+        """Record a latency in secs
+        """
+        index = self.bucket(value)
+        with self.lock:
+            self.value += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def snapshot(self):
+        """Return (count, total, max, buckets) taken under the lock
+        """
+        with self.lock:
+            return self.value, self.total, self.max, dict(self.buckets)
+
+    def _percentile(self, snapshot, percent):
+        """Return the upper bound of the bucket holding the percentile of a snapshot
+        """
+        count, total, maximum, buckets = snapshot
+        if count == 0:
+            return 0.0
+        rank = count * percent / 100.0
+        seen = 0
+        for index in sorted(buckets):
+            seen += buckets[index]
+            if seen >= rank:
+                return min(self.upper_bound(index), maximum)
+        return maximum
+
+    def percentile(self, percent):
+        """Return the percentile (in secs)
+        """
+        return self._percentile(self.snapshot(), percent)
+
+    def get(self):
+        """Return a dict with count, avg, max, p50, p90 and p99, from one snapshot
+        """
+        snapshot = self.snapshot()
+        count, total, maximum, buckets = snapshot
+        return {
+            'count' : count,
+            'avg' : total / count if count else 0.0,
+            'max' : maximum,
+            'p50' : self._percentile(snapshot, 50),
+            'p90' : self._percentile(snapshot, 90),
+            'p99' : self._percentile(snapshot, 99),
+        }
 
 class SNMPFloat(SNMP):
     '''Float counter
@@ -129,9 +277,14 @@ class SNMPFloat(SNMP):
         SNMP.__init__(self, oid=oid, doc=doc, initial=initial)
 
 class SNMPString(SNMP):
-    '''Float counter
+    '''String value
     '''
     def __init__(self, oid="module.snmp.key", doc="A statistic string value", initial=""):
         """Init the object
         """
         SNMP.__init__(self, oid=oid, doc=doc, initial=initial)
+
+    def set(self, value):
+        """Replace the current value
+        """
+        self.value = value
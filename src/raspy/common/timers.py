@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""A hierarchical timer wheel.
+
+Scheduling and expiring a timer costs O(1), whatever the number of timers.
+The wheel has levels of slots : a slot of level 0 covers one tick, a slot of
+level l covers slots**l ticks. A timer is put in the lowest level covering
+its delay. When the wheel turns, the slots of the higher levels are cascaded
+to the lower ones, until the timers reach level 0 and expire.
+
+Timers can't be cancelled : the owner checks its state when the timer
+expires and schedules a new one if needed. This keeps the refresh of a
+deadline (ie the liveness of a worker) to an attribute update.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__copyright__ = "Copyright © 2013-2014 Sébastien GALLET aka bibi21000"
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import math
+import time
+
+class TimerWheel(object):
+    """A hierarchical timer wheel
+    """
+
+    def __init__(self, tick=0.1, slots=64, levels=3, now=None):
+        """Initialize the wheel
+
+        :parameter tick: the resolution of the wheel in secs
+        :parameter slots: the number of slots of each level
+        :parameter levels: the number of levels. Timers beyond tick*slots**levels are cascaded again.
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for i in range(slots)] for level in range(levels)]
+        self.current = int((time.time() if now is None else now) / tick)
+        """The last expired tick"""
+        self.count = 0
+        self._due = None
+        """The next tick to turn the wheel to, None when it must be computed again"""
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, at, item):
+        """Schedule item to expire at time at"""
+        self._insert(max(int(math.ceil(at / self.tick)), self.current + 1), item)
+        self.count += 1
+
+    def _insert(self, tick, item):
+        """Put item in the slot of tick"""
+        delay = tick - self.current
+        span = self.slots
+        for level in range(self.levels):
+            if delay < span or level == self.levels - 1:
+                break
+            span *= self.slots
+        at = tick
+        if delay >= span:
+            # Too far : wait in the last slot before the current one of the last level
+            at = self.current + span - span // self.slots
+        self.wheels[level][(at * self.slots // span) % self.slots].append((tick, item))
+        # The wheel must turn at the start of the slot to expire or cascade the item
+        unit = span // self.slots
+        if self._due is not None and at // unit * unit < self._due:
+            self._due = at // unit * unit
+
+    def next_due(self):
+        """Return the time the wheel must turn next to expire or cascade timers, None if it's empty.
+
+        The timers don't expire before it, so the owner can sleep until then.
+        """
+        if self.count == 0:
+            return None
+        if self._due is None:
+            due = []
+            unit = 1
+            for level in range(self.levels):
+                for slot in range(1, self.slots + 1):
+                    start = (self.current // unit + slot) * unit
+                    if self.wheels[level][(start // unit) % self.slots]:
+                        due.append(start)
+                        break
+                unit *= self.slots
+            self._due = min(due)
+        return self._due * self.tick
+
+    def expire(self, now=None):
+        """Turn the wheel up to now.
+
+        :returns: the list of the expired items
+        """
+        target = int((time.time() if now is None else now) / self.tick)
+        expired = []
+        if self.current < target:
+            self._due = None
+        while self.current < target:
+            self.current += 1
+            span = self.slots ** (self.levels - 1)
+            for level in range(self.levels - 1, 0, -1):
+                if self.current % span == 0:
+                    slot = self.wheels[level][(self.current // span) % self.slots]
+                    if slot:
+                        timers = list(slot)
+                        del slot[:]
+                        for tick, item in timers:
+                            self._insert(max(tick, self.current), item)
+                span //= self.slots
+            slot = self.wheels[0][self.current % self.slots]
+            if slot:
+                timers = list(slot)
+                del slot[:]
+                for tick, item in timers:
+                    if tick > self.current:
+                        # Beyond the range of the wheel
+                        self._insert(tick, item)
+                    else:
+                        expired.append(item)
+                        self.count -= 1
+        return expired
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""Hot path tracing.
+
+Logging every message in the loops of the broker, the workers and the
+proxy is costly, even when the messages are filtered by the level : the
+call to the logger is made and some arguments are built. A Tracer caches
+logger.isEnabledFor(DEBUG) in its enabled attribute, so the guard costs an
+attribute lookup :
+
+.. code-block:: python
+
+    TRACER = Tracer("BROKER")
+    ...
+    if TRACER.enabled:
+        TRACER.trace("recv", msg)
+
+The cache is updated by refresh(), to call after changing the log level.
+The loops call it periodically (ie with the heartbeats).
+
+Only 1 event of sample is traced. Events can also be written to a binary
+file (see configure()), without formatting them : a record [kind][timestamp][id][size]
+where kind is NAME (the record is followed by size bytes of the event name)
+or EVENT (size is the size of the message). Use read_trace() to decode it.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__copyright__ = "Copyright © 2013-2014 Sébastien GALLET aka bibi21000"
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import logging
+import struct
+import threading
+import time
+import weakref
+import zmq
+import raspy.common.MDP as MDP
+
+RECORD = struct.Struct('!BdHI') # kind, timestamp, event id, size
+NAME = 0
+EVENT = 1
+
+class TraceOutput(object):
+    """A binary trace file, shared by the tracers
+    """
+
+    def __init__(self, filename):
+        """Open the trace file"""
+        self.lock = threading.Lock()
+        self.events = {}
+        self.output = open(filename, 'ab')
+
+    def write(self, name, size):
+        """Write an event"""
+        with self.lock:
+            event = self.events.get(name)
+            if event is None:
+                event = self.events[name] = len(self.events)
+                data = name.encode('utf-8')
+                self.output.write(RECORD.pack(NAME, time.time(), event, len(data)) + data)
+            self.output.write(RECORD.pack(EVENT, time.time(), event, size))
+
+    def close(self):
+        """Close the trace file"""
+        with self.lock:
+            self.output.close()
+
+class Tracer(object):
+    """A tracer for a hot path
+    """
+
+    sample = 1
+    """Trace 1 event of sample"""
+
+    output = None
+    """The binary TraceOutput, if any"""
+
+    def __init__(self, name, logger=MDP.logger):
+        """Create a tracer
+
+        A tracer can be shared by many threads (ie the clients).
+
+        :parameter name: the prefix of the traces (BROKER, WORKER, ...)
+        """
+        self.name = name
+        self.logger = logger
+        self.count = 0
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.log_enabled = False
+        _tracers.add(self)
+        self.refresh()
+
+    def refresh(self):
+        """Update the cache of the guard"""
+        self.log_enabled = self.logger.isEnabledFor(logging.DEBUG)
+        self.enabled = self.log_enabled or Tracer.output is not None
+
+    def trace(self, event, msg):
+        """Trace an event with its message (a list of frames).
+        The caller must check enabled before.
+        """
+        with self.lock:
+            self.count += 1
+            count = self.count
+        if count % Tracer.sample != 0:
+            return
+        output = Tracer.output
+        if output is not None:
+            output.write("%s.%s" % (self.name, event), sum([len(frame) for frame in msg]))
+        if self.log_enabled:
+            # The frames received without copy are logged with their content
+            self.logger.debug("%s - %s : %s", self.name, event, \
+                [frame.bytes if isinstance(frame, zmq.Frame) else frame for frame in msg])
+
+# The tracers alive : a tracer is dropped when it is garbage collected
+_tracers = weakref.WeakSet()
+
+def refresh():
+    """Update the cache of all the tracers, ie after changing the log level"""
+    for tracer in list(_tracers):
+        tracer.refresh()
+
+def configure(sample=1, filename=None):
+    """Configure the tracers
+
+    :parameter sample: trace 1 event of sample
+    :parameter filename: write the events to this binary file. None to stop it.
+    """
+    if Tracer.output is not None:
+        Tracer.output.close()
+        Tracer.output = None
+    Tracer.sample = max(1, sample)
+    if filename is not None:
+        Tracer.output = TraceOutput(filename)
+    refresh()
+
+def read_trace(filename):
+    """Yield the events of a binary trace file : (timestamp, name, size)"""
+    names = {}
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            kind, timestamp, event, size = RECORD.unpack(data)
+            if kind == NAME:
+                names[event] = f.read(size).decode('utf-8')
+            else:
+                yield (timestamp, names.get(event), size)
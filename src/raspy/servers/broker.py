@@ -32,45 +32,260 @@ Credits :
 """
 
 import logging
+import math
+import os
 import time
 from binascii import hexlify
+from bisect import bisect_left
+from collections import OrderedDict
+import heapq
+import random
 import re
 import threading
+import json
 import zmq
 
 import raspy.common.MDP as MDP
 from raspy.common.executive import Executive
 from raspy.common.kvsimple import KVMsg
+from raspy.common.journal import Journal
+from raspy.common.kvcliapi import KvPublisherClient
+from raspy.common.statistics import SNMPCounter, SNMPHistogram
+from raspy.common.timers import TimerWheel
+from raspy.common import tracing
+
+TRACER = tracing.Tracer("BROKER")
+PROXY_TRACER = tracing.Tracer("PROXY")
 
 # simple struct for routing information for a key-value snapshot
 class Route:
-    def __init__(self, socket, identity, subtree):
+    def __init__(self, socket, identity, subtree, keys=None, sequence=0, credit=None):
         self.socket = socket        # ROUTER socket to send to
         self.identity = identity    # Identity of peer who requested state
         self.subtree = subtree      # Client subtree specification
+        self.keys = keys            # Keys of the snapshot left to send
+        self.sequence = sequence    # Sequence of the proxy when the snapshot was requested
+        self.credit = credit        # Messages the peer can receive, None for no limit
+        self.expiry = None          # Drop the snapshot at this point, unless credit
+
+class KeyIndex(object):
+    """A sorted index of the keys of a kvmap
+
+    The keys are kept in sorted chunks of CHUNK to 2*CHUNK keys, with the
+    last key of each chunk : adding or removing a key costs O(log n + CHUNK)
+    instead of moving the whole sorted list.
+    Find the keys of a subtree in O(log n + matching keys).
+    """
+    CHUNK = 1000
+
+    def __init__(self, keys=None):
+        keys = sorted(keys) if keys else []
+        self.chunks = [keys[i:i+self.CHUNK] for i in range(0, len(keys), self.CHUNK)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+        self.count = len(keys)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for key in chunk:
+                yield key
+
+    def add(self, key):
+        """Add key to the index if it's not already in"""
+        if not self.chunks:
+            self.chunks.append([key])
+            self.maxes.append(key)
+            self.count += 1
+            return
+        pos = bisect_left(self.maxes, key)
+        if pos == len(self.maxes):
+            # After the last key
+            pos -= 1
+            chunk = self.chunks[pos]
+            chunk.append(key)
+            self.maxes[pos] = key
+        else:
+            chunk = self.chunks[pos]
+            i = bisect_left(chunk, key)
+            if chunk[i] == key:
+                return
+            chunk.insert(i, key)
+        self.count += 1
+        if len(chunk) > 2*self.CHUNK:
+            self.chunks.insert(pos+1, chunk[self.CHUNK:])
+            del chunk[self.CHUNK:]
+            self.maxes.insert(pos, chunk[-1])
+
+    def remove(self, key):
+        """Remove key from the index if it's in"""
+        pos = bisect_left(self.maxes, key)
+        if pos == len(self.maxes):
+            return
+        chunk = self.chunks[pos]
+        i = bisect_left(chunk, key)
+        if chunk[i] != key:
+            return
+        del chunk[i]
+        self.count -= 1
+        if not chunk:
+            del self.chunks[pos]
+            del self.maxes[pos]
+        elif i == len(chunk):
+            self.maxes[pos] = chunk[-1]
+
+    def prefix(self, prefix):
+        """Return the list of keys starting with prefix"""
+        keys = []
+        pos = bisect_left(self.maxes, prefix)
+        start = bisect_left(self.chunks[pos], prefix) if pos < len(self.chunks) else 0
+        while pos < len(self.chunks):
+            chunk = self.chunks[pos]
+            end = start
+            while end < len(chunk) and chunk[end].startswith(prefix):
+                end += 1
+            keys.extend(chunk[start:end])
+            if end < len(chunk):
+                break
+            pos += 1
+            start = 0
+        return keys
+
+FORWARDED = "\0fwd" # Prefix of the request id of the requests forwarded to a peer
+DIRECTORY = "\0directory" # Request id of the mmi.directory requests sent to the peers
+
+REGEX_SPECIALS = ".^$*+?{}[]\\|()"
+
+def regex_prefix(pattern):
+    """Return the literal prefix of the names matched by a regex with re.search.
+
+    Only a pattern anchored with ^ has one : '^host1\\.devices\\..*' -> 'host1.devices.'
+    """
+    if not pattern.startswith('^') or '|' in pattern:
+        return ''
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 >= len(pattern) or pattern[i+1].isalnum():
+                break
+            char = pattern[i+1]
+            i += 2
+        elif char in REGEX_SPECIALS:
+            break
+        else:
+            i += 1
+        if i < len(pattern) and pattern[i] in "*?{":
+            # The last char is optional
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+def frame_bytes(frame):
+    """Return the content of a frame : a zmq.Frame received with copy=False or a string"""
+    return frame.bytes if isinstance(frame, zmq.Frame) else frame
+
+def delimiter(msg, start=0):
+    """Return the index of the first empty frame of msg from start.
+
+    Works on zmq.Frame and strings without copying them.
+    Raise ValueError if there's none.
+    """
+    for i in range(start, len(msg)):
+        if len(msg[i]) == 0:
+            return i
+    raise ValueError("No empty delimiter frame in message")
 
 class Service(object):
     """a single Service"""
     name = None # Service name
-    requests = None # List of client requests
-    waiting = None # List of waiting workers
+    requests = None # Heap of client requests : (-priority, order, arrived at, deadline, msg)
+    waiting = None # Waiting workers, by identity, oldest first
+    workers = 0 # Number of workers attached
+    rate = 0.0 # Requests per second during the last stats interval
 
     def __init__(self, name):
         self.name = name
         self.requests = []
-        self.waiting = []
+        self.order = 0
+        self.waiting = OrderedDict()
+        self.requests_count = SNMPCounter(oid="%s.requests" % name, doc="Requests received")
+        self.expired_count = SNMPCounter(oid="%s.expired" % name, doc="Requests dropped after their deadline")
+        self.overload_count = SNMPCounter(oid="%s.overload" % name, doc="Requests refused because the queue is full")
+        self.replies_count = SNMPCounter(oid="%s.replies" % name, doc="Replies sent back")
+        self.latency = SNMPHistogram(oid="%s.latency" % name, doc="Time from client request to worker reply")
+        self.last_requests = 0
+
+    def stats(self):
+        """Return the statistics of the service"""
+        return {
+            'requests' : self.requests_count.get(),
+            'replies' : self.replies_count.get(),
+            'expired' : self.expired_count.get(),
+            'overload' : self.overload_count.get(),
+            'queue' : len(self.requests),
+            'workers' : self.workers,
+            'idle' : len(self.waiting),
+            'rate' : self.rate,
+            'latency' : self.latency.get(),
+        }
+
+    def queue(self, msg, arrived, deadline=None, priority=0):
+        """Queue a request. Higher priorities first, then first in first out"""
+        self.order += 1
+        heapq.heappush(self.requests, (-priority, self.order, arrived, deadline, msg))
+
+    def next_request(self, now):
+        """Pop the next request, dropping the expired ones.
+
+        :returns: (arrived at, msg) or None if there is no request
+        """
+        while self.requests:
+            priority, order, arrived, deadline, msg = heapq.heappop(self.requests)
+            if deadline is not None and deadline < now:
+                self.expired_count.set()
+                continue
+            return arrived, msg
+        return None
+
+    def drop_expired(self, now):
+        """Drop all the expired requests"""
+        requests = [request for request in self.requests if request[3] is None or request[3] >= now]
+        if len(requests) < len(self.requests):
+            self.expired_count.set(len(self.requests) - len(requests))
+            heapq.heapify(requests)
+            self.requests = requests
+
+class Peer(object):
+    """a peer Broker, reached through a DEALER"""
+    endpoint = None # Endpoint of the peer
+    socket = None # Our DEALER connected to the peer
+    services = None # Services with workers on the peer
+    expiry = 0 # the directory is dropped at this point, unless refreshed
+
+    def __init__(self, endpoint, socket):
+        self.endpoint = endpoint
+        self.socket = socket
+        self.services = set()
 
 class Worker(object):
     """a Worker, idle or active"""
     identity = None # hex Identity of worker
-    address = None # Address to route to
+    address = None # Address frames to route to
     service = None # Owning service, if known
     expiry = None # expires at this point, unless heartbeat
+    heartbeat_at = None # send a heartbeat at this point, unless traffic
+    timer_at = None # time of our pending timer in the wheel
+    request_at = None # arrival of the request being processed
+    stream = None # id of the stream being sent
 
     def __init__(self, identity, address, lifetime):
         self.identity = identity
         self.address = address
         self.expiry = time.time() + 1e-3*lifetime
+        self.heartbeat_at = self.expiry
 
 class Proxy(threading.Thread):
     """The publisher
@@ -81,9 +296,41 @@ class Proxy(threading.Thread):
         - /device/
 
     from : http://zguide.zeromq.org/page:all#Working-with-Subtrees
+
+    **Snapshots**
+
+    A client requests a snapshot with [ICANHAZ?][subtree][credit] and gets the
+    entries of the subtree followed by [KTHXBAI]. The snapshot is streamed by
+    chunks between the updates from the collector, so publishing never stalls.
+    The client can send at most credit entries at a time and grants more
+    with [CREDIT][count][subtree]. Without credit frame, there is no limit.
+    Without subtree frame, the credit is given to all the snapshots of the
+    client. A client can request the snapshots of many subtrees at once :
+    the body of each KTHXBAI is its subtree.
+
+    KTHXBAI holds the sequence of the proxy when the snapshot was requested :
+    the client must apply all the updates published after it.
+
+    **Persistence**
+
+    With a data_dir, the updates are appended to a journal in data_dir/proxy
+    and the state (kvmap and sequence) is restored at startup. The journal is
+    compacted in background when it holds more updates than live keys.
+
+    **Time to live**
+
+    An update with a ttl is timestamped by the proxy if needed. The key is
+    deleted (and the delete published) when the ttl is over, unless it was
+    updated meanwhile.
     """
 
-    def __init__(self, hostname='localhost', service="broker", broker_ip='*', broker_port=5514, speed=1.0):
+    SNAPSHOT_CHUNK = 500 # Max entries sent to a client per loop
+    SNAPSHOT_TTL = 30 # Drop a snapshot after secs without credit
+    COLLECTOR_BATCH = 500 # Max updates applied per loop
+    COMPACT_INTERVAL = 60 # Check the journal for compaction every secs
+    COMPACT_MIN = 10000 # Don't compact the journal under this number of updates
+
+    def __init__(self, hostname='localhost', service="broker", broker_ip='*', broker_port=5514, speed=1.0, data_dir=None):
         """Initialize the proxy
         """
         threading.Thread.__init__(self)
@@ -97,6 +344,16 @@ class Proxy(threading.Thread):
         self.collector.bind("tcp://%s:%s" % (broker_ip, broker_port+3))
         self.sequence = 0
         self.kvmap = {}
+        self.journal = None
+        self.compact_thread = None
+        self.compact_at = time.time() + self.COMPACT_INTERVAL
+        self.expiries = []
+        """Heap of (expires at, key, sequence) for the updates with a ttl"""
+        if data_dir is not None:
+            self.journal = Journal(os.path.join(data_dir, "proxy"))
+            self.restore()
+        self.index = KeyIndex(self.kvmap.keys())
+        self.routes = {}
         self.poller = zmq.Poller()
         self.poller.register(self.collector, zmq.POLLIN)
         self.poller.register(self.snapshot, zmq.POLLIN)
@@ -110,8 +367,10 @@ class Proxy(threading.Thread):
         """Run the proxy
         """
         while not self._stopevent.isSet():
+            # Don't wait if there are snapshots to send
+            timeout = 0 if self.snapshots_ready() else self.speed*1000.0
             try:
-                items = dict(self.poller.poll(self.speed*1000.0))
+                items = dict(self.poller.poll(timeout))
             except KeyboardInterrupt: # pragma: no cover
                 break                 # pragma: no cover
             except zmq.ZMQError as exc:
@@ -119,45 +378,169 @@ class Proxy(threading.Thread):
                     raise exc
                 else:
                     items = []
-            # Apply state update sent from client
+            # Apply state updates sent from clients
             if self.collector in items:
-                kvmsg = KVMsg.recv(self.collector)
-                self.sequence += 1
-                kvmsg.sequence = self.sequence
-                kvmsg.send(self.publisher)
-                kvmsg.store(self.kvmap)
-                MDP.logger.debug("PROXY - Server publishing update for sequence %5d", self.sequence)
-            # Execute state snapshot request
+                for i in range(self.COLLECTOR_BATCH):
+                    try:
+                        kvmsg = KVMsg.from_msg(self.collector.recv_multipart(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+                    self.update(kvmsg)
+            # Execute state snapshot requests
             if self.snapshot in items:
-                msg = self.snapshot.recv_multipart()
-                identity, request, subtree = msg
-                if request == "ICANHAZ?":
-                    pass
+                while True:
+                    try:
+                        msg = self.snapshot.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.process_snapshot(msg)
+            self.send_snapshots()
+            self.expire()
+            if self.journal is not None and time.time() > self.compact_at:
+                self.compact_at = time.time() + self.COMPACT_INTERVAL
+                if self.journal.appended > max(self.COMPACT_MIN, len(self.kvmap)):
+                    self.compact(background=True)
+        #Destroy context
+        self.ctx.destroy(0)
+        if self.compact_thread is not None:
+            self.compact_thread.join()
+        if self.journal is not None:
+            self.journal.close()
+
+    def update(self, kvmsg):
+        """Apply a state update : publish it, store it and journal it"""
+        self.sequence += 1
+        kvmsg.sequence = self.sequence
+        if kvmsg.ttl and not kvmsg.timestamp:
+            kvmsg.timestamp = time.time()
+        kvmsg.send(self.publisher)
+        if kvmsg.ttl and kvmsg.body is not None:
+            heapq.heappush(self.expiries, (kvmsg.timestamp + kvmsg.ttl, kvmsg.key, kvmsg.sequence))
+        if kvmsg.key is not None:
+            if kvmsg.body is None:
+                self.index.remove(kvmsg.key)
+            else:
+                self.index.add(kvmsg.key)
+        kvmsg.store(self.kvmap)
+        if self.journal is not None:
+            self.journal.append(kvmsg.pack())
+        if PROXY_TRACER.enabled:
+            PROXY_TRACER.trace("publish", [kvmsg.key or '', kvmsg.body or ''])
+
+    def restore(self):
+        """Restore kvmap and sequence from the journal"""
+        for data in self.journal.replay():
+            kvmsg = KVMsg.unpack(data)
+            if kvmsg.sequence > self.sequence:
+                self.sequence = kvmsg.sequence
+            kvmsg.store(self.kvmap)
+        for kvmsg in self.kvmap.values():
+            if kvmsg.ttl:
+                heapq.heappush(self.expiries, (kvmsg.timestamp + kvmsg.ttl, kvmsg.key, kvmsg.sequence))
+        MDP.logger.info("PROXY - Restored %s keys at sequence %s", len(self.kvmap), self.sequence)
+
+    def expire(self):
+        """Delete the keys whose ttl is over, unless they were updated since"""
+        now = time.time()
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, key, sequence = heapq.heappop(self.expiries)
+            kvmsg = self.kvmap.get(key)
+            if kvmsg is not None and kvmsg.sequence == sequence:
+                MDP.logger.debug("PROXY - Key %s expired", key)
+                self.update(KVMsg(0, key=key))
+
+    def compact(self, background=False):
+        """Replace the journal by a snapshot of the current state"""
+        if self.compact_thread is not None:
+            if self.compact_thread.is_alive():
+                return
+            self.compact_thread.join()
+            self.compact_thread = None
+        upto = self.journal.rotate()
+        # Stored kvmsgs are never updated : the list is a consistent snapshot
+        kvmsgs = list(self.kvmap.values())
+        # Keep the sequence even if the last updates were deletes
+        kvmsgs.append(KVMsg(self.sequence))
+        records = (kvmsg.pack() for kvmsg in kvmsgs)
+        if background:
+            self.compact_thread = threading.Thread(target=self.journal.compact, args=(records, upto))
+            self.compact_thread.daemon = True
+            self.compact_thread.start()
+        else:
+            self.journal.compact(records, upto)
+
+    def process_snapshot(self, msg):
+        """Process a message received on the snapshot socket"""
+        identity = msg.pop(0)
+        request = msg.pop(0) if msg else None
+        try:
+            if request == "ICANHAZ?" and len(msg) >= 1:
+                subtree = msg.pop(0)
+                credit = int(msg.pop(0)) if msg else None
+                if (identity, subtree) in self.routes:
+                    MDP.logger.warning("PROXY - Snapshot for subtree %s already sent to %s. Ignoring.", subtree, hexlify(identity))
+                    return
+                keys = self.index.prefix(subtree)
+                route = Route(self.snapshot, identity, subtree, keys=keys, sequence=self.sequence, credit=credit)
+                route.expiry = time.time() + self.SNAPSHOT_TTL
+                self.routes[(identity, subtree)] = route
+                MDP.logger.debug("PROXY - Start state snapshot %5d for subtree %s : %s keys", self.sequence, subtree, len(keys))
+            elif request == "CREDIT" and len(msg) >= 1:
+                credit = int(msg.pop(0))
+                if msg:
+                    routes = [self.routes.get((identity, msg.pop(0)))]
                 else:
-                    MDP.logger.error("PROXY - Server recevie bad request. Aborting.")
-                    break
-                # Send state snapshot to client
-                route = Route(self.snapshot, identity, subtree)
-                # For each entry in kvmap, send kvmsg to client
-                for k, v in self.kvmap.items():
-                    self.send_single(k, v, route)
+                    # Without subtree, the credit is for all the snapshots of the client
+                    routes = [route for route in self.routes.values() if route.identity == identity]
+                for route in routes:
+                    if route is not None and route.credit is not None:
+                        route.credit += credit
+                        route.expiry = time.time() + self.SNAPSHOT_TTL
+            else:
+                MDP.logger.error("PROXY - Server receive bad request %s. Ignoring.", request)
+        except ValueError:
+            MDP.logger.error("PROXY - Server receive bad credit in request %s. Ignoring.", request)
+
+    def snapshots_ready(self):
+        """Return True if we can send entries of a snapshot"""
+        for route in self.routes.values():
+            if not route.keys or route.credit is None or route.credit > 0:
+                return True
+        return False
+
+    def send_snapshots(self):
+        """Send a chunk of entries to each client which has credit and end finished snapshots"""
+        now = time.time()
+        for route_id, route in list(self.routes.items()):
+            count = self.SNAPSHOT_CHUNK if route.credit is None else min(self.SNAPSHOT_CHUNK, route.credit)
+            sent = 0
+            while sent < count and route.keys:
+                key = route.keys.pop()
+                kvmsg = self.kvmap.get(key)
+                # The key may have been deleted since the request
+                if kvmsg is not None:
+                    self.send_single(key, kvmsg, route)
+                    sent += 1
+            if route.credit is not None:
+                route.credit -= sent
+            if not route.keys:
                 # Now send END message with sequence number
-                MDP.logger.debug("PROXY - Sending state shapshot %5d", self.sequence)
-                self.snapshot.send(identity, zmq.SNDMORE)
-                kvmsg = KVMsg(self.sequence)
+                MDP.logger.debug("PROXY - Sending state shapshot %5d", route.sequence)
+                route.socket.send(route.identity, zmq.SNDMORE)
+                kvmsg = KVMsg(route.sequence)
                 kvmsg.key = "KTHXBAI"
-                kvmsg.body = subtree
-                kvmsg.send(self.snapshot)
-        #Destroy context
-        self.ctx.destroy(0)
+                kvmsg.body = route.subtree
+                kvmsg.send(route.socket)
+                del self.routes[route_id]
+            elif sent == 0 and route.expiry < now:
+                MDP.logger.warning("PROXY - Drop state snapshot for %s : no credit", hexlify(route.identity))
+                del self.routes[route_id]
 
     def send_single(self, key, kvmsg, route):
         """Send one state snapshot key-value pair to a socket"""
-        # check front of key against subscription subtree:
-        if kvmsg.key.startswith(route.subtree):
-            # Send identity of recipient first
-            route.socket.send(route.identity, zmq.SNDMORE)
-            kvmsg.send(route.socket)
+        # Send identity of recipient first
+        route.socket.send(route.identity, zmq.SNDMORE)
+        kvmsg.send(route.socket)
 
     def shutdown(self):
         """Shutdown the proxy.
@@ -184,6 +567,88 @@ class Broker(Executive):
         }
 
     You can do the same for crons and scenarios
+
+    Only the services with workers are discovered. The compiled patterns
+    and the results are kept in LRU caches of DISCOVERY_CACHE entries. The
+    results are invalidated when a service gets its first worker or loses
+    its last one. The names of these services are kept sorted, so a pattern
+    anchored with a literal prefix (ie ^host1\.devices\.) only looks at
+    the names starting with it.
+
+    **Heartbeats**
+
+    Each idle worker has a timer in a hierarchical timer wheel, due at its
+    next heartbeat or at its expiry. Any message from a worker refreshes
+    its expiry and any message to a worker delays its next heartbeat, so
+    busy workers get no heartbeat. The first heartbeat of a worker is
+    randomly delayed, so the heartbeats are spread over the interval.
+
+    **Federation**
+
+    A broker can be peered with the brokers of other hubs. It connects a
+    DEALER to each of them and asks for their directory (the services with
+    workers) every PEER_INTERVAL msecs with [mmi.directory][]. The directory
+    of a peer is dropped when it doesn't answer for HEARTBEAT_LIVENESS
+    intervals.
+
+    A request for a service without local workers but in the directory
+    of a peer is forwarded to the peer (round robin between the peers),
+    with a request id in the envelope. The reply is sent back to the client.
+    A forwarded request is never forwarded again. The requests to the
+    services with local workers keep the direct path.
+
+    mmi.discovery and mmi.service include the services of the peers.
+
+    **Statistics**
+
+    The broker counts the requests and the replies of each service and
+    keeps an histogram of the time from the client request to the worker
+    reply. [mmi.stats][service] returns the statistics of a service in json,
+    [mmi.stats][] the ones of all services. They are also published every
+    STATS_INTERVAL secs in the key/value proxy under /stats/broker/<service>.
+
+    **Deadlines and priorities**
+
+    A client can send its request with the C_CLIENT_QOS header, followed
+    by a timeout (msecs) and a priority frame :
+
+    [MDPC01Q][timeout][priority][service][body...]
+
+    Requests waiting for a worker are dispatched by priority (higher first),
+    then in the order they came in. The ones whose timeout is over are
+    dropped instead of being dispatched : the client doesn't wait for them
+    anymore. When MAX_QUEUE requests are waiting, the broker replies
+    [T_OVERLOAD] to the new ones instead of queuing them.
+
+    **Zero copy**
+
+    The messages are received as zmq.Frame (copy=False). Only the envelope,
+    header, command and service frames are copied to strings to be parsed.
+    The body frames (ie camera images or log chunks) are queued and sent
+    as received, so they go through the broker without being copied.
+
+    **Streams**
+
+    A worker can reply to a request with a stream of chunks (see
+    MajorDomoWorker.stream()) :
+
+    .. seqdiag::
+
+        seqdiag mdp_stream {
+          client;broker;worker;
+          client  -> broker [label = "[MDPC01][service][request]"];
+          broker  -> worker [label = "[REQUEST][client][][request]"];
+          broker  <-- worker [label = "[STREAM][client][][stream id][0][][data]"];
+          client  <-- broker [label = "[MDPC01S][service][stream id][0][][data]"];
+          client  -> broker [label = "[MDPC01S][service][stream id][1]"];
+          broker  -> worker [label = "[CREDIT][stream id][1]"];
+          broker  <-- worker [label = "[STREAM][client][][stream id][n][200]"];
+          client  <-- broker [label = "[MDPC01S][service][stream id][n][200]"];
+        }
+
+    The broker keeps the worker of each stream to send it the credits of
+    the client. The worker is waiting again after the final chunk. The
+    streams of the peers are forwarded the same way.
     """
 
     # We'd normally pull these from config data
@@ -191,74 +656,135 @@ class Broker(Executive):
     HEARTBEAT_LIVENESS = 5 # 3-5 is reasonable
     HEARTBEAT_INTERVAL = 3500 # msecs
     HEARTBEAT_EXPIRY = HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+    TIMER_TICK = 100 # msecs, resolution of the timers of the workers
+    PEER_INTERVAL = HEARTBEAT_INTERVAL # msecs between the directory requests to the peers
+    DISCOVERY_CACHE = 128 # Patterns and results of mmi.discovery kept in cache
+    MAX_QUEUE = 10000 # Requests queued by service before replying T_OVERLOAD
+    STATS_INTERVAL = 10 # Publish the statistics every secs
+    STATS_SUBTREE = "/stats/broker/"
 
     ctx = None # Our context
     socket = None # Socket for clients & workers
     poller = None # our Poller
 
-    heartbeat_at = None# When to send HEARTBEAT
+    heartbeat_at = None# When to refresh the tracers
     services = None # known services
     workers = None # known workers
-    waiting = None # idle workers
+    waiting = None # idle workers, by identity
 
-    def __init__(self, hostname='localhost', service="broker", broker_ip='127.0.0.1', broker_port=15514):
+    def __init__(self, hostname='localhost', service="broker", broker_ip='127.0.0.1', broker_port=15514, data_dir=None, \
+            bind=None, proxy=True, peers=None):
         """Initialize the Broker
+
+        :parameter data_dir: the directory where the proxy stores its state. None to keep it in memory only.
+        :parameter bind: the endpoint to bind to instead of tcp://broker_ip:broker_port (ie for a shard)
+        :parameter proxy: start the key/value proxy. The statistics are published to broker_port in all cases.
+        :parameter peers: the endpoints of the peer brokers (ie tcp://192.168.0.12:5514)
         """
         MDP.logger.debug("BROKER - Starting ...")
         Executive.__init__(self, hostname, service, broker_ip, broker_port)
         self.services = {}
         self.workers = {}
-        self.waiting = []
+        self.waiting = OrderedDict()
+        self.live_services = KeyIndex()
+        self.patterns = OrderedDict()
+        self.discoveries = OrderedDict()
         self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
+        self.timers = TimerWheel(tick=1e-3*self.TIMER_TICK)
         self.ctx = zmq.Context()
         self.socket = self.ctx.socket(zmq.ROUTER)
         self.socket.linger = 0
         self.poller = zmq.Poller()
         self.poller.register(self.socket, zmq.POLLIN)
-        self.socket.bind("tcp://%s:%s" % (self.broker_ip, self.broker_port))
-        self.proxy_thread = Proxy(hostname=hostname, service=service, broker_ip=broker_ip, broker_port=broker_port, speed=self.speed)
-        self.proxy_thread.daemon = True
+        self.socket.bind(bind or "tcp://%s:%s" % (self.broker_ip, self.broker_port))
+        self.peers = []
+        for endpoint in peers or []:
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.linger = 0
+            socket.connect(endpoint)
+            self.poller.register(socket, zmq.POLLIN)
+            self.peers.append(Peer(endpoint, socket))
+        self.remote_services = {}
+        self.remote_index = KeyIndex()
+        self.forwarded = OrderedDict()
+        self.forward_sequence = 0
+        self.streams = {}
+        """The workers sending a stream, by stream id"""
+        self.remote_streams = {}
+        """(peer, request id) of the streams forwarded from the peers, by stream id"""
+        self.peers_at = time.time()
+        self.proxy_thread = None
+        if proxy:
+            self.proxy_thread = Proxy(hostname=hostname, service=service, broker_ip=broker_ip, broker_port=broker_port, speed=self.speed, \
+                data_dir=data_dir)
+            self.proxy_thread.daemon = True
+        self.stats_at = time.time() + self.STATS_INTERVAL
+        self.stats_publisher = KvPublisherClient(hostname=hostname, broker_ip='127.0.0.1' if broker_ip == '*' else broker_ip, \
+            broker_port=broker_port)
         MDP.logger.info("BROKER - MDP broker is active at tcp://%s:%s", self.broker_ip, self.broker_port)
 
     def run(self):
         """Main broker work happens here"""
-        self.proxy_thread.start()
+        if self.proxy_thread is not None:
+            self.proxy_thread.start()
+        timeout = min(self.HEARTBEAT_INTERVAL, self.PEER_INTERVAL) if self.peers else self.HEARTBEAT_INTERVAL
         while not self._stopevent.isSet():
+            # Sleep until the next slot of the timers, at most timeout
+            due = self.timers.next_due()
+            if due is not None:
+                due = min(timeout, max(0, int(math.ceil(1e3*(due - time.time())))))
             try:
-                items = self.poller.poll(self.HEARTBEAT_INTERVAL)
+                items = dict(self.poller.poll(timeout if due is None else due))
             except KeyboardInterrupt: # pragma: no cover
                 break                 # pragma: no cover
             except zmq.ZMQError as exc:
                 if not self._stopevent.isSet():
                     raise exc
                 else:
-                    items = []
-            if items:
+                    items = {}
+            for peer in self.peers:
+                if peer.socket in items:
+                    try:
+                        self.process_peer(peer, peer.socket.recv_multipart(copy=False))
+                    except zmq.ZMQError as exc:
+                        if not self._stopevent.isSet():
+                            raise exc
+            if self.socket in items:
                 try:
-                    msg = self.socket.recv_multipart()
-                    MDP.logger.debug("BROKER - Received message: %s", msg)
-                    sender = msg.pop(0)
-                    empty = msg.pop(0)
-                    assert empty == ''
-                    header = msg.pop(0)
+                    msg = self.socket.recv_multipart(copy=False)
+                    if TRACER.enabled:
+                        TRACER.trace("recv", msg)
+                    # Return envelope : sender and any address frames
+                    # (ie a request id) up to the empty delimiter
+                    empty = delimiter(msg, 1)
+                    sender = [frame.bytes for frame in msg[:empty]]
+                    header = msg[empty+1].bytes
                     if MDP.C_CLIENT == header:
-                        self.process_client(sender, msg)
+                        self.process_client(sender, msg[empty+2:])
+                    elif MDP.C_CLIENT_QOS == header:
+                        self.process_client_qos(sender, msg[empty+2:])
                     elif MDP.W_WORKER == header:
-                        self.process_worker(sender, msg)
+                        self.process_worker(sender, msg[empty+2:])
+                    elif MDP.C_STREAM == header:
+                        self.process_credit(msg[empty+2:])
                     else:
                         MDP.logger.error("BROKER - Invalid message: %s", msg)
+                except (ValueError, IndexError):
+                    MDP.logger.error("BROKER - Invalid message: %s", msg)
                 except zmq.ZMQError as exc:
                     if not self._stopevent.isSet():
                         raise exc
-            self.purge_workers()
-            self.send_heartbeats()
+            self.process_timers()
+            self.publish_stats()
+            self.poll_peers()
 
     def shutdown(self):
         """Shutdown the broker.
         """
         self._stopevent.set()
-        self.proxy_thread.shutdown()
-        self.proxy_thread.join()
+        if self.proxy_thread is not None:
+            self.proxy_thread.shutdown()
+            self.proxy_thread.join()
 
     def destroy(self):
         """Disconnect all workers, destroy context."""
@@ -270,30 +796,66 @@ class Broker(Executive):
                 pass
             except RuntimeError:
                 pass
+        self.stats_publisher.destroy()
         self.ctx.destroy(0)
 
-    def process_client(self, sender, msg):
-        """Process a request coming from a client."""
+    def process_client_qos(self, sender, msg):
+        """Process a request coming from a client with the timeout and priority frames."""
+        assert len(msg) >= 4 # timeout + priority + service name + body
+        timeout = frame_bytes(msg[0])
+        priority = frame_bytes(msg[1])
+        try:
+            deadline = time.time() + 1e-3*int(timeout) if timeout else None
+            priority = int(priority) if priority else 0
+        except ValueError:
+            MDP.logger.error("BROKER - Invalid timeout or priority: %s, %s", timeout, priority)
+            return
+        self.process_client(sender, msg[2:], deadline, priority)
+
+    def process_client(self, sender, msg, deadline=None, priority=0):
+        """Process a request coming from a client.
+
+        sender is the client address or its return envelope : a list of
+        address frames starting with the client address.
+        msg is the service name and the body frames (strings or zmq.Frame).
+
+        :parameter deadline: drop the request if it's not dispatched before this time
+        :parameter priority: requests with higher priority are dispatched first
+        """
         #Removed because of mmi.discovery message, ...
         assert len(msg) >= 2 # Service name + body
         #assert len(msg) >= 1 # Service name. Body can be null. But it fails ...
-        service = msg.pop(0)
-        # Set reply return address to client sender
-        msg = [sender, ''] + msg
+        service = frame_bytes(msg[0])
+        body = msg[1:]
+        if not isinstance(sender, list):
+            sender = [sender]
+        if self.peers and service in self.remote_services and not sender[-1].startswith(FORWARDED):
+            local = self.services.get(service)
+            if (local is None or local.workers == 0) and self.forward(service, sender, body, deadline, priority):
+                return
+        # Set reply return envelope to client sender
+        msg = sender + [''] + body
         if service.startswith(self.INTERNAL_SERVICE_PREFIX):
             self.service_internal(service, msg)
         else:
-            self.dispatch(self.require_service(service), msg)
+            self.dispatch(self.require_service(service), msg, deadline, priority)
 
     def process_worker(self, sender, msg):
-        """Process message sent to us by a worker."""
+        """Process message sent to us by a worker.
+
+        sender is the worker address or its address frames when it's
+        connected through a front (see raspy.servers.shards).
+        msg is the command and the following frames (strings or zmq.Frame).
+        """
         assert len(msg) >= 1 # At least, command
-        command = msg.pop(0)
-        worker_ready = hexlify(sender) in self.workers
+        command = frame_bytes(msg[0])
+        worker_ready = self.worker_identity(sender) in self.workers
         worker = self.require_worker(sender)
+        # Any message counts as a heartbeat
+        worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
         if MDP.W_READY == command:
-            assert len(msg) >= 1 # At least, a service name
-            service = msg.pop(0)
+            assert len(msg) >= 2 # At least, a service name
+            service = frame_bytes(msg[1])
             # Not first command in session or Reserved service name
             if worker_ready or service.startswith(self.INTERNAL_SERVICE_PREFIX):
                 self.delete_worker(worker, True)
@@ -301,23 +863,42 @@ class Broker(Executive):
                 MDP.logger.debug("BROKER - Attach worker for service : %s", service)
                 # Attach worker to service and mark as idle
                 worker.service = self.require_service(service)
+                worker.service.workers += 1
+                if worker.service.workers == 1:
+                    self.live_services.add(service)
+                    self.discoveries.clear()
+                # Spread the heartbeats over the interval
+                worker.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL*random.uniform(0.5, 1.0)
                 self.worker_waiting(worker)
         elif MDP.W_REPLY == command:
             if worker_ready == True:
-                # Remove & save client return envelope and insert the
-                # protocol header and service name, then rewrap envelope.
-                client = msg.pop(0)
-                empty = msg.pop(0) # ?
-                msg = [client, '', MDP.C_CLIENT, worker.service.name] + msg
-                self.socket.send_multipart(msg)
-                self.worker_waiting(worker)
+                # Keep the client return envelope and insert the
+                # protocol header and service name after it.
+                head = delimiter(msg, 1) + 1
+                msg = msg[1:head] + [MDP.C_CLIENT, worker.service.name] + msg[head:]
+                self.socket.send_multipart(msg, copy=False)
+                self.worker_replied(worker)
             else:
                 self.delete_worker(worker, True)
-        elif MDP.W_HEARTBEAT == command:
+        elif MDP.W_STREAM == command:
             if worker_ready == True:
-                worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+                # [client envelope][''][stream id][sequence][final][data]
+                head = delimiter(msg, 1) + 1
+                stream_id = frame_bytes(msg[head])
+                final = frame_bytes(msg[head+2])
+                self.socket.send_multipart(msg[1:head] + [MDP.C_STREAM, worker.service.name] + msg[head:], copy=False)
+                if final:
+                    self.streams.pop(stream_id, None)
+                    worker.stream = None
+                    self.worker_replied(worker)
+                elif worker.stream is None:
+                    worker.stream = stream_id
+                    self.streams[stream_id] = worker
             else:
                 self.delete_worker(worker, True)
+        elif MDP.W_HEARTBEAT == command:
+            if worker_ready != True:
+                self.delete_worker(worker, True)
         elif MDP.W_DISCONNECT == command:
             self.delete_worker(worker, False)
         else:
@@ -328,14 +909,60 @@ class Broker(Executive):
         assert worker is not None
         if disconnect == True:
             self.send_to_worker(worker, MDP.W_DISCONNECT, None, None)
+        if worker.stream is not None:
+            self.streams.pop(worker.stream, None)
         if worker.service is not None:
-            worker.service.waiting.remove(worker)
+            worker.service.waiting.pop(worker.identity, None)
+            worker.service.workers -= 1
+            if worker.service.workers == 0:
+                self.live_services.remove(worker.service.name)
+                self.discoveries.clear()
+        self.waiting.pop(worker.identity, None)
         self.workers.pop(worker.identity)
 
+    def worker_replied(self, worker):
+        """The worker has sent its reply or the final chunk of its stream"""
+        worker.service.replies_count.set()
+        if worker.request_at is not None:
+            worker.service.latency.set(time.time() - worker.request_at)
+            worker.request_at = None
+        self.worker_waiting(worker)
+
+    def process_credit(self, msg):
+        """Process a credit from a client : [service][stream id][credit].
+
+        It's sent to the worker of the stream, or to the peer it comes from.
+        """
+        assert len(msg) >= 3
+        stream_id = frame_bytes(msg[1])
+        credit = frame_bytes(msg[2])
+        worker = self.streams.get(stream_id)
+        if worker is not None:
+            self.send_to_worker(worker, MDP.W_CREDIT, None, [stream_id, credit])
+            return
+        remote = self.remote_streams.get(stream_id)
+        if remote is not None:
+            peer, request_id = remote
+            try:
+                peer.socket.send_multipart([request_id, '', MDP.C_STREAM, frame_bytes(msg[0]), stream_id, credit], \
+                    zmq.NOBLOCK)
+            except zmq.Again:
+                MDP.logger.warning("BROKER - Can't forward credit to peer %s", peer.endpoint)
+            return
+        MDP.logger.debug("BROKER - Drop credit for unknown stream %s", stream_id)
+
+    def worker_identity(self, address):
+        """Return the hex identity of a worker address (a frame or a list of frames)"""
+        if isinstance(address, list):
+            return '.'.join([hexlify(frame) for frame in address])
+        return hexlify(address)
+
     def require_worker(self, address):
         """Finds the worker (creates if necessary)."""
         assert address is not None
-        identity = hexlify(address)
+        if not isinstance(address, list):
+            address = [address]
+        identity = self.worker_identity(address)
         worker = self.workers.get(identity)
         if worker is None:
             worker = Worker(identity, address, self.HEARTBEAT_EXPIRY)
@@ -355,64 +982,232 @@ class Broker(Executive):
     def service_internal(self, service, msg):
         """Handle internal service according to 8/MMI specification"""
         returncode = "501"
+        msg = [frame_bytes(frame) for frame in msg]
         if "mmi.service" == service:
             name = msg[-1]
-            returncode = "200" if name in self.services else "404"
+            returncode = "200" if name in self.services or name in self.remote_services else "404"
         elif "mmi.discovery" == service:
             name = msg[-1]
             try:
-                srvs = [k for k in self.services.keys() if len(k) > 0 and re.search(name, k)] + msg[-1:]
+                srvs = self.discover(name) + msg[-1:]
                 msg = msg[:-1] + srvs
                 MDP.logger.debug("BROKER - Discovery send : %s", srvs)
                 returncode = "200"
             except re.error:
                 pass
+        elif "mmi.directory" == service:
+            msg = msg[:-1] + list(self.live_services) + msg[-1:]
+            returncode = "200"
+        elif "mmi.stats" == service:
+            name = msg[-1]
+            if not name:
+                stats = dict((srv.name, srv.stats()) for srv in self.services.values())
+                msg = msg[:-1] + [json.dumps(stats), ""]
+                returncode = "200"
+            elif name in self.services:
+                msg = msg[:-1] + [json.dumps(self.services[name].stats()), ""]
+                returncode = "200"
+            else:
+                returncode = "404"
         msg[-1] = returncode
-        # insert the protocol header and service name after the routing envelope ([client, ''])
-        msg = msg[:2] + [MDP.C_CLIENT, service] + msg[2:]
+        # insert the protocol header and service name after the routing envelope ([client, ...,  ''])
+        head = msg.index('') + 1
+        msg = msg[:head] + [MDP.C_CLIENT, service] + msg[head:]
         self.socket.send_multipart(msg)
 
-    def send_heartbeats(self):
-        """Send heartbeats to idle workers if it's time"""
-        if time.time() > self.heartbeat_at:
-            for worker in self.waiting:
-                self.send_to_worker(worker, MDP.W_HEARTBEAT, None, None)
-            self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
+    def discover(self, pattern):
+        """Return the sorted names of the services with workers matching pattern (re.search).
+
+        Raise re.error if the pattern is not valid.
+        """
+        srvs = self.discoveries.pop(pattern, None)
+        if srvs is None:
+            regex = self.patterns.pop(pattern, None)
+            if regex is None:
+                regex = re.compile(pattern)
+            self.patterns[pattern] = regex
+            if len(self.patterns) > self.DISCOVERY_CACHE:
+                self.patterns.popitem(last=False)
+            prefix = regex_prefix(pattern)
+            names = self.live_services.prefix(prefix)
+            if self.remote_index:
+                names = sorted(set(names + self.remote_index.prefix(prefix)))
+            srvs = [k for k in names if len(k) > 0 and regex.search(k)]
+            if len(self.discoveries) >= self.DISCOVERY_CACHE:
+                self.discoveries.popitem(last=False)
+        self.discoveries[pattern] = srvs
+        return list(srvs)
 
-    def purge_workers(self):
-        """Look for & kill expired workers.
+    def forward(self, service, sender, msg, deadline=None, priority=0):
+        """Forward a request to a peer having workers for the service.
 
-        Workers are oldest to most recent, so we stop at the first alive worker.
+        :returns: False if the request could not be sent
         """
-        while self.waiting:
-            w = self.waiting[0]
-            if w.expiry < time.time():
-                MDP.logger.info("BROKER - Deleting expired worker: %s", w.identity)
-                self.delete_worker(w, False)
-                self.waiting.pop(0)
+        peers = self.remote_services[service]
+        peer = peers[self.forward_sequence % len(peers)]
+        self.forward_sequence += 1
+        request_id = FORWARDED + "%x" % self.forward_sequence
+        now = time.time()
+        timeout = None if deadline is None else max(0, int(1e3*(deadline - now)))
+        try:
+            peer.socket.send_multipart([request_id, ''] + MDP.client_header(service, timeout, priority or None) + msg, \
+                zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            MDP.logger.warning("BROKER - Can't forward request to peer %s", peer.endpoint)
+            return False
+        self.forwarded[request_id] = (sender, now + 1e-3*self.HEARTBEAT_EXPIRY)
+        return True
+
+    def process_peer(self, peer, msg):
+        """Process a reply from a peer : a directory or the reply of a forwarded request"""
+        peer.expiry = time.time() + 1e-3*self.PEER_INTERVAL*self.HEARTBEAT_LIVENESS
+        assert len(msg) >= 4 # request id + empty + header + service
+        request_id = frame_bytes(msg[0])
+        header = frame_bytes(msg[2])
+        service = frame_bytes(msg[3])
+        if request_id == DIRECTORY:
+            if frame_bytes(msg[-1]) == MDP.T_OK:
+                services = set([frame_bytes(frame) for frame in msg[4:-1]])
+                if services != peer.services:
+                    MDP.logger.info("BROKER - Directory of peer %s : %s", peer.endpoint, sorted(services))
+                    peer.services = services
+                    self.update_remote_services()
+            return
+        forwarded = self.forwarded.pop(request_id, None)
+        if forwarded is None:
+            MDP.logger.debug("BROKER - Drop late reply from peer %s", peer.endpoint)
+            return
+        if header == MDP.C_STREAM:
+            # [stream id][sequence][final][data]
+            stream_id = frame_bytes(msg[4])
+            if frame_bytes(msg[6]):
+                self.remote_streams.pop(stream_id, None)
             else:
+                # Wait for the next chunk
+                self.forwarded[request_id] = (forwarded[0], time.time() + 1e-3*self.HEARTBEAT_EXPIRY)
+                self.remote_streams[stream_id] = (peer, request_id)
+        else:
+            header = MDP.C_CLIENT
+        self.socket.send_multipart(forwarded[0] + ['', header, service] + msg[4:], copy=False)
+
+    def update_remote_services(self):
+        """Rebuild the services of the peers"""
+        remote_services = {}
+        for peer in self.peers:
+            for service in peer.services:
+                remote_services.setdefault(service, []).append(peer)
+        self.remote_services = remote_services
+        self.remote_index = KeyIndex(remote_services.keys())
+        self.discoveries.clear()
+
+    def poll_peers(self):
+        """Ask the peers for their directory and drop the expired ones if it's time"""
+        now = time.time()
+        if not self.peers or now < self.peers_at:
+            return
+        self.peers_at = now + 1e-3*self.PEER_INTERVAL
+        expired = False
+        for peer in self.peers:
+            if peer.services and now > peer.expiry:
+                MDP.logger.warning("BROKER - Peer %s is not responding, drop its directory", peer.endpoint)
+                peer.services = set()
+                expired = True
+            try:
+                peer.socket.send_multipart([DIRECTORY, '', MDP.C_CLIENT, "mmi.directory", ""], zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+        if expired:
+            self.update_remote_services()
+        # Forget the forwarded requests without reply
+        while self.forwarded:
+            request_id = next(iter(self.forwarded))
+            if self.forwarded[request_id][1] >= now:
                 break
+            del self.forwarded[request_id]
+        for stream_id in [stream_id for stream_id, remote in self.remote_streams.items() if remote[1] not in self.forwarded]:
+            del self.remote_streams[stream_id]
+
+    def process_timers(self):
+        """Send the heartbeats and delete the expired workers whose timers are due"""
+        now = time.time()
+        for worker in self.timers.expire(now):
+            if worker.timer_at is None or worker.timer_at > now:
+                # Replaced by an earlier timer
+                continue
+            worker.timer_at = None
+            if self.workers.get(worker.identity) is not worker or worker.identity not in self.waiting:
+                # Deleted, or busy : the timer is armed again when it's waiting
+                continue
+            if worker.expiry <= now:
+                MDP.logger.info("BROKER - Deleting expired worker: %s", worker.identity)
+                self.delete_worker(worker, False)
+                continue
+            if worker.heartbeat_at <= now:
+                self.send_to_worker(worker, MDP.W_HEARTBEAT, None, None)
+            self.arm_timer(worker)
+        if now > self.heartbeat_at:
+            self.heartbeat_at = now + 1e-3*self.HEARTBEAT_INTERVAL
+            # Follow the changes of the log level
+            tracing.refresh()
+
+    def arm_timer(self, worker):
+        """Schedule the timer of the worker at its next heartbeat or expiry"""
+        at = min(worker.heartbeat_at, worker.expiry)
+        if worker.timer_at is None or at < worker.timer_at:
+            worker.timer_at = at
+            self.timers.schedule(at, worker)
+
+    def publish_stats(self):
+        """Update the rates and publish the statistics of the services in the proxy if it's time"""
+        now = time.time()
+        if now > self.stats_at:
+            elapsed = now - self.stats_at + self.STATS_INTERVAL
+            self.stats_at = now + self.STATS_INTERVAL
+            for service in list(self.services.values()):
+                requests = service.requests_count.get()
+                service.rate = (requests - service.last_requests) / elapsed
+                service.last_requests = requests
+                self.stats_publisher.send(self.STATS_SUBTREE, service.name, json.dumps(service.stats()), \
+                    ttl=3*self.STATS_INTERVAL)
 
     def worker_waiting(self, worker):
         """This worker is now waiting for work."""
         # Queue to broker and service waiting lists
-        self.waiting.append(worker)
-        worker.service.waiting.append(worker)
-        worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+        self.waiting[worker.identity] = worker
+        worker.service.waiting[worker.identity] = worker
+        self.arm_timer(worker)
         self.dispatch(worker.service, None)
 
-    def dispatch(self, service, msg):
+    def dispatch(self, service, msg, deadline=None, priority=0):
         """Dispatch requests to waiting workers as possible"""
         assert service is not None
+        now = time.time()
         if msg is not None:# Queue message if any
-            service.requests.append(msg)
-        self.purge_workers()
+            service.requests_count.set()
+            if len(service.requests) >= self.MAX_QUEUE:
+                service.drop_expired(now)
+            if len(service.requests) >= self.MAX_QUEUE:
+                service.overload_count.set()
+                self.send_overload(service, msg)
+            else:
+                service.queue(msg, now, deadline, priority)
         while service.waiting and service.requests:
-            msg = service.requests.pop(0)
-            worker = service.waiting.pop(0)
-            self.waiting.remove(worker)
+            request = service.next_request(now)
+            if request is None:
+                break
+            arrived, msg = request
+            identity, worker = service.waiting.popitem(last=False)
+            del self.waiting[identity]
+            worker.request_at = arrived
             self.send_to_worker(worker, MDP.W_REQUEST, None, msg)
 
+    def send_overload(self, service, msg):
+        """Reply T_OVERLOAD to the client of a request"""
+        if TRACER.enabled:
+            TRACER.trace("overload", msg)
+        head = delimiter(msg) + 1
+        self.socket.send_multipart(msg[:head] + [MDP.C_CLIENT, service.name, MDP.T_OVERLOAD])
+
     def send_to_worker(self, worker, command, option, msg=None):
         """Send message to worker.
 
@@ -428,9 +1223,12 @@ class Broker(Executive):
         # and routing envelope
         if option is not None:
             msg = [option] + msg
-        msg = [worker.address, '', MDP.W_WORKER, command] + msg
-        MDP.logger.debug("BROKER - Sending %r to worker : %s", command, msg)
-        self.socket.send_multipart(msg)
+        msg = worker.address + ['', MDP.W_WORKER, command] + msg
+        # Any message counts as a heartbeat
+        worker.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
+        if TRACER.enabled:
+            TRACER.trace("send", msg)
+        self.socket.send_multipart(msg, copy=False)
 
 if __name__ == '__main__': # pragma: no cover
     mybroker = Broker()    # pragma: no cover
@@ -193,19 +193,13 @@ class Core(Server):
         - sync from trc to system : using sudo with no password
     """
 
-    def __init__(self, hostname='localhost', service="core", broker_ip='127.0.0.1', broker_port=5514):
+    def __init__(self, hostname='localhost', service="core", broker_ip='127.0.0.1', broker_port=5514, conffile=None):
         """Initialize the server
         """
-        Server.__init__(self, hostname, service, broker_ip, broker_port)
-        self.worker_cron_thread = threading.Thread(target=self.worker_cron)
-        self.worker_cron_thread.daemon = True
-        self._active_threads.append(self.worker_cron_thread)
-        self.worker_scenario_thread = threading.Thread(target=self.worker_scenario)
-        self.worker_scenario_thread.daemon = True
-        self._active_threads.append(self.worker_scenario_thread)
-        self.worker_scenarios_thread = threading.Thread(target=self.worker_scenarios)
-        self.worker_scenarios_thread.daemon = True
-        self._active_threads.append(self.worker_scenarios_thread)
+        Server.__init__(self, hostname, service, broker_ip, broker_port, conffile=conffile)
+        self.worker_cron_pool = self.add_worker_pool(self.worker_cron, "cron")
+        self.worker_scenario_pool = self.add_worker_pool(self.worker_scenario, "scenario")
+        self.worker_scenarios_pool = self.add_worker_pool(self.worker_scenarios, "scenarios")
         self.publisher = None
         self.manager_scenario = ScenarioManager(publisher=self.publisher)
 
@@ -214,7 +208,7 @@ class Core(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s.cron" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s.cron" % MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -235,7 +229,7 @@ class Core(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s.scenario" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s.scenario" % MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -261,7 +255,7 @@ class Core(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s.scenarios" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s.scenarios" % MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -24,6 +24,8 @@ __email__ = 'bibi21000@gmail.com'
 import threading
 import traceback
 import os
+import json
+import types
 import raspy.common.MDP as MDP
 from raspy.common.server import Server
 from raspy.common.mdwrkapi import MajorDomoWorker
@@ -40,13 +42,35 @@ class Fake(Server):
         -
     """
 
-    def __init__(self, hostname='localhost', service="fake", broker_ip='127.0.0.1', broker_port=5514):
+    def __init__(self, hostname='localhost', service="fake", broker_ip='127.0.0.1', broker_port=5514, conffile=None):
         """Initialize the server
         """
-        Server.__init__(self, hostname, service, broker_ip, broker_port)
-        self.worker_devices_thread = threading.Thread(target=self.worker_devices)
-        self.worker_devices_thread.daemon = True
-        self._active_threads.append(self.worker_devices_thread)
+        Server.__init__(self, hostname, service, broker_ip, broker_port, conffile=conffile)
+        self.worker_devices_pool = self.add_worker_pool(self.worker_devices, "devices")
+        self.devices = {}
+        """The devices of the server, by name"""
+
+    def add_device(self, device):
+        """Add a device : its commands are executed with [exec][oid][command][value]
+        """
+        self.devices[device.name] = device
+
+    def exec_device(self, worker, oid, command, value=None):
+        """Execute the command of a device and return the reply.
+
+        A command which returns a generator of chunks (ie the image of a camera)
+        is streamed with worker.stream() and the reply is None.
+        """
+        device = self.devices.get(oid.partition('-')[0])
+        if device is None:
+            return [MDP.T_NOTFOUND]
+        res = device.exec_cmd(oid, command, value)
+        if res is None:
+            return [MDP.T_ERROR]
+        if isinstance(res, types.GeneratorType):
+            worker.stream(res)
+            return None
+        return [json.dumps(res), MDP.T_OK]
 
     def worker_devices(self):
         """Create a worker to handle devices requests
@@ -54,7 +78,7 @@ class Fake(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s.devices" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s.devices"%MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -73,10 +97,14 @@ class Fake(Server):
                     except OSError as exc:
                         logging.exception("OSError Exception in worker_devices for action %s", action)
                         reply = [MDP.T_ERROR]
+                elif action == "exec":
+                    # [exec][oid][command][value in json]
+                    value = json.loads(request[2]) if len(request) > 2 else None
+                    reply = self.exec_device(worker, request[0], request[1], value)
                 else:
                     reply = [action] + [MDP.T_NOTIMPLEMENTED]
                     logging.debug("worker_devices send [%s][%s]", action, MDP.T_NOTIMPLEMENTED)
-            except IndexError:
+            except (IndexError, ValueError):
                 logging.exception("Exception in worker_devices")
                 reply = [MDP.T_ERROR]
 
@@ -21,6 +21,7 @@ __copyright__ = "Copyright © 2013-2014 Sébastien GALLET aka bibi21000"
 __author__ = 'Sébastien GALLET aka bibi21000'
 __email__ = 'bibi21000@gmail.com'
 
+import os
 import threading
 import traceback
 import SocketServer
@@ -28,7 +29,7 @@ import socket
 import gzip
 import raspy.common.MDP as MDP
 from raspy.common.server import Server
-from raspy.common.mdwrkapi import MajorDomoWorker
+from raspy.common.mdwrkapi import MajorDomoWorker, file_chunks
 
 import logging
 
@@ -127,7 +128,7 @@ class Logger(Server):
 
      - numeric : data for a device. We must be abble to aggregate data from multiple devices ( ie a graph for inside/outqide temperature)
      - text events : door open, notification, server log, ...
-     - images for webcam ??? large amount of data, not a good idea to tranport it using zmq. A ftp client which sync to a server.
+     - images for webcam : large amount of data. They are streamed by chunks with a credit window (see MajorDomoWorker.stream()), so the memory stays bounded.
 
     How to log :
 
@@ -154,16 +155,12 @@ class Logger(Server):
     graphes = {}
 
     def __init__(self, hostname='localhost', service="logger", broker_ip='127.0.0.1', broker_port=5514, \
-            data_dir='.rapsy'):
+            data_dir='.rapsy', conffile=None):
         """Initialize the server
         """
-        Server.__init__(self, hostname, service, broker_ip, broker_port)
-        self.worker_log_thread = threading.Thread(target=self.worker_log)
-        self.worker_log_thread.daemon = True
-        self._active_threads.append(self.worker_log_thread)
-        self.worker_graph_thread = threading.Thread(target=self.worker_graph)
-        self.worker_graph_thread.daemon = True
-        self._active_threads.append(self.worker_graph_thread)
+        Server.__init__(self, hostname, service, broker_ip, broker_port, conffile=conffile)
+        self.worker_log_pool = self.add_worker_pool(self.worker_log, "log")
+        self.worker_graph_pool = self.add_worker_pool(self.worker_graph, "graph")
         self.http_server = ThreadedTCPServer(('', broker_port+4), ThreadedTCPRequestHandler)
         self.http_server.logger = self
         self.http_thread = threading.Thread(target=self.http_server.serve_forever)
@@ -176,7 +173,7 @@ class Logger(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s.log" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s" % MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -188,8 +185,17 @@ class Logger(Server):
             logging.debug("Receive job for service %s : %s", "%s" % MDP.routing_key(self.hostname, self.service), \
                             request)
             try:
-                reply = [MDP.T_OK]
-            except OSError:
+                if request[0] == "stream" and len(request) > 1:
+                    # Stream a log file of data_dir : [stream][filename]
+                    filename = os.path.join(self.data_dir, os.path.basename(request[1]))
+                    if os.path.isfile(filename):
+                        worker.stream(file_chunks(filename))
+                        reply = None
+                    else:
+                        reply = [MDP.T_NOTFOUND]
+                else:
+                    reply = [MDP.T_OK]
+            except (OSError, IOError):
                 reply = [MDP.T_ERROR]
 
     def worker_graph(self):
@@ -197,7 +203,7 @@ class Logger(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s.graph" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s" % MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -78,14 +78,12 @@ class OneWire(Server):
     """
 
     def __init__(self, hostname='localhost', service="onewire", broker_ip='127.0.0.1', broker_port=5514, \
-            devices_dir='/sys/bus/w1/devices'):
+            devices_dir='/sys/bus/w1/devices', conffile=None):
         """Initialize the server
         """
-        Server.__init__(self, hostname, service, broker_ip, broker_port)
+        Server.__init__(self, hostname, service, broker_ip, broker_port, conffile=conffile)
         self.devices_dir = devices_dir
-        self.worker_devices_thread = threading.Thread(target=self.worker_devices)
-        self.worker_devices_thread.daemon = True
-        self._active_threads.append(self.worker_devices_thread)
+        self.worker_devices_pool = self.add_worker_pool(self.worker_devices, "devices")
 
     def worker_devices(self):
         """Create a worker to handle devices requests
@@ -93,7 +91,7 @@ class OneWire(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s.devices" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s.devices"%MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Sharded broker.
+
+The Broker runs in one thread of one process, so it's limited by the GIL.
+The ShardedBroker starts shards Broker processes. Each one owns a range of
+the hash of the service names and binds to broker_ip:broker_port+SHARD_PORT+i.
+
+The clients and the workers exchange their messages directly with the
+shard of their service, so the throughput grows with the number of shards :
+
+    - the ShardedMajorDomoClient asks the ports of the shards to the front
+      with [mmi.shards][] and sends each request to the shard of its service,
+    - a worker connects to shard_endpoint(front, service).
+
+The front, bound to broker_port, still accepts the clients and workers of
+a single Broker. It forwards :
+
+    - the requests and the stream credits of the clients to the shard
+      of their service,
+    - the messages of the workers to the shard of the service they are
+      ready for,
+    - the replies from the shards back to the clients and workers.
+
+The mmi services work across the shards : the front sends them to all
+the shards and merges their replies. mmi.discovery and mmi.directory return
+the union of the services, mmi.stats without name the statistics of all
+the services and the other ones the first successful reply.
+
+The front also runs the key/value proxy. The shards publish their
+statistics to it.
+
+As the broker, the front forwards the body frames without copying them.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__copyright__ = "Copyright © 2013-2014 Sébastien GALLET aka bibi21000"
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import json
+import multiprocessing
+import threading
+import time
+import zmq
+import raspy.common.MDP as MDP
+from raspy.common.MDP import service_shard
+from raspy.common.executive import Executive
+from raspy.servers.broker import Broker, Proxy, frame_bytes, delimiter
+
+FANOUT = "\0fanout" # First envelope frame of the requests sent to all shards. Not a zmq identity (5 bytes).
+
+class BrokerShard(multiprocessing.Process):
+    """A Broker process owning a shard of the services
+    """
+
+    def __init__(self, number, endpoint, hostname='localhost', service="broker", broker_ip='127.0.0.1', broker_port=15514):
+        """Initialize the shard
+
+        :parameter endpoint: the endpoint the broker binds to
+        :parameter broker_port: the port of the front, where the statistics are published
+        """
+        multiprocessing.Process.__init__(self, name="%s-shard-%s" % (service, number))
+        self.daemon = True
+        self.number = number
+        self.endpoint = endpoint
+        self.hostname = hostname
+        self.service = service
+        self.broker_ip = broker_ip
+        self.broker_port = broker_port
+        self.stop_event = multiprocessing.Event()
+
+    def run(self):
+        """Run the broker until shutdown"""
+        broker = Broker(hostname=self.hostname, service="%s%s" % (self.service, self.number), broker_ip=self.broker_ip, \
+            broker_port=self.broker_port, bind=self.endpoint, proxy=False)
+        def wait_stop():
+            self.stop_event.wait()
+            broker.shutdown()
+        watcher = threading.Thread(target=wait_stop)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            broker.run()
+        finally:
+            broker.destroy()
+
+    def shutdown(self):
+        """Stop the broker"""
+        self.stop_event.set()
+
+class ShardedBroker(Executive):
+    """The front of the sharded brokers
+    """
+
+    SHARD_PORT = 10 # The shard i binds to broker_ip:broker_port+SHARD_PORT+i
+    HEARTBEAT_INTERVAL = Broker.HEARTBEAT_INTERVAL
+    HEARTBEAT_EXPIRY = Broker.HEARTBEAT_EXPIRY
+
+    def __init__(self, hostname='localhost', service="broker", broker_ip='127.0.0.1', broker_port=15514, data_dir=None, shards=None):
+        """Initialize the front
+
+        :parameter data_dir: the directory where the proxy stores its state. None to keep it in memory only.
+        :parameter shards: the number of broker processes. None for the number of cpus.
+        """
+        Executive.__init__(self, hostname, service, broker_ip, broker_port)
+        self.shards = shards or multiprocessing.cpu_count()
+        self.ctx = zmq.Context()
+        self.frontend = self.ctx.socket(zmq.ROUTER)
+        self.frontend.linger = 0
+        self.frontend.bind("tcp://%s:%s" % (self.broker_ip, self.broker_port))
+        self.poller = zmq.Poller()
+        self.poller.register(self.frontend, zmq.POLLIN)
+        self.processes = []
+        self.backends = []
+        local_ip = "127.0.0.1" if broker_ip in ("*", "0.0.0.0") else broker_ip
+        for i in range(self.shards):
+            port = broker_port + self.SHARD_PORT + i
+            self.processes.append(BrokerShard(i, "tcp://%s:%s" % (broker_ip, port), hostname=hostname, service=service, \
+                broker_ip=broker_ip, broker_port=broker_port))
+            backend = self.ctx.socket(zmq.DEALER)
+            backend.linger = 0
+            backend.connect("tcp://%s:%s" % (local_ip, port))
+            self.poller.register(backend, zmq.POLLIN)
+            self.backends.append(backend)
+        self.workers = {}
+        """[shard, last seen, busy] of the workers, by address"""
+        self.fanouts = {}
+        """[request, replies, sent at] of the requests sent to all shards, by id"""
+        self.fanout_sequence = 0
+        self.now = time.time()
+        self.purge_at = self.now + 1e-3*self.HEARTBEAT_INTERVAL
+        self.proxy_thread = Proxy(hostname=hostname, service=service, broker_ip=broker_ip, broker_port=broker_port, \
+            speed=self.speed, data_dir=data_dir)
+        self.proxy_thread.daemon = True
+        MDP.logger.info("BROKER - Sharded broker with %s shards is active at tcp://%s:%s", self.shards, self.broker_ip, self.broker_port)
+
+    def run(self):
+        """Forward the messages between the clients, the workers and the shards"""
+        for process in self.processes:
+            process.start()
+        self.proxy_thread.start()
+        while not self._stopevent.isSet():
+            try:
+                items = dict(self.poller.poll(self.HEARTBEAT_INTERVAL))
+            except KeyboardInterrupt: # pragma: no cover
+                break                 # pragma: no cover
+            except zmq.ZMQError as exc:
+                if not self._stopevent.isSet():
+                    raise exc
+                else:
+                    items = {}
+            self.now = time.time()
+            try:
+                if self.frontend in items:
+                    self.drain(self.frontend, self.process_front)
+                for backend in self.backends:
+                    if backend in items:
+                        self.drain(backend, self.process_shard)
+            except zmq.ZMQError as exc:
+                if not self._stopevent.isSet():
+                    raise exc
+            self.purge()
+
+    def drain(self, socket, process):
+        """Process all the messages waiting on socket"""
+        while True:
+            try:
+                msg = socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            process(msg)
+
+    def shutdown(self):
+        """Shutdown the front and the shards.
+        """
+        self._stopevent.set()
+        for process in self.processes:
+            process.shutdown()
+        self.proxy_thread.shutdown()
+        self.proxy_thread.join()
+        for process in self.processes:
+            process.join()
+
+    def destroy(self):
+        """Destroy context."""
+        self.proxy_thread = None
+        self.ctx.destroy(0)
+
+    def process_front(self, msg):
+        """Forward a message from a client or a worker to its shard"""
+        try:
+            empty = delimiter(msg)
+            header = frame_bytes(msg[empty+1])
+            if header == MDP.C_CLIENT or header == MDP.C_CLIENT_QOS or header == MDP.C_STREAM:
+                # The credits of the streams go to the shard of their service too
+                service = frame_bytes(msg[empty+4] if header == MDP.C_CLIENT_QOS else msg[empty+2])
+                if service.startswith(Broker.INTERNAL_SERVICE_PREFIX):
+                    self.process_internal(service, [frame_bytes(frame) for frame in msg])
+                else:
+                    self.backends[service_shard(service, self.shards)].send_multipart(msg, copy=False)
+            elif header == MDP.W_WORKER:
+                self.process_worker(frame_bytes(msg[0]), [frame_bytes(frame) for frame in msg[empty+2:empty+4]], msg)
+            else:
+                MDP.logger.error("BROKER - Invalid message: %s", msg)
+        except (ValueError, IndexError):
+            MDP.logger.error("BROKER - Invalid message: %s", msg)
+
+    def process_worker(self, address, command, msg):
+        """Forward a message from a worker to the shard of its service
+
+        :parameter command: the command frame and the service one, if any
+        """
+        if command[0] == MDP.W_READY:
+            shard = service_shard(command[1], self.shards)
+            self.workers[address] = [shard, self.now, False]
+        else:
+            worker = self.workers.get(address)
+            if worker is None:
+                # Unknown worker : ask it to reconnect, as the broker does
+                self.frontend.send_multipart([address, '', MDP.W_WORKER, MDP.W_DISCONNECT])
+                return
+            shard = worker[0]
+            worker[1] = self.now
+            if command[0] == MDP.W_REPLY or command[0] == MDP.W_STREAM:
+                # A streaming worker sends chunks or heartbeats until its final chunk
+                worker[2] = False
+            elif command[0] == MDP.W_DISCONNECT:
+                del self.workers[address]
+        self.backends[shard].send_multipart(msg, copy=False)
+
+    def process_internal(self, service, msg):
+        """Reply to mmi.shards or forward a mmi request to all the shards"""
+        if service == "mmi.shards":
+            head = msg.index('') + 1
+            ports = ["%s" % (self.broker_port + self.SHARD_PORT + i) for i in range(self.shards)]
+            self.frontend.send_multipart(msg[:head] + [MDP.C_CLIENT, service] + ports + [MDP.T_OK])
+            return
+        self.fanout_sequence += 1
+        fanout = "%x" % self.fanout_sequence
+        self.fanouts[fanout] = [msg, [], self.now]
+        for backend in self.backends:
+            backend.send_multipart([FANOUT, fanout] + msg)
+
+    def process_shard(self, msg):
+        """Forward a message from a shard to a client or a worker"""
+        head = [frame_bytes(frame) for frame in msg[:4]]
+        if head[0] == FANOUT:
+            fanout = self.fanouts.get(head[1])
+            if fanout is None:
+                return
+            fanout[1].append([frame_bytes(frame) for frame in msg[2:]])
+            if len(fanout[1]) == self.shards:
+                del self.fanouts[head[1]]
+                self.frontend.send_multipart(self.merge(fanout[0], fanout[1]))
+            return
+        if len(head) >= 4 and head[1] == '' and head[2] == MDP.W_WORKER:
+            worker = self.workers.get(head[0])
+            if worker is not None:
+                if head[3] == MDP.W_REQUEST:
+                    worker[2] = True
+                elif head[3] == MDP.W_DISCONNECT:
+                    del self.workers[head[0]]
+        self.frontend.send_multipart(msg, copy=False)
+
+    def merge(self, request, replies):
+        """Merge the replies of the shards to a mmi request"""
+        head = replies[0].index('') + 3
+        service = replies[0][head-1]
+        successes = [reply for reply in replies if reply[-1] == MDP.T_OK]
+        if not successes:
+            return replies[0]
+        bodies = [reply[head:-1] for reply in successes]
+        if service in ("mmi.discovery", "mmi.directory"):
+            body = sorted(set([srv for srvs in bodies for srv in srvs]))
+        elif service == "mmi.stats" and not request[-1]:
+            stats = {}
+            for srvs in bodies:
+                stats.update(json.loads(srvs[0]))
+            body = [json.dumps(stats)]
+        else:
+            # mmi.service, mmi.stats of a service, ... : the shard of the service
+            return successes[0]
+        return replies[0][:head] + body + [MDP.T_OK]
+
+    def purge(self):
+        """Forget the expired idle workers and the fanouts without all their replies"""
+        if self.now < self.purge_at:
+            return
+        self.purge_at = self.now + 1e-3*self.HEARTBEAT_INTERVAL
+        expiry = self.now - 1e-3*self.HEARTBEAT_EXPIRY
+        for address in [address for address, worker in self.workers.items() if not worker[2] and worker[1] < expiry]:
+            del self.workers[address]
+        expiry = self.now - 1e-3*self.HEARTBEAT_INTERVAL
+        for fanout in [fanout for fanout, request in self.fanouts.items() if request[2] < expiry]:
+            MDP.logger.warning("BROKER - Drop mmi request without all the replies of the shards : %s", self.fanouts[fanout][0])
+            del self.fanouts[fanout]
+
+if __name__ == '__main__': # pragma: no cover
+    mybroker = ShardedBroker()    # pragma: no cover
+    mybroker.run()                # pragma: no cover
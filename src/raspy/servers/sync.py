@@ -42,13 +42,11 @@ class Sync(Server):
 
     """
 
-    def __init__(self, hostname='localhost', service="sync", broker_ip='127.0.0.1', broker_port=5514):
+    def __init__(self, hostname='localhost', service="sync", broker_ip='127.0.0.1', broker_port=5514, conffile=None):
         """Initialize the server
         """
-        Server.__init__(self, hostname, service, broker_ip, broker_port)
-        self.worker_sync_thread = threading.Thread(target=self.worker_sync)
-        self.worker_sync_thread.daemon = True
-        self._active_threads.append(self.worker_sync_thread)
+        Server.__init__(self, hostname, service, broker_ip, broker_port, conffile=conffile)
+        self.worker_sync_pool = self.add_worker_pool(self.worker_sync, "sync")
         self.publisher = None
 
     def worker_sync(self):
@@ -56,7 +54,7 @@ class Sync(Server):
         """
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), \
                 "%s" % MDP.routing_key(self.hostname, self.service))
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         logging.debug("Start worker for service %s", "%s" % MDP.routing_key(self.hostname, self.service))
         while not self._stopevent.isSet():
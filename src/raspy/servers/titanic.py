@@ -23,6 +23,8 @@ __email__ = 'bibi21000@gmail.com'
 
 import pickle
 import threading
+import time
+import json
 from uuid import uuid4
 import traceback
 import os
@@ -32,46 +34,631 @@ try:
 except ImportError:
     from configparser import SafeConfigParser
     import configparser as ConfigParser
+from collections import OrderedDict, deque
 import zmq
 import raspy.common.MDP as MDP
 from raspy.common.executive import Executive
 from raspy.common.mdwrkapi import MajorDomoWorker
-from raspy.common.mdcliapi import MajorDomoClient
+from raspy.common.mdcliapi import MajorDomoAsyncClient
+from raspy.common.kvcliapi import KvPublisherClient
 from raspy.common.zhelpers import zpipe
+from raspy.common.journal import Journal
+
+class FileStorage(object):
+    """Titanic storage : a pickle file per request and per reply
+
+    This is the layout of the zguide. Each message costs a file creation
+    and a file deletion.
+    """
+
+    def __init__(self, path):
+        """Initialize the storage
+
+        :parameter path: the directory of the files
+        """
+        self.path = path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def request_filename(self, uuid):
+        """Returns freshly allocated request filename for given UUID"""
+        return os.path.join(self.path, "%s.req" % uuid)
+
+    def reply_filename(self, uuid):
+        """Returns freshly allocated reply filename for given UUID"""
+        return os.path.join(self.path, "%s.rep" % uuid)
+
+    def put_request(self, uuid, request):
+        """Store a request"""
+        with open(self.request_filename(uuid), 'w') as f:
+            pickle.dump(request, f)
+
+    def get_request(self, uuid):
+        """Return the request for uuid or None if it is closed"""
+        filename = self.request_filename(uuid)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'r') as f:
+            return pickle.load(f)
+
+    def has_request(self, uuid):
+        """Return True if the request for uuid is known"""
+        return os.path.exists(self.request_filename(uuid))
+
+    def put_reply(self, uuid, reply):
+        """Store the reply of a request"""
+        with open(self.reply_filename(uuid), 'w') as f:
+            pickle.dump(reply, f)
+
+    def get_reply(self, uuid):
+        """Return the reply for uuid or None if it is not available"""
+        filename = self.reply_filename(uuid)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'r') as f:
+            return pickle.load(f)
+
+    def close_request(self, uuid):
+        """Remove the request and the reply"""
+        for filename in [self.request_filename(uuid), self.reply_filename(uuid)]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def close(self):
+        """Close the storage"""
+        pass
+
+class JournalStorage(object):
+    """Titanic storage : a segmented append-only journal
+
+    The requests and replies are kept in memory, indexed by uuid. Every
+    change is appended to the journal as a record [op][uuid][pickled message]
+    where op is :
+
+        - Q : the request
+        - P : the reply
+        - C : the close
+
+    The journal is compacted in background when it holds more records than
+    the live messages.
+
+    The files of a FileStorage in path (the layout of the previous versions)
+    are imported at startup then removed.
+    """
+
+    COMPACT_MIN = 10000 # Don't compact the journal under this number of records
+
+    def __init__(self, path, sync=False):
+        """Initialize the storage and restore the messages from the journal
+
+        :parameter path: the journal is created in path/journal
+        :parameter sync: fsync after each record
+        """
+        self.journal = Journal(os.path.join(path, "journal"), sync=sync)
+        self.lock = threading.Lock()
+        self.compact_thread = None
+        self.index = {}
+        """uuid -> [request, reply]"""
+        for data in self.journal.replay():
+            self.apply(data[0:1], data[1:33], data[33:])
+        self.import_files(path)
+        MDP.logger.info("TITANIC - Restored %s requests from journal", len(self.index))
+
+    def import_files(self, path):
+        """Import the requests and replies of a FileStorage in path, then remove their files.
+
+        The files are removed once the journal is compacted : after a crash,
+        the import is done again.
+        """
+        if not os.path.isdir(path):
+            return
+        files = FileStorage(path)
+        uuids = [name[:-4] for name in os.listdir(path) if name.endswith('.req')]
+        for uuid in uuids:
+            self.put_request(uuid, files.get_request(uuid))
+            reply = files.get_reply(uuid)
+            if reply is not None:
+                self.put_reply(uuid, reply)
+        for name in os.listdir(path):
+            if name.endswith('.rep') and not os.path.exists(files.request_filename(name[:-4])):
+                MDP.logger.warning("TITANIC - Reply %s without request left in %s", name, path)
+        if not uuids:
+            return
+        self.compact()
+        for uuid in uuids:
+            files.close_request(uuid)
+        MDP.logger.info("TITANIC - Imported %s requests from files", len(uuids))
+
+    def apply(self, op, uuid, data):
+        """Apply a record to the index"""
+        if op == b'Q':
+            self.index[uuid] = [pickle.loads(data), None]
+        elif op == b'P':
+            if uuid in self.index:
+                self.index[uuid][1] = pickle.loads(data)
+        elif op == b'C':
+            self.index.pop(uuid, None)
+
+    def append(self, op, uuid, message=None):
+        """Append a record to the journal. Must be called with the lock"""
+        data = b'' if message is None else pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self.journal.append(op + uuid + data)
+
+    def put_request(self, uuid, request):
+        """Store a request"""
+        with self.lock:
+            self.index[uuid] = [list(request), None]
+            self.append(b'Q', uuid, request)
+
+    def get_request(self, uuid):
+        """Return the request for uuid or None if it is closed"""
+        entry = self.index.get(uuid)
+        return None if entry is None else list(entry[0])
+
+    def has_request(self, uuid):
+        """Return True if the request for uuid is known"""
+        return uuid in self.index
+
+    def put_reply(self, uuid, reply):
+        """Store the reply of a request. Replies of closed requests are dropped"""
+        with self.lock:
+            entry = self.index.get(uuid)
+            if entry is not None:
+                entry[1] = list(reply)
+                self.append(b'P', uuid, reply)
+
+    def get_reply(self, uuid):
+        """Return the reply for uuid or None if it is not available"""
+        entry = self.index.get(uuid)
+        return None if entry is None or entry[1] is None else list(entry[1])
+
+    def close_request(self, uuid):
+        """Remove the request and the reply"""
+        with self.lock:
+            if self.index.pop(uuid, None) is not None:
+                self.append(b'C', uuid)
+        if self.journal.appended > max(self.COMPACT_MIN, 2*len(self.index)):
+            self.compact(background=True)
+
+    def compact(self, background=False):
+        """Replace the journal by a snapshot of the live messages"""
+        if self.compact_thread is not None:
+            if self.compact_thread.is_alive():
+                return
+            self.compact_thread.join()
+            self.compact_thread = None
+        with self.lock:
+            upto = self.journal.rotate()
+            entries = [(uuid, entry[0], entry[1]) for uuid, entry in self.index.items()]
+        def records():
+            for uuid, request, reply in entries:
+                yield b'Q' + uuid + pickle.dumps(request, pickle.HIGHEST_PROTOCOL)
+                if reply is not None:
+                    yield b'P' + uuid + pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+        if background:
+            self.compact_thread = threading.Thread(target=self.journal.compact, args=(records(), upto))
+            self.compact_thread.daemon = True
+            self.compact_thread.start()
+        else:
+            self.journal.compact(records(), upto)
+
+    def close(self):
+        """Close the storage"""
+        if self.compact_thread is not None:
+            self.compact_thread.join()
+        self.journal.close()
+
+STORAGES = {
+    'file' : FileStorage,
+    'journal' : JournalStorage,
+}
+"""The storage backends of Titanic"""
+
+class PendingQueue(object):
+    """The queue of the requests waiting for dispatch
+
+    The pending uuids are kept in memory, in arrival order. The queue is
+    backed by a journal of records [-][uuid] (new request) and [+][uuid]
+    (request done), compacted to the pending uuids when it holds more done
+    records than pending ones. So the cost of a startup depends on the
+    pending requests, not on the history.
+
+    A queue file of the previous versions is imported at startup then removed.
+    """
+
+    COMPACT_MIN = 1000 # Don't compact the journal under this number of records
+
+    def __init__(self, path):
+        """Initialize the queue and restore the pending uuids
+
+        :parameter path: the journal is created in path/pending
+        """
+        self.journal = Journal(os.path.join(path, "pending"))
+        self.pending = OrderedDict()
+        for data in self.journal.replay():
+            if data[0:1] == b'-':
+                self.pending[data[1:]] = True
+            else:
+                self.pending.pop(data[1:], None)
+        legacy = os.path.join(path, "queue")
+        if os.path.isfile(legacy):
+            with open(legacy, 'r') as f:
+                for entry in f:
+                    if entry[0] == '-':
+                        self.add(entry[1:].rstrip())
+            os.unlink(legacy)
+        MDP.logger.info("TITANIC - Restored %s pending requests", len(self.pending))
+
+    def __len__(self):
+        return len(self.pending)
+
+    def uuids(self):
+        """Return the pending uuids, oldest first"""
+        return list(self.pending.keys())
+
+    def add(self, uuid):
+        """Add a new request to the queue"""
+        self.pending[uuid] = True
+        self.journal.append(b'-' + uuid)
+
+    def done(self, uuid):
+        """Remove a processed request from the queue"""
+        if self.pending.pop(uuid, None) is not None:
+            self.journal.append(b'+' + uuid)
+            if self.journal.appended > max(self.COMPACT_MIN, 2*len(self.pending)):
+                self.compact()
+
+    def compact(self):
+        """Replace the journal by the pending uuids"""
+        upto = self.journal.rotate()
+        self.journal.compact([b'-' + uuid for uuid in self.pending], upto)
+
+    def close(self):
+        """Close the queue"""
+        self.journal.close()
+
+def _str(value):
+    """Return value as an utf-8 string : json.loads returns unicode strings"""
+    value = "%s" % value
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+class ConfigStore(object):
+    """The keys/values store of the services
+
+    Each service has a file <service>.sto in ini format. A file is parsed
+    once, at the first access, and the reads are served from memory.
+    The writes mark the service dirty : flush() saves the dirty services
+    (write to a temporary file then rename) at most every flush_interval
+    secs. With a flush_interval of 0, each write is saved immediately.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        """Initialize the store
+
+        :parameter path: the directory of the files
+        :parameter flush_interval: save the dirty services every secs
+        """
+        self.path = path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.parsers = {}
+        self.dirty = set()
+        self.dirty_since = None
+
+    def filename(self, service):
+        """Returns store filename for given service"""
+        return os.path.join(self.path, "%s.sto" % service)
+
+    def parser(self, service):
+        """Return the parser of a service, reading its file at the first access"""
+        parser = self.parsers.get(service)
+        if parser is None:
+            parser = SafeConfigParser()
+            parser.read(self.filename(service))
+            self.parsers[service] = parser
+        return parser
+
+    def changed(self, service):
+        """Mark a service as dirty"""
+        self.dirty.add(service)
+        if self.dirty_since is None:
+            self.dirty_since = time.time()
+        if self.flush_interval <= 0:
+            self.flush(force=True)
+
+    def get(self, service, section, key):
+        """Return the value of a key or None if it doesn't exist"""
+        with self.lock:
+            parser = self.parser(service)
+            if parser.has_option(section, key):
+                return "%s" % parser.get(section, key)
+            return None
+
+    def set(self, service, section, key, value):
+        """Set the value of a key"""
+        with self.lock:
+            parser = self.parser(service)
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, key, value)
+            self.changed(service)
+
+    def mget(self, service):
+        """Return all the sections of a service : a dict of dicts"""
+        with self.lock:
+            parser = self.parser(service)
+            return dict((section, dict(parser.items(section))) for section in parser.sections())
+
+    def mset(self, service, sections):
+        """Set the values of many sections : a dict of dicts"""
+        with self.lock:
+            parser = self.parser(service)
+            for section in sections:
+                if not parser.has_section(_str(section)):
+                    parser.add_section(_str(section))
+                for key in sections[section]:
+                    parser.set(_str(section), _str(key), _str(sections[section][key]))
+            self.changed(service)
+
+    def remove_option(self, service, section, key):
+        """Remove a key. Raise ConfigParser.NoSectionError if the section doesn't exist"""
+        with self.lock:
+            self.parser(service).remove_option(section, key)
+            self.changed(service)
+
+    def remove_section(self, service, section):
+        """Remove a section"""
+        with self.lock:
+            self.parser(service).remove_section(section)
+            self.changed(service)
+
+    def remove(self, service):
+        """Remove all the keys of a service"""
+        with self.lock:
+            self.parsers[service] = SafeConfigParser()
+            self.changed(service)
+
+    def flush(self, force=False):
+        """Save the dirty services if the flush interval is over or if force"""
+        with self.lock:
+            if not self.dirty:
+                return
+            if not force and time.time() < self.dirty_since + self.flush_interval:
+                return
+            for service in self.dirty:
+                filename = self.filename(service)
+                parser = self.parsers[service]
+                try:
+                    if not parser.sections():
+                        if os.path.isfile(filename):
+                            os.unlink(filename)
+                        continue
+                    with open(filename + '.tmp', 'wb') as configfile:
+                        parser.write(configfile)
+                        configfile.flush()
+                        os.fsync(configfile.fileno())
+                    os.rename(filename + '.tmp', filename)
+                except (IOError, OSError):
+                    MDP.logger.exception("TITANIC - Can't save store %s", filename)
+            self.dirty = set()
+            self.dirty_since = None
+
+class ServiceState(object):
+    """The dispatch state and the metrics of a target service
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.inflight = 0
+        self.available = False
+        self.checked_until = 0
+        """The result of the last mmi.service is valid until"""
+        self.checking = False
+        self.retry_at = 0
+        self.backoff = 0
+        self.pending = deque()
+        """The uuids of the requests waiting for a slot in the window, oldest first"""
+        self.dispatched = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def stats(self):
+        """Return the metrics of the service"""
+        return {
+            'depth' : len(self.pending) + self.inflight,
+            'inflight' : self.inflight,
+            'available' : self.available,
+            'dispatched' : self.dispatched,
+            'latency_avg' : self.latency_total / self.dispatched if self.dispatched else 0.0,
+            'latency_max' : self.latency_max,
+        }
+
+class Dispatcher(object):
+    """The dispatcher of the pending requests
+
+    The requests are sent asynchronously, so a slow or dead service
+    doesn't stall the others. The pending uuids are indexed by service and
+    at most window requests are in flight for each service : a request is
+    only read from the storage when it can be sent. The result of mmi.service is cached for MMI_TTL secs
+    and refreshed while the requests are dispatched.
+    A service which is not available or doesn't reply is retried after
+    a backoff which doubles, once for all the requests in flight which fail, up to BACKOFF_MAX secs.
+
+    The callbacks are called by client.process() : the dispatcher must be
+    used by the thread which pumps the client. notify(uuid) is called
+    when the reply of a request is stored.
+    """
+
+    WINDOW = 10 # Max requests in flight per service
+    MMI_TTL = 5.0 # Cache mmi.service for secs
+    BACKOFF_MIN = 1.0 # First backoff in secs
+    BACKOFF_MAX = 60.0 # Max backoff in secs
+
+    def __init__(self, client, storage, queue, window=WINDOW, notify=None):
+        """Initialize the dispatcher
+
+        :parameter client: a MajorDomoAsyncClient
+        """
+        self.client = client
+        self.notify = notify
+        self.storage = storage
+        self.queue = queue
+        self.window = window
+        self.services = {}
+        self.inflight = {}
+        """uuid -> (service state, sent at)"""
+        for uuid in self.queue.uuids():
+            self.add(uuid)
+
+    def service(self, name):
+        """Return the state of a service, creating it if needed"""
+        state = self.services.get(name)
+        if state is None:
+            state = self.services[name] = ServiceState(name)
+        return state
+
+    def add(self, uuid, service=None):
+        """Add a pending request to its service.
+
+        :parameter service: the service of the request. None to read it from the storage
+        """
+        if service is None:
+            request = self.storage.get_request(uuid)
+            # If the client already closed request, treat as successful
+            if request is None:
+                self.queue.done(uuid)
+                return
+            service = request[0]
+        self.service(service).pending.append(uuid)
+
+    def dispatch(self):
+        """Send the pending requests of the services with free slots in their window"""
+        now = time.time()
+        for state in list(self.services.values()):
+            if not state.pending or state.retry_at > now or state.inflight >= self.window:
+                continue
+            if state.checked_until < now:
+                # Refresh in the background and keep dispatching with the last known availability
+                self.check(state)
+            if not state.available:
+                continue
+            while state.pending and state.inflight < self.window:
+                uuid = state.pending.popleft()
+                request = self.storage.get_request(uuid)
+                # If the client already closed request, treat as successful
+                if request is None:
+                    self.queue.done(uuid)
+                    continue
+                self.send(uuid, state, request[1:], now)
+
+    def check(self, state):
+        """Use MMI protocol to check if service is available"""
+        if state.checking:
+            return
+        state.checking = True
+        future = self.client.send_async("mmi.service", [state.name])
+        future.add_done_callback(lambda future: self.checked(state, future.reply))
+
+    def checked(self, state, reply):
+        """Handle the reply of mmi.service"""
+        state.checking = False
+        state.checked_until = time.time() + self.MMI_TTL
+        if reply and reply[0] == MDP.T_OK:
+            state.available = True
+        else:
+            self.unavailable(state)
+
+    def unavailable(self, state):
+        """Backoff a service, once for all the failures of the same episode"""
+        state.available = False
+        state.checked_until = 0
+        if state.retry_at > time.time():
+            # Already backing off : another request of the window failed
+            return
+        state.backoff = min(self.BACKOFF_MAX, max(self.BACKOFF_MIN, 2*state.backoff))
+        state.retry_at = time.time() + state.backoff
+        MDP.logger.debug("TITANIC - Service %s unavailable, retry in %ss", state.name, state.backoff)
+
+    def send(self, uuid, state, request, now):
+        """Send a request to its service"""
+        MDP.logger.debug("TITANIC - Processing request %s", uuid)
+        state.inflight += 1
+        self.inflight[uuid] = (state, now)
+        future = self.client.send_async(state.name, request)
+        future.add_done_callback(lambda future: self.done(uuid, future.reply))
+
+    def done(self, uuid, reply):
+        """Handle the reply of a request"""
+        state, sent_at = self.inflight.pop(uuid)
+        state.inflight -= 1
+        if reply:
+            latency = time.time() - sent_at
+            state.dispatched += 1
+            state.latency_total += latency
+            state.latency_max = max(state.latency_max, latency)
+            state.backoff = 0
+            self.storage.put_reply(uuid, reply)
+            self.queue.done(uuid)
+            if self.notify is not None:
+                self.notify(uuid)
+        else:
+            state.pending.appendleft(uuid)
+            self.unavailable(state)
+
+    def stats(self):
+        """Return the metrics of the services"""
+        return dict((state.name, state.stats()) for state in list(self.services.values()))
 
 class Titanic(Executive):
     """The Titanic helper
 
     Also integrates a store for keys/values
 
+    When the reply of a request is stored, Titanic publishes the key
+    /titanic/<uuid> with body 200 through the key/value proxy, so the
+    clients don't need to poll titanic.reply. The key expires after
+    NOTIFY_TTL secs.
+
     From http://zguide.zeromq.org/py:all#Disconnected-Reliability-Titanic-Pattern
          http://zguide.zeromq.org/py:all#Service-Oriented-Reliable-Queuing-Majordomo-Pattern
          https://github.com/imatix/zguide/tree/master/examples/Python
     """
 
+    NOTIFY_TTL = 900 # Completion events expire after secs
+
     def __init__(self, hostname='localhost', service="titanic", broker_ip='127.0.0.1', broker_port=5514, \
-            data_dir='/tmp/raspy'):
+            data_dir='/tmp/raspy', storage='journal', store_flush=1.0):
         """Initialize the Titanic helper
+
+        :parameter storage: the storage backend of requests and replies, a key of STORAGES
+        :parameter store_flush: the flush interval of titanic.store in secs, 0 to save on each write
         """
         MDP.logger.debug("TITANIC - Starting ...")
         Executive.__init__(self, hostname, service, broker_ip, broker_port)
         self.data_dir = data_dir
         self.store_dir = os.path.join(self.data_dir, "store")
         self.queue_dir = os.path.join(self.data_dir, "queue")
-        if not os.path.isdir(self.store_dir):
-            os.makedirs(self.store_dir)
+        self.store = ConfigStore(self.store_dir, flush_interval=store_flush)
         self.ctx = zmq.Context()
         if not os.path.isdir(self.queue_dir):
             os.makedirs(self.queue_dir)
-        self.ctx = zmq.Context()
+        self.storage = STORAGES[storage](self.queue_dir)
+        self.queue = PendingQueue(self.queue_dir)
         # Create MDP client session with short timeout
         MDP.logger.debug("TITANIC - Connect client to tcp://%s:%s", self.broker_ip, self.broker_port)
-        self.client = MajorDomoClient("tcp://%s:%s" % (self.broker_ip, self.broker_port))
+        self.client = MajorDomoAsyncClient("tcp://%s:%s" % (self.broker_ip, self.broker_port))
         self.client.timeout = 1000 # 1 sec
         self.client.retries = 1 # only 1 retry
+        self.publisher = KvPublisherClient(hostname=hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
+        self.dispatcher = Dispatcher(self.client, self.storage, self.queue, notify=self.notify_reply)
         self.request_pipe, self.peer = zpipe(self.ctx)
         self.poller = zmq.Poller()
         self.poller.register(self.request_pipe, zmq.POLLIN)
+        self.poller.register(self.client.client, zmq.POLLIN)
         self.request_thread = threading.Thread(target=self.titanic_request, args=(self.peer,))
         self._active_threads.append(self.request_thread)
         self.request_thread.daemon = True
@@ -84,6 +671,9 @@ class Titanic(Executive):
         self.store_thread = threading.Thread(target=self.titanic_store)
         self._active_threads.append(self.store_thread)
         self.store_thread.daemon = True
+        self.stats_thread = threading.Thread(target=self.titanic_stats)
+        self._active_threads.append(self.stats_thread)
+        self.stats_thread.daemon = True
         MDP.logger.info("TITANIC - Started")
 
     def run(self):
@@ -93,59 +683,49 @@ class Titanic(Executive):
         self.reply_thread.start()
         self.close_thread.start()
         self.store_thread.start()
+        self.stats_thread.start()
         while not self._stopevent.isSet():
             # We'll dispatch once per second, if there's no activity
+            # More often when requests are in flight, to handle their timeouts
+            timeout = self.speed*1000.0
+            if self.client.pending:
+                timeout = min(timeout, 100)
             try:
-                items = self.poller.poll(self.speed*1000.0)
+                items = dict(self.poller.poll(timeout))
             except KeyboardInterrupt: # pragma: no cover
                 break                 # pragma: no cover
             except zmq.ZMQError as exc:
                 if not self._stopevent.isSet():
                     raise exc
                 else:
-                    items = None      # pragma: no cover
-            if items:
-                # Append UUID to queue, prefixed with '-' for pending
-                uuid = self.request_pipe.recv()
-                MDP.logger.debug("TITANIC - Store new uid %s in queue", uuid)
-                try:
-                    with open(os.path.join(self.queue_dir, 'queue'), 'a') as f:
-                        f.write("-%s\n" % uuid)
-                except (IOError) as e:
-                    MDP.logger.error("TITANIC - Can't create file %s", os.path.join(self.queue_dir, 'queue'))
-            # Brute-force dispatcher
-            try:
-                with open(os.path.join(self.queue_dir, 'queue'), 'r+b') as f:
-                    for entry in f.readlines():
-                        # UUID is prefixed with '-' if still waiting
-                        if entry[0] == '-':
-                            uuid = entry[1:].rstrip() # rstrip '\n' etc.
-                            MDP.logger.debug("TITANIC - Processing request %s", uuid)
-                            if self.service_success(self.client, uuid):
-                                # mark queue entry as processed
-                                here = f.tell()
-                                f.seek(-1*len(entry), os.SEEK_CUR)
-                                f.write('+')
-                                f.seek(here, os.SEEK_SET)
-            except (IOError) as e:
-                MDP.logger.debug("TITANIC - Can't open file %s ... Create it", os.path.join(self.queue_dir, 'queue'))
-                try:
-                    with open(os.path.join(self.queue_dir, 'queue'), 'a') as f:
-                        f.write("")
-                except (IOError) as e:
-                    MDP.logger.error("TITANIC - Can't create file %s", os.path.join(self.queue_dir, 'queue'))
-
-    def request_filename(self, uuid):
-        """Returns freshly allocated request filename for given UUID"""
-        return os.path.join(self.queue_dir, "%s.req" % uuid)
+                    items = {}        # pragma: no cover
+            if self.request_pipe in items:
+                # Append the new UUIDs to the queue
+                while True:
+                    try:
+                        uuid, service = self.request_pipe.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    MDP.logger.debug("TITANIC - Store new uid %s in queue", uuid)
+                    self.queue.add(uuid)
+                    self.dispatcher.add(uuid, service)
+            # Handle the replies then dispatch the pending requests
+            self.client.process(0)
+            self.dispatcher.dispatch()
+            self.store.flush()
 
-    def reply_filename(self, uuid):
-        """Returns freshly allocated reply filename for given UUID"""
-        return os.path.join(self.queue_dir, "%s.rep" % uuid)
+    def destroy(self):
+        """Save the store, close the storage and the queue
+        """
+        Executive.destroy(self)
+        self.publisher.destroy()
+        self.store.flush(force=True)
+        self.storage.close()
+        self.queue.close()
 
     def store_filename(self, service):
         """Returns store filename for given service"""
-        return os.path.join(self.store_dir, "%s.sto" % service)
+        return self.store.filename(service)
 
     def titanic_request(self, pipe):
         """Create a worker to handle titanic.request
@@ -154,7 +734,7 @@ class Titanic(Executive):
         """
         MDP.logger.info("TITANIC - Connect titanic_request worker to tcp://%s:%s", self.broker_ip, self.broker_port)
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "titanic.request")
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         while not self._stopevent.isSet():
             # Send reply if it's not null
@@ -162,96 +742,100 @@ class Titanic(Executive):
             request = worker.recv(reply)
             if not request:
                 break      # Interrupted, exit
-            # Generate UUID and save message to disk
+            # Generate UUID and save message to storage
             uuid = uuid4().hex
-            filename = self.request_filename(uuid)
-            with open(filename, 'w') as f:
-                pickle.dump(request, f)
-            # Send UUID through to message queue
-            pipe.send(uuid)
+            self.storage.put_request(uuid, request)
+            # Send UUID and service through to message queue
+            pipe.send_multipart([uuid, request[0]])
             # Now send UUID back to client
             # Done by the worker.recv() at the top of the loop
             reply = ["200", uuid]
 
+    def notify_reply(self, uuid):
+        """Publish the completion of a request"""
+        self.publisher.send(MDP.TITANIC_SUBTREE, uuid, MDP.T_OK, ttl=self.NOTIFY_TTL)
+
+    def get_reply(self, uuid):
+        """Return [status] + reply for a request UUID"""
+        reply = self.storage.get_reply(uuid)
+        if reply is not None:
+            return [MDP.T_OK] + reply
+        if self.storage.has_request(uuid):
+            return [MDP.T_PENDING] # pending
+        return [MDP.T_UNKNOWN] # unknown
+
     def titanic_reply(self):
         """Create a worker to handle titanic.service
 
         titanic.reply: fetch a reply, if available, for a given request UUID.
+        With many UUIDs, the reply holds for each UUID [uuid][status][count] followed
+        by the count frames of its reply.
         """
         MDP.logger.info("TITANIC - Connect titanic_reply worker to tcp://%s:%s", self.broker_ip, self.broker_port)
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "titanic.reply")
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         while not self._stopevent.isSet():
             request = worker.recv(reply)
             if not request:
                 break      # Interrupted, exit
-            uuid = request.pop(0)
-            req_filename = self.request_filename(uuid)
-            rep_filename = self.reply_filename(uuid)
-            if os.path.exists(rep_filename):
-                with open(rep_filename, 'r') as f:
-                    reply = pickle.load(f)
-                reply = [MDP.T_OK] + reply
+            if len(request) == 0:
+                reply = [MDP.T_UNKNOWN]
+            elif len(request) == 1:
+                reply = self.get_reply(request[0])
             else:
-                if os.path.exists(req_filename):
-                    reply = [MDP.T_PENDING] # pending
-                else:
-                    reply = [MDP.T_UNKNOWN] # unknown
+                reply = []
+                for uuid in request:
+                    frames = self.get_reply(uuid)
+                    reply += [uuid, frames[0], "%s" % (len(frames) - 1)] + frames[1:]
 
     def titanic_close(self):
         """Create a worker to handle titanic.close
 
         titanic.close: confirm that a reply has been stored and processed.
+        Accepts many UUIDs.
         """
         MDP.logger.info("TITANIC - Connect titanic_close worker to tcp://%s:%s", self.broker_ip, self.broker_port)
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "titanic.close")
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         while not self._stopevent.isSet():
             request = worker.recv(reply)
             if not request:
                 break      # Interrupted, exit
-            uuid = request.pop(0)
-            req_filename = self.request_filename(uuid)
-            rep_filename = self.reply_filename(uuid)
-            # should these be protected?  Does zfile_delete ignore files
-            # that have already been removed?  That's what we are doing here.
-            if os.path.exists(req_filename):
-                os.remove(req_filename)
-            if os.path.exists(rep_filename):
-                os.remove(rep_filename)
+            for uuid in request:
+                self.storage.close_request(uuid)
             reply = [MDP.T_OK]
 
-    def service_success(self, client, uuid):
-        """Attempt to process a single request, return True if successful"""
-        # Load request message, service will be first frame
-        filename = self.request_filename(uuid)
-        # If the client already closed request, treat as successful
-        if not os.path.exists(filename):
-            return True
-        with open(filename, 'r') as f:
-            request = pickle.load(f)
-        service = request.pop(0)
-        # Use MMI protocol to check if service is available
-        mmi_request = [service]
-        mmi_reply = client.send("mmi.service", mmi_request)
-        service_ok = mmi_reply and mmi_reply[0] == MDP.T_OK
-        if service_ok:
-            reply = client.send(service, request)
-            if reply:
-                filename = self.reply_filename(uuid)
-                with open(filename, "w") as f:
-                    pickle.dump(reply, f)
-                return True
-        return False
+    def titanic_stats(self):
+        """Create a worker to handle titanic.stats
+
+        titanic.stats: return the queue depth and the dispatch latency per service, in json.
+        """
+        MDP.logger.info("TITANIC - Connect titanic_stats worker to tcp://%s:%s", self.broker_ip, self.broker_port)
+        worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "titanic.stats")
+        self.register_worker(worker)
+        reply = None
+        while not self._stopevent.isSet():
+            request = worker.recv(reply)
+            if not request:
+                break      # Interrupted, exit
+            reply = [json.dumps(self.dispatcher.stats())] + [MDP.T_OK]
 
     def titanic_store(self):
         """Create a worker to handle store services
+
+        titanic.store actions :
+
+            - get service section key
+            - set service section key value
+            - delete service [section [key]]
+            - mget service : all the sections of the service in a json dict of dicts
+            - mset service sections : update many sections from a json dict of dicts
         """
         MDP.logger.info("TITANIC - Connect titanic.store worker to tcp://%s:%s", self.broker_ip, self.broker_port)
         worker = MajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "titanic.store")
-        self._active_workers.append(worker)
+        self.register_worker(worker)
         reply = None
         while not self._stopevent.isSet():
             request = worker.recv(reply)
@@ -263,34 +847,29 @@ class Titanic(Executive):
                 service = request.pop(0)
                 reply = [service] + [MDP.T_ERROR]
                 if action == "set":
-                    try:
-                        parser = SafeConfigParser()
-                        parser.read(self.store_filename(service))
-                        section = request.pop(0)
-                        key = request.pop(0)
-                        value = request.pop(0)
-                        reply = [service] + [section] + [key] + [MDP.T_ERROR]
-                        if not parser.has_section(section):
-                            parser.add_section(section)
-                        parser.set(section, key, value)
-                        with open(self.store_filename(service), 'wb') as configfile:
-                            parser.write(configfile)
-                        reply = [service] + [section] + [key] + [MDP.T_OK]
-                    except IOError:
-                        reply = [service] + [MDP.T_ERROR]
+                    section = request.pop(0)
+                    key = request.pop(0)
+                    value = request.pop(0)
+                    reply = [service] + [section] + [key] + [MDP.T_ERROR]
+                    self.store.set(service, section, key, value)
+                    reply = [service] + [section] + [key] + [MDP.T_OK]
                 elif action == "get":
-                    parser = SafeConfigParser()
-                    parser.read(self.store_filename(service))
                     section = request.pop(0)
                     key = request.pop(0)
                     reply = [service] + [section] + [key] + [MDP.T_ERROR]
-                    if parser.has_option(section, key) == True:
-                        value = "%s" % parser.get(section, key)
+                    value = self.store.get(service, section, key)
+                    if value is not None:
                         MDP.logger.debug("TITANIC - Store retrieve value for %s.%s.%s : %s", service, section, key, value)
                         reply = [service] + [section] + [key] + [value] + [MDP.T_OK]
                     else:
                         MDP.logger.debug("TITANIC - Store can't retrieve value for %s.%s.%s", service, section, key)
                         reply = [service] + [section] + [key] + [MDP.T_NOTFOUND]
+                elif action == "mget":
+                    reply = [service] + [json.dumps(self.store.mget(service))] + [MDP.T_OK]
+                elif action == "mset":
+                    sections = json.loads(request.pop(0))
+                    self.store.mset(service, sections)
+                    reply = [service] + [MDP.T_OK]
                 elif action == "delete":
                     section = None
                     key = None
@@ -301,31 +880,16 @@ class Titanic(Executive):
                     reply = [service] + [section] + [key] + [MDP.T_ERROR]
                     if key is not None:
                         try:
-                            parser = SafeConfigParser()
-                            parser.read(self.store_filename(service))
-                            parser.remove_option(section, key)
-                            with open(self.store_filename(service), 'wb') as configfile:
-                                parser.write(configfile)
+                            self.store.remove_option(service, section, key)
                             reply = [service] + [section] + [key] + [MDP.T_OK]
-                        except (IOError, ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+                        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
                             reply = [service] + [section] + [MDP.T_ERROR]
                     elif section is not None:
-                        try:
-                            parser = SafeConfigParser()
-                            parser.read(self.store_filename(service))
-                            parser.remove_section(section)
-                            with open(self.store_filename(service), 'wb') as configfile:
-                                parser.write(configfile)
-                            reply = [service] + [section] + [MDP.T_OK]
-                        except (ConfigParser.NoSectionError, IOError):
-                            reply = [service] + [section] + [MDP.T_ERROR]
+                        self.store.remove_section(service, section)
+                        reply = [service] + [section] + [MDP.T_OK]
                     else:
-                        try:
-                            if os.path.isfile(self.store_filename(service)):
-                                os.unlink(self.store_filename(service))
-                            reply = [service] + [MDP.T_OK]
-                        except OSError:
-                            reply = [service] + [MDP.T_ERROR]
+                        self.store.remove(service)
+                        reply = [service] + [MDP.T_OK]
                 else:
                     reply = [MDP.T_NOTIMPLEMENTED]
             except:
@@ -39,7 +39,7 @@ from raspy.common.server import Server
 from raspy.common.mdcliapi import MajorDomoClient
 from raspy.common.devices import *
 import raspy.common.devices as devices
-from raspy.common.devices.device import DReg, BaseDevice
+from raspy.common.devices.device import DReg, BaseDevice, Command
 
 from tests.common import SLEEP
 from tests.common import TestRasPy
@@ -150,7 +150,28 @@ class ServerBase():
         request = "all"
         reply = self.mdclient.send("%s.statistics"%MDP.routing_key(self.hostname, self.service), request)
         self.assertNotEqual(reply, None)
-        self.assertEqual(reply[0], MDP.T_OK)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.assertTrue(isinstance(mjson.loads(reply[0]), dict))
+        self.stopServer()
+
+    def test_052_statistics_requests(self):
+        self.startServer()
+        service = "%s.mmi"%MDP.routing_key(self.hostname, self.service)
+        for i in range(3):
+            reply = self.mdclient.send(service, "status")
+            self.assertNotEqual(reply, None)
+        reply = self.mdclient.send(service, "notimplemmmmment")
+        reply = self.mdclient.send("%s.statistics"%MDP.routing_key(self.hostname, self.service), "all")
+        self.assertNotEqual(reply, None)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        statistics = mjson.loads(reply[0])
+        self.assertEqual(statistics["%s.requests" % service], 4)
+        self.assertEqual(statistics["%s.errors" % service], 0)
+        self.assertEqual(statistics["%s.latency" % service]["count"], 4)
+        reply = self.mdclient.send("%s.statistics"%MDP.routing_key(self.hostname, self.service), "list_keys")
+        self.assertNotEqual(reply, None)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.assertTrue("%s.requests" % service in mjson.loads(reply[0]))
         self.stopServer()
 
     def test_051_statistics_not_implemented_action(self):
@@ -244,3 +265,47 @@ class DeviceBase(object):
         self.assertTrue(device.cmd_log(True))
         res = device.cmd_log()
         self.assertEqual(res, True)
+
+    def test_050_exec_cmd(self):
+        device_name = 'test_%s_device' % self.oid
+        device = BaseDevice()
+        device.poll = 0
+        self.assertTrue(device.exec_cmd(device_name, 'poll', 5))
+        self.assertEqual(device.exec_cmd(device_name, 'poll'), 5)
+        self.assertTrue('poll' in device.exec_cmd(device_name, 'commands').split('|'))
+        self.assertTrue(device.exec_cmd(device_name, 'bad_command') is None)
+        self.assertEqual(device.commands['poll'](), 5)
+
+    def test_051_exec_cmd_subdevice(self):
+        device_name = 'test_%s_device' % self.oid
+        device = BaseDevice()
+        subdevice = BaseDevice()
+        device.add_subdevice('volume', subdevice)
+        device.log = False
+        subdevice.log = False
+        self.assertTrue(device.exec_cmd('%s-volume' % device_name, 'log', True))
+        self.assertEqual(subdevice.log, True)
+        self.assertEqual(device.log, False)
+        self.assertTrue(device.exec_cmd('%s-bass' % device_name, 'log', True) is None)
+
+    def test_052_exec_many(self):
+        device_name = 'test_%s_device' % self.oid
+        device = BaseDevice()
+        device.poll = 0
+        res = device.exec_many([(device_name, 'poll', 5), (device_name, 'poll', None), (device_name, 'bad_command', None)])
+        self.assertEqual(res, [True, 5, None])
+
+    def test_053_command(self):
+        command = Command(json=mjson.dumps({'info' : 'from json'}), callback=lambda value: value * 2)
+        self.assertEqual(command.info, 'from json')
+        self.assertEqual(command(21), 42)
+        self.assertTrue(Command()(1) is None)
+
+    def test_054_subdevice_command_added_later(self):
+        device_name = 'test_%s_device' % self.oid
+        device = BaseDevice()
+        subdevice = BaseDevice()
+        device.add_subdevice('volume', subdevice)
+        subdevice.add_command('level', Command(callback=lambda value: value + 1))
+        self.assertEqual(device.exec_cmd('%s-volume' % device_name, 'level', 1), 2)
+        self.assertEqual(device.exec_many([('%s-volume' % device_name, 'level', 2), (device_name, 'level', 2)]), [3, None])
@@ -51,6 +51,25 @@ class TestCamera(TestDevice, DeviceBase, MediaBase):
         device = DReg.new(json=conf)
         self.assertIsInstance(device, devices.media.MediaCamera)
 
+    def test_300_device_image(self):
+        filename = '.raspy_test_image'
+        data = os.urandom(200000)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        try:
+            conf = mjson.dumps(\
+                { 'oid' : '%s.%s' % (self.key, self.oid), \
+                  'name' : 'test_%s_device' % self.oid, \
+                  'image' : filename, \
+                })
+            device = DReg.new(json=conf)
+            self.assertTrue('image' in device.commands)
+            self.assertEqual(''.join(device.cmd_image()), data)
+            device.config['image'] = filename + '.none'
+            self.assertEqual(device.cmd_image(), None)
+        finally:
+            os.unlink(filename)
+
 
 class TestTV(TestDevice, DeviceBase, MediaBase):
     key="media"
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unittests for the asyncio front-ends.
+
+They need python 3. The broker is python 2 : it's launched in a subprocess
+with the interpreter of the RASPY_PYTHON2 environment variable (python2 by
+default). The tests are skipped when one of them is missing.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import os
+import sys
+import time
+import unittest
+import subprocess
+import logging
+
+import zmq
+
+import raspy
+import raspy.common.MDP as MDP
+from raspy.common.kvsimple import KVMsg
+try:
+    import asyncio
+    import shutil
+    from raspy.common.asyncapi import AsyncMajorDomoClient, AsyncMajorDomoWorker, AsyncKvSubscriberClient
+except ImportError:
+    asyncio = None
+
+PYTHON2 = os.environ.get('RASPY_PYTHON2', 'python2')
+
+BROKER = """
+from raspy.servers.broker import Broker
+Broker(hostname=%r, broker_ip=%r, broker_port=%r).run()
+"""
+
+def skip_reason():
+    """Return why the tests can't run, None if they can"""
+    if asyncio is None:
+        return "Needs python 3"
+    if shutil.which(PYTHON2) is None:
+        return "Needs %s to run the broker" % PYTHON2
+    return None
+
+@unittest.skipIf(skip_reason() is not None, skip_reason())
+class TestAsyncApi(unittest.TestCase):
+    """
+    Test the asyncio client, worker and subscriber against a broker
+    """
+    broker_ip = "127.0.0.1"
+    broker_port = 5514
+    hostname = "localhost"
+    sleep = 0.5
+
+    def setUp(self):
+        env = dict(os.environ)
+        src = os.path.dirname(os.path.dirname(os.path.abspath(raspy.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([src] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+        self.broker = subprocess.Popen([PYTHON2, "-c", BROKER % (self.hostname, self.broker_ip, self.broker_port)], env=env)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        time.sleep(self.sleep*2)
+        self.client = AsyncMajorDomoClient("tcp://%s:%s" % (self.broker_ip, self.broker_port), loop=self.loop)
+
+    def tearDown(self):
+        self.client.destroy()
+        self.broker.terminate()
+        self.broker.wait()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def wait(self, awaitable, timeout=5.0):
+        """Run the loop until awaitable is done and return its result"""
+        return self.loop.run_until_complete(asyncio.wait_for(awaitable, timeout))
+
+    def echo_worker(self, service):
+        """Start a worker which replies its requests"""
+        worker = AsyncMajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), service, loop=self.loop)
+        def serve(future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            worker.reply([b"echo"] + future.result())
+            worker.recv().add_done_callback(serve)
+        worker.recv().add_done_callback(serve)
+        return worker
+
+    def test_100_client_mmi(self):
+        reply = self.wait(self.client.send("mmi.service", ["mmi.service"]))
+        self.assertEqual(reply, [MDP.T_NOTFOUND.encode()])
+
+    def test_110_client_no_reply(self):
+        self.client.timeout = 100
+        self.client.retries = 2
+        reply = self.wait(self.client.send("nowhere.service", ["request"]))
+        self.assertEqual(reply, None)
+        self.assertEqual(self.client.pending, {})
+
+    def test_120_client_running_loop(self):
+        broker = "tcp://%s:%s" % (self.broker_ip, self.broker_port)
+        self.assertRaises(RuntimeError, AsyncMajorDomoClient, broker)
+        # Created by a callback of the running loop
+        clients = []
+        self.loop.call_soon(lambda: clients.append(AsyncMajorDomoClient(broker)))
+        self.wait(asyncio.sleep(0))
+        client = clients[0]
+        try:
+            self.assertTrue(client.loop is self.loop)
+            reply = self.wait(client.send("mmi.service", ["mmi.service"]))
+            self.assertEqual(reply, [MDP.T_NOTFOUND.encode()])
+        finally:
+            client.destroy()
+
+    def test_200_worker(self):
+        worker = self.echo_worker("async.service")
+        self.wait(asyncio.sleep(self.sleep))
+        replies = self.wait(asyncio.gather(*[self.client.send("async.service", ["request%s" % i]) for i in range(20)]))
+        self.assertEqual(replies, [[b"echo", ("request%s" % i).encode()] for i in range(20)])
+        reply = self.wait(self.client.send("mmi.service", ["async.service"]))
+        self.assertEqual(reply[-1], MDP.T_OK.encode())
+        worker.destroy()
+        # Let the worker get the end of the iteration
+        self.wait(asyncio.sleep(0))
+
+    def test_210_worker_shutdown(self):
+        worker = AsyncMajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "async.service", loop=self.loop)
+        request = worker.recv()
+        worker.shutdown()
+        self.assertRaises(StopAsyncIteration, self.wait, request)
+        worker.destroy()
+
+    def test_220_worker_late_credit(self):
+        worker = AsyncMajorDomoWorker("tcp://%s:%s" % (self.broker_ip, self.broker_port), "async.service", loop=self.loop)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        MDP.logger.addHandler(handler)
+        try:
+            worker.on_message([b'', MDP.W_WORKER.encode(), MDP.W_CREDIT.encode(), b'stream1', b'10'])
+        finally:
+            MDP.logger.removeHandler(handler)
+        self.assertEqual([record for record in records if record.levelno >= logging.ERROR], [])
+        self.assertEqual(len(worker.requests), 0)
+        worker.destroy()
+
+    def test_300_subscriber(self):
+        subtree = "/testasync/"
+        ctx = zmq.Context()
+        publisher = ctx.socket(zmq.PUSH)
+        publisher.linger = 0
+        publisher.connect("tcp://%s:%s" % (self.broker_ip, self.broker_port+3))
+        for i in range(10):
+            KVMsg(0, key=("%skey%s" % (subtree, i)).encode(), body=("value%s" % i).encode()).send(publisher)
+        self.wait(asyncio.sleep(self.sleep))
+        subscriber = AsyncKvSubscriberClient(hostname=self.hostname, subtree=subtree, \
+            broker_ip=self.broker_ip, broker_port=self.broker_port, loop=self.loop, credit=4)
+        update = subscriber.recv()
+        self.wait(asyncio.sleep(self.sleep))
+        # The snapshot is received before the updates
+        self.assertEqual(len(subscriber.kvmap), 10)
+        sequence = subscriber.sequence
+        KVMsg(0, key=("%skey%s" % (subtree, 10)).encode(), body=b"value10").send(publisher)
+        kvmsg = self.wait(update)
+        self.assertEqual(kvmsg.key, ("%skey10" % subtree).encode())
+        self.assertTrue(kvmsg.sequence > sequence)
+        self.assertEqual(len(subscriber.kvmap), 11)
+        subscriber.shutdown()
+        self.assertRaises(StopAsyncIteration, self.wait, subscriber.recv())
+        subscriber.destroy()
+        ctx.destroy(0)
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
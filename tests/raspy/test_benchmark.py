@@ -0,0 +1,394 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for RasPy.
+
+Benchmarks are skipped by default. Launch them with :
+
+    NOSESKIP=False nosetests --nocapture tests/raspy/test_benchmark.py
+"""
+
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import os
+import sys
+import time
+import unittest
+import logging
+import shutil
+import threading
+import multiprocessing
+
+import raspy.common.MDP as MDP
+from raspy.servers.broker import Broker, Proxy, KeyIndex
+from raspy.common.kvsimple import KVMsg
+from raspy.common.mdcliapi import MajorDomoClient, ShardedMajorDomoClient, shard_endpoint
+from raspy.common.mdwrkapi import MajorDomoWorker
+from raspy.servers.shards import ShardedBroker, service_shard
+from raspy.servers.titanic import STORAGES
+from raspy.common import tracing
+from raspy.common.devices.device import BaseDevice
+
+from tests.raspy.common import TestRasPyIP
+
+def shard_echo(front, service):
+    """Run an echo worker on the shard of service"""
+    worker = MajorDomoWorker(shard_endpoint(front, service), service)
+    reply = None
+    while True:
+        reply = worker.recv(reply)
+        if reply is None:
+            break
+
+def shard_client(front, service, rounds, start, done):
+    """Send rounds requests to service once start is set"""
+    client = ShardedMajorDomoClient(front)
+    client.send(service, ["warmup"])
+    start.wait()
+    for i in range(rounds):
+        client.send(service, ["request"])
+    done.put(i + 1)
+    client.destroy()
+
+class TestBenchmark(TestRasPyIP):
+    """
+    Parent class for benchmarks
+    """
+    loglevel = logging.INFO
+
+    def setUp(self):
+        self.skipTest("Benchmark")
+
+    def report(self, name, count, elapsed):
+        print("%-40s : %8d ops in %7.3fs : %10.0f ops/s" % (name, count, elapsed, count/elapsed))
+
+class TestBrokerBenchmark(TestBenchmark):
+    """
+    Benchmarks for the broker bookkeeping
+    """
+    rounds = 20000
+
+    def setUp(self):
+        TestBenchmark.setUp(self)
+        self.broker = Broker(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
+
+    def tearDown(self):
+        self.broker.proxy_thread.ctx.destroy(0)
+        self.broker.destroy()
+        self.broker = None
+
+    def test_100_dispatch_workers(self):
+        client = "bench-client"
+        for count in [10, 100, 1000, 10000]:
+            service = "bench%s.service" % count
+            workers = []
+            for i in range(count):
+                worker = self.broker.require_worker("bench-%s-%05d" % (count, i))
+                worker.service = self.broker.require_service(service)
+                self.broker.worker_waiting(worker)
+                workers.append(worker)
+            waiting = self.broker.services[service].waiting
+            start = time.time()
+            for i in range(self.rounds):
+                worker = waiting[next(iter(waiting))]
+                self.broker.process_client(client, [service, "body"])
+                self.broker.process_worker(worker.address, [MDP.W_REPLY, client, '', "reply"])
+            self.report("Dispatch with %s workers" % count, self.rounds, time.time() - start)
+            for worker in workers:
+                self.broker.delete_worker(worker, False)
+
+    def test_120_idle_workers(self):
+        client = "bench-client"
+        service = "bench.service"
+        rates = []
+        for count in [100, 1000, 10000]:
+            for i in range(count):
+                self.broker.process_worker("idle-%s-%05d" % (count, i), [MDP.W_READY, "idle.service"])
+            worker = "bench-worker-%s" % count
+            self.broker.process_worker(worker, [MDP.W_READY, service])
+            start = time.time()
+            for i in range(self.rounds):
+                self.broker.process_client(client, [service, "body"])
+                self.broker.process_worker(worker, [MDP.W_REPLY, client, '', "reply"])
+                self.broker.process_timers()
+            elapsed = time.time() - start
+            self.report("Broker with %s idle workers" % count, self.rounds, elapsed)
+            rates.append(self.rounds / elapsed)
+            # The worker served all the requests without being disconnected
+            self.assertEqual(self.broker.services[service].workers, 1)
+            self.assertEqual(self.broker.services[service].stats()["replies"], len(rates)*self.rounds)
+            for idle in list(self.broker.workers.values()):
+                self.broker.delete_worker(idle, False)
+        # The idle workers don't slow down the dispatch
+        self.assertTrue(rates[-1] > rates[0] / 2)
+
+    def test_110_tracing(self):
+        client = "bench-client"
+        service = "bench.service"
+        worker = self.broker.require_worker("bench-worker")
+        worker.service = self.broker.require_service(service)
+        self.broker.worker_waiting(worker)
+        # Format the debug traces to /dev/null instead of the console
+        logger = MDP.logger
+        level = logger.level
+        devnull = open(os.devnull, 'w')
+        handler = logging.StreamHandler(devnull)
+        logger.addHandler(handler)
+        logger.propagate = False
+        trace_file = '.raspy_bench_trace'
+        try:
+            for name, loglevel, sample, filename in [
+                    ("off", logging.INFO, 1, None),
+                    ("binary sampled 1/100", logging.INFO, 100, trace_file),
+                    ("binary full", logging.INFO, 1, trace_file),
+                    ("debug sampled 1/100", logging.DEBUG, 100, None),
+                    ("debug full", logging.DEBUG, 1, None),
+                    ]:
+                logger.setLevel(loglevel)
+                tracing.configure(sample=sample, filename=filename)
+                start = time.time()
+                for i in range(self.rounds):
+                    self.broker.process_client(client, [service, "body"])
+                    self.broker.process_worker(worker.address, [MDP.W_REPLY, client, '', "reply"])
+                self.report("Broker with tracing %s" % name, 2*self.rounds, time.time() - start)
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = True
+            devnull.close()
+            logger.setLevel(level)
+            tracing.configure()
+            try:
+                os.unlink(trace_file)
+            except OSError:
+                pass
+
+class TestPayloadBenchmark(TestBenchmark):
+    """
+    Benchmarks for the large bodies through the broker
+    """
+    payloads = [(1024, 5000), (65536, 2000), (1048576, 200)]
+
+    def setUp(self):
+        TestBenchmark.setUp(self)
+        self.broker = Broker(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, proxy=False)
+        thread = threading.Thread(target=self.broker.run)
+        thread.daemon = True
+        thread.start()
+        self.worker = MajorDomoWorker("tcp://%s:%s"%(self.broker_ip, self.broker_port), "bench.echo")
+        # Echo the bodies without copying them
+        self.worker.copy = False
+        def run():
+            reply = None
+            while True:
+                reply = self.worker.recv(reply)
+                if reply is None:
+                    break
+        self.worker_thread = threading.Thread(target=run)
+        self.worker_thread.daemon = True
+        self.worker_thread.start()
+        self.mdclient = MajorDomoClient("tcp://%s:%s"%(self.broker_ip, self.broker_port))
+        time.sleep(self.sleep)
+
+    def tearDown(self):
+        self.worker.shutdown()
+        self.broker.shutdown()
+        # Don't destroy the socket of the worker while it's polling it
+        self.worker_thread.join()
+        time.sleep(self.sleep/4.0)
+        self.mdclient.destroy()
+        self.worker.destroy()
+        self.broker.destroy()
+
+    def test_100_echo(self):
+        for size, count in self.payloads:
+            body = "x" * size
+            start = time.time()
+            for i in range(count):
+                reply = self.mdclient.send("bench.echo", [body])
+            elapsed = time.time() - start
+            self.assertEqual(reply, [body])
+            self.report("Echo %sKB bodies (%.0fMB/s)" % (size // 1024, 2.0*size*count/elapsed/1048576), count, elapsed)
+
+class TestShardBenchmark(TestBenchmark):
+    """
+    Benchmarks for the sharded broker
+    """
+    rounds = 5000
+    clients = 4
+
+    def test_100_throughput(self):
+        front = "tcp://%s:%s" % (self.broker_ip, self.broker_port)
+        # One service in each shard of 4 shards : they are spread on the shards of 2 and 1
+        services = {}
+        i = 0
+        while len(services) < self.clients:
+            services.setdefault(service_shard("bench.service%s" % i, self.clients), "bench.service%s" % i)
+            i += 1
+        rates = {}
+        for shards in [1, 2, 4]:
+            broker = ShardedBroker(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, shards=shards)
+            thread = threading.Thread(target=broker.run)
+            thread.daemon = True
+            thread.start()
+            time.sleep(self.sleep)
+            start = multiprocessing.Event()
+            done = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=shard_echo, args=(front, service)) for service in services.values()]
+            processes += [multiprocessing.Process(target=shard_client, args=(front, service, self.rounds, start, done)) \
+                for service in services.values()]
+            for process in processes:
+                process.daemon = True
+                process.start()
+            time.sleep(self.sleep*2)
+            begin = time.time()
+            start.set()
+            count = sum([done.get() for i in range(self.clients)])
+            elapsed = time.time() - begin
+            self.report("Requests through %s shards" % shards, count, elapsed)
+            rates[shards] = count / elapsed
+            for process in processes:
+                process.terminate()
+                process.join()
+            broker.shutdown()
+            thread.join()
+            broker.destroy()
+        # The shards run in parallel when there are cpus for them, the workers and the clients
+        if multiprocessing.cpu_count() >= 3*self.clients:
+            self.assertTrue(rates[4] > 2*rates[1])
+
+class TestDeviceBenchmark(TestBenchmark):
+    """
+    Benchmarks for the commands of the devices
+    """
+    rounds = 100000
+
+    def test_100_exec_cmd(self):
+        device = BaseDevice()
+        device.add_subdevice('volume', BaseDevice())
+        for oid in ["bench_device", "bench_device-volume"]:
+            start = time.time()
+            for i in range(self.rounds):
+                device.exec_cmd(oid, 'log', True)
+            self.report("Execute commands on %s" % oid, self.rounds, time.time() - start)
+        commands = [("bench_device", 'log', True)] * 100
+        start = time.time()
+        for i in range(self.rounds // 100):
+            device.exec_many(commands)
+        self.report("Execute commands by batches of 100", self.rounds, time.time() - start)
+
+class TestProxyBenchmark(TestBenchmark):
+    """
+    Benchmarks for the key/value proxy
+    """
+    keys = 1000000
+    data_dir = '.raspy_bench'
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.data_dir)
+        except:
+            pass
+
+    def start_proxy(self):
+        return Proxy(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, data_dir=self.data_dir)
+
+    def stop_proxy(self, proxy):
+        proxy.journal.close()
+        proxy.ctx.destroy(0)
+
+    def test_100_restart(self):
+        proxy = self.start_proxy()
+        block = self.keys // 10
+        rates = []
+        start = time.time()
+        for i in range(self.keys):
+            if i % block == 0:
+                block_start = time.time()
+            proxy.update(KVMsg(0, key="/device/host%s/key%07d" % (i % 10, i), body="value%s" % i))
+            if i % block == block - 1:
+                rates.append(block / (time.time() - block_start))
+        self.report("Journal updates", self.keys, time.time() - start)
+        # The updates don't slow down when the proxy holds more keys
+        self.assertTrue(rates[-1] > rates[0] / 2)
+        self.stop_proxy(proxy)
+        start = time.time()
+        proxy = self.start_proxy()
+        self.report("Restart from journal", self.keys, time.time() - start)
+        self.assertEqual(len(proxy.kvmap), self.keys)
+        start = time.time()
+        proxy.compact()
+        self.report("Compaction", self.keys, time.time() - start)
+        self.stop_proxy(proxy)
+        start = time.time()
+        proxy = self.start_proxy()
+        self.report("Restart from snapshot", self.keys, time.time() - start)
+        self.assertEqual(len(proxy.kvmap), self.keys)
+        self.assertEqual(proxy.sequence, self.keys)
+        self.stop_proxy(proxy)
+
+    def test_110_key_index(self):
+        rounds = 100000
+        rates = []
+        for count in [10000, 100000, 1000000]:
+            index = KeyIndex("/device/host%s/key%07d" % (i % 10, i) for i in range(0, 2*count, 2))
+            start = time.time()
+            for i in range(1, 2*rounds, 2):
+                index.add("/device/host%s/key%07d" % (i % 10, i))
+            for i in range(1, 2*rounds, 2):
+                index.remove("/device/host%s/key%07d" % (i % 10, i))
+            elapsed = time.time() - start
+            self.report("Index updates with %s keys" % count, 2*rounds, elapsed)
+            rates.append(2*rounds / elapsed)
+        # The cost of an update is flat
+        self.assertTrue(rates[-1] > rates[0] / 3)
+
+class TestTitanicBenchmark(TestBenchmark):
+    """
+    Benchmarks for the titanic storages
+    """
+    requests = 10000
+    data_dir = '.raspy_bench'
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.data_dir)
+        except:
+            pass
+
+    def test_100_storages(self):
+        for name in sorted(STORAGES):
+            storage = STORAGES[name]("%s/%s" % (self.data_dir, name))
+            uuids = ["%032x" % i for i in range(self.requests)]
+            start = time.time()
+            for uuid in uuids:
+                storage.put_request(uuid, ["echo", "request"])
+            for uuid in uuids:
+                storage.get_request(uuid)
+                storage.put_reply(uuid, ["reply"])
+            for uuid in uuids:
+                storage.get_reply(uuid)
+                storage.close_request(uuid)
+            self.report("Titanic %s storage" % name, self.requests, time.time() - start)
+            storage.close()
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
@@ -23,8 +23,9 @@ __license__ = """
 __author__ = 'Sébastien GALLET aka bibi21000'
 __email__ = 'bibi21000@gmail.com'
 
-import sys
+import sys, os
 import time
+import json
 import unittest
 from pprint import pprint
 
@@ -32,7 +33,9 @@ import raspy.common.MDP as MDP
 from raspy.servers.broker import Broker
 from raspy.servers.titanic import Titanic
 from raspy.servers.fake import Fake
-from raspy.common.mdcliapi import MajorDomoClient
+from raspy.common.mdcliapi import MajorDomoClient, MajorDomoAsyncClient
+from raspy.common.devices.device import DReg
+import raspy.common.devices.media
 import threading
 import logging
 
@@ -41,8 +44,10 @@ from tests.raspy.common import TestServer, ServerBase
 class TestFake(TestServer, ServerBase):
     service="fake"
 
-    def startServer(self):
+    def startServer(self, devices=[]):
         self.server = Fake(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
+        for device in devices:
+            self.server.add_device(device)
         self.server_thread = threading.Thread(target=self.server.run)
         self.server_thread.daemon = True
         self.server_thread.start()
@@ -72,6 +77,63 @@ class TestFake(TestServer, ServerBase):
         self.assertEqual(reply[-1], MDP.T_NOTIMPLEMENTED)
         self.stopServer()
 
+    def test_110_devices_pool(self):
+        self.server = Fake(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
+        conffile = os.path.join('.raspy_test', 'fake.ini')
+        with open(conffile, 'w') as f:
+            f.write("[Pools]\ndevices = 3\n")
+        self.server.configure_pools(conffile)
+        self.server_thread = threading.Thread(target=self.server.run)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        time.sleep(self.sleep/4.0)
+        service = "%s.devices"%MDP.routing_key(self.hostname, self.service)
+        self.assertEqual(len(self.broker.services[service].waiting), 3)
+        request = "list_keys"
+        reply = self.mdclient.send(service, request)
+        self.assertNotEqual(reply, None)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.stopServer()
+
+    def test_111_devices_pool_conffile(self):
+        conffile = os.path.join('.raspy_test', 'fake.ini')
+        with open(conffile, 'w') as f:
+            f.write("[Pools]\ndevices = 2\n")
+        self.server = Fake(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, conffile=conffile)
+        self.server_thread = threading.Thread(target=self.server.run)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        time.sleep(self.sleep/4.0)
+        # The pools are configured when the server starts
+        self.assertEqual(self.server.worker_devices_pool.size, 2)
+        service = "%s.devices"%MDP.routing_key(self.hostname, self.service)
+        self.assertEqual(len(self.broker.services[service].waiting), 2)
+        self.stopServer()
+
+    def test_120_devices_exec(self):
+        filename = os.path.join('.raspy_test', 'camera.jpg')
+        data = os.urandom(200000)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        camera = DReg.new(json=json.dumps({'oid' : 'media.camera', 'name' : 'camera1', 'image' : filename}))
+        self.startServer([camera])
+        service = "%s.devices"%MDP.routing_key(self.hostname, self.service)
+        reply = self.mdclient.send(service, ["exec", "camera1", "log", "true"])
+        self.assertEqual(reply, ["true", MDP.T_OK])
+        reply = self.mdclient.send(service, ["exec", "nocamera", "log"])
+        self.assertEqual(reply, [MDP.T_NOTFOUND])
+        # The image of the camera is streamed by chunks
+        client = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip, self.broker_port))
+        try:
+            stream = client.stream(service, ["exec", "camera1", "image"])
+            chunks = list(stream)
+            self.assertEqual(stream.final, MDP.T_OK)
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(''.join(chunks), data)
+        finally:
+            client.destroy()
+        self.stopServer()
+
 if __name__ == '__main__':
     sys.argv.append('-v')
     unittest.main()
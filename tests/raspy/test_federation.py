@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unittests for the federation of brokers.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import sys
+import time
+import unittest
+import threading
+
+import raspy.common.MDP as MDP
+from raspy.servers.broker import Broker
+from raspy.common.mdcliapi import MajorDomoClient, MajorDomoAsyncClient
+from raspy.common.mdwrkapi import MajorDomoWorker
+
+from tests.raspy.common import TestRasPyIP
+
+class TestFederation(TestRasPyIP):
+    """
+    Test two peered brokers
+    """
+    peer_port = 5524
+
+    def setUp(self):
+        self.brokers = [
+            Broker(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, \
+                peers=["tcp://%s:%s" % (self.broker_ip, self.peer_port)]),
+            Broker(hostname="peer", broker_ip=self.broker_ip, broker_port=self.peer_port, \
+                peers=["tcp://%s:%s" % (self.broker_ip, self.broker_port)]),
+        ]
+        for broker in self.brokers:
+            broker.PEER_INTERVAL = 100
+            thread = threading.Thread(target=broker.run)
+            thread.daemon = True
+            thread.start()
+        self.workers = []
+        time.sleep(self.sleep/4.0)
+        self.mdclient = MajorDomoClient("tcp://%s:%s"%(self.broker_ip,self.broker_port))
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.shutdown()
+        for broker in self.brokers:
+            broker.shutdown()
+        time.sleep(self.sleep/4.0)
+        self.mdclient.destroy()
+        for worker in self.workers:
+            worker.destroy()
+        for broker in self.brokers:
+            broker.destroy()
+
+    def start_echo(self, port, service):
+        """Start an echo worker for service on the broker at port"""
+        worker = MajorDomoWorker("tcp://%s:%s"%(self.broker_ip, port), service)
+        self.workers.append(worker)
+        def run():
+            reply = None
+            while True:
+                request = worker.recv(reply)
+                if request is None:
+                    break
+                if request[0] == "stream":
+                    worker.stream(["chunk%s" % i for i in range(int(request[1]))], credit=2)
+                    reply = None
+                else:
+                    reply = request + [service]
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def test_100_forward(self):
+        self.start_echo(self.peer_port, "peer.echo")
+        time.sleep(self.sleep)
+        reply = self.mdclient.send("mmi.service", ["peer.echo"])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        reply = self.mdclient.send("mmi.discovery", ["^peer\\."])
+        self.assertEqual(reply, ["peer.echo", MDP.T_OK])
+        reply = self.mdclient.send("peer.echo", ["hello"])
+        self.assertEqual(reply, ["hello", "peer.echo"])
+
+    def test_110_local_first(self):
+        self.start_echo(self.peer_port, "both.echo")
+        time.sleep(self.sleep)
+        reply = self.mdclient.send("both.echo", ["hello"])
+        self.assertEqual(reply, ["hello", "both.echo"])
+        self.assertFalse("both.echo" in self.brokers[0].services)
+        self.start_echo(self.broker_port, "both.echo")
+        time.sleep(self.sleep)
+        reply = self.mdclient.send("both.echo", ["hello"])
+        self.assertEqual(reply, ["hello", "both.echo"])
+        self.assertEqual(self.brokers[0].services["both.echo"].stats()["requests"], 1)
+
+    def test_115_stream(self):
+        self.start_echo(self.peer_port, "peer.echo")
+        time.sleep(self.sleep)
+        client = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip, self.broker_port))
+        try:
+            stream = client.stream("peer.echo", ["stream", "10"])
+            self.assertEqual(list(stream), ["chunk%s" % i for i in range(10)])
+            self.assertEqual(self.brokers[0].remote_streams, {})
+        finally:
+            client.destroy()
+
+    def test_120_peer_down(self):
+        self.start_echo(self.peer_port, "peer.echo")
+        time.sleep(self.sleep)
+        reply = self.mdclient.send("mmi.service", ["peer.echo"])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.brokers[1].shutdown()
+        # The directory expires after HEARTBEAT_LIVENESS intervals
+        time.sleep(self.sleep*2)
+        reply = self.mdclient.send("mmi.service", ["peer.echo"])
+        self.assertEqual(reply[-1], MDP.T_NOTFOUND)
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
@@ -34,7 +34,7 @@ import raspy.common.MDP as MDP
 from raspy.servers.broker import Broker
 from raspy.servers.titanic import Titanic
 from raspy.servers.logger import Logger, RrdCachedClient
-from raspy.common.mdcliapi import MajorDomoClient
+from raspy.common.mdcliapi import MajorDomoClient, MajorDomoAsyncClient
 import threading
 import logging
 from urllib2 import urlopen
@@ -75,6 +75,25 @@ class TestLogger(TestServer, ServerBase):
         self.assertEqual(reply[-1], MDP.T_OK)
         self.stopServer()
 
+    def test_110_logger_log_stream(self):
+        self.startServer()
+        data = os.urandom(300000)
+        if not os.path.isdir(self.server.data_dir):
+            os.makedirs(self.server.data_dir)
+        filename = os.path.join(self.server.data_dir, 'test_stream.log')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        client = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip, self.broker_port))
+        try:
+            stream = client.stream("%s.log"%MDP.routing_key(self.hostname, self.service), ["stream", "test_stream.log"])
+            self.assertEqual(''.join(stream), data)
+            reply = client.send("%s.log"%MDP.routing_key(self.hostname, self.service), ["stream", "none.log"])
+            self.assertEqual(reply, [MDP.T_NOTFOUND])
+        finally:
+            client.destroy()
+            os.unlink(filename)
+        self.stopServer()
+
     def test_500_http_server(self):
         self.startServer()
         url = "http://127.0.0.1:%s" % (self.broker_port+4)
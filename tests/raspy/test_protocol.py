@@ -25,15 +25,19 @@ __author__ = 'Sébastien GALLET aka bibi21000'
 __email__ = 'bibi21000@gmail.com'
 
 import sys
+import os
+import json
 import time
+import random
 import unittest
 from pprint import pprint
 import threading
 
 import raspy.common.MDP as MDP
-from raspy.servers.broker import Broker
-from raspy.servers.titanic import Titanic
-from raspy.common.mdcliapi import MajorDomoClient, TitanicClient
+from raspy.servers.broker import Broker, Proxy, KeyIndex, Service, regex_prefix
+from raspy.servers.titanic import Titanic, STORAGES, PendingQueue, ConfigStore, Dispatcher
+from raspy.common.mdcliapi import MajorDomoClient, MajorDomoAsyncClient, MajorDomoFuture, TitanicClient
+from raspy.common import mdcliapi
 from raspy.common.mdwrkapi import MajorDomoWorker
 from raspy.common.server import Server
 from raspy.common.kvsimple import KVMsg
@@ -50,13 +54,27 @@ class TestProtocol(TestRasPyIP):
     Test ZMQ protocols : Majordomo, titanic and subtree publisher
     """
     service=""
+    ctx = None
+
     def tearDown(self):
         #pass
+        if self.ctx is not None:
+            self.ctx.destroy(0)
+            self.ctx = None
         try:
             shutil.rmtree('.raspy_test2')
         except:
             pass
 
+    def kv_pipe(self):
+        """Return a pair of connected sockets to exchange kv messages"""
+        self.ctx = zmq.Context()
+        output = self.ctx.socket(zmq.DEALER)
+        output.bind("inproc://kvmsg_selftest")
+        input = self.ctx.socket(zmq.DEALER)
+        input.connect("inproc://kvmsg_selftest")
+        return output, input
+
     def test_001_start_wait_and_stop(self):
         self.broker = Server(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
         self.broker_thread = threading.Thread(target=self.broker.run)
@@ -75,11 +93,7 @@ class TestProtocol(TestRasPyIP):
         time.sleep(self.sleep)
 
     def test_100_kv_msg(self):
-        ctx = zmq.Context()
-        output = ctx.socket(zmq.DEALER)
-        output.bind("ipc://kvmsg_selftest.ipc")
-        input = ctx.socket(zmq.DEALER)
-        input.connect("ipc://kvmsg_selftest.ipc")
+        output, input = self.kv_pipe()
         kvmap = {}
         kvmsg = KVMsg(1)
         kvmsg.key = "key"
@@ -92,6 +106,412 @@ class TestProtocol(TestRasPyIP):
         self.assertTrue(len(kvmap) == 1)
         self.assertTrue(kvmsg.dump() is not None)
 
+    def test_101_kv_msg_properties(self):
+        output, input = self.kv_pipe()
+        kvmsg = KVMsg(2**40+1, key="key", body="body")
+        kvmsg.send(output)
+        kvmsg2 = KVMsg.recv(input)
+        self.assertEqual(kvmsg2.sequence, 2**40+1)
+        self.assertEqual(kvmsg2.ttl, 0)
+        self.assertEqual(kvmsg2.uuid, None)
+        kvmsg = KVMsg(2**64-1, key="key", body="body", timestamp=1000.5, ttl=30, uuid="0123456789abcdef")
+        kvmsg.send(output)
+        kvmsg2 = KVMsg.recv(input)
+        self.assertEqual(kvmsg2.sequence, 2**64-1)
+        self.assertEqual(kvmsg2.timestamp, 1000.5)
+        self.assertEqual(kvmsg2.ttl, 30)
+        self.assertEqual(kvmsg2.uuid, "0123456789abcdef")
+        kvmsg3 = KVMsg.unpack(kvmsg.pack())
+        self.assertEqual(kvmsg3.sequence, 2**64-1)
+        self.assertEqual(kvmsg3.key, "key")
+        self.assertEqual(kvmsg3.body, "body")
+        self.assertEqual(kvmsg3.ttl, 30)
+        self.assertEqual(kvmsg3.uuid, "0123456789abcdef")
+
+    def test_102_kv_ttl(self):
+        proxy = Proxy(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
+        proxy.update(KVMsg(0, key="/test/key1", body="value1", ttl=1))
+        proxy.update(KVMsg(0, key="/test/key2", body="value2", ttl=1))
+        proxy.update(KVMsg(0, key="/test/key2", body="value22"))
+        self.assertTrue(proxy.kvmap["/test/key1"].timestamp > 0)
+        proxy.expire()
+        self.assertTrue("/test/key1" in proxy.kvmap)
+        time.sleep(1.1)
+        proxy.expire()
+        self.assertFalse("/test/key1" in proxy.kvmap)
+        self.assertEqual(proxy.kvmap["/test/key2"].body, "value22")
+        self.assertEqual(proxy.index.prefix("/test/"), ["/test/key2"])
+        proxy.ctx.destroy(0)
+
+    def test_103_kv_snapshot_requests(self):
+        proxy = Proxy(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
+        proxy.update(KVMsg(0, key="/test/key1", body="value1"))
+        proxy.update(KVMsg(0, key="/other/key1", body="value1"))
+        # Bad credits are ignored
+        proxy.process_snapshot(["client1", "ICANHAZ?", "/test/", "bad"])
+        proxy.process_snapshot(["client1", "CREDIT", "bad"])
+        self.assertEqual(proxy.routes, {})
+        # A client can request many subtrees at once
+        proxy.process_snapshot(["client1", "ICANHAZ?", "/test/", "0"])
+        proxy.process_snapshot(["client1", "ICANHAZ?", "/other/", "0"])
+        self.assertEqual(len(proxy.routes), 2)
+        # A request for a subtree in progress doesn't restart it
+        proxy.process_snapshot(["client1", "ICANHAZ?", "/test/", "5"])
+        self.assertEqual(proxy.routes[("client1", "/test/")].credit, 0)
+        proxy.process_snapshot(["client1", "CREDIT", "2", "/test/"])
+        self.assertEqual(proxy.routes[("client1", "/test/")].credit, 2)
+        self.assertEqual(proxy.routes[("client1", "/other/")].credit, 0)
+        proxy.process_snapshot(["client1", "CREDIT", "1"])
+        self.assertEqual(proxy.routes[("client1", "/test/")].credit, 3)
+        self.assertEqual(proxy.routes[("client1", "/other/")].credit, 1)
+        proxy.ctx.destroy(0)
+
+    def test_110_key_index(self):
+        index = KeyIndex(["/b/1", "/a/2", "/a/1"])
+        index.add("/a/3")
+        index.add("/a/1")
+        index.add("/ab/1")
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.prefix("/a/"), ["/a/1", "/a/2", "/a/3"])
+        self.assertEqual(index.prefix("/a"), ["/a/1", "/a/2", "/a/3", "/ab/1"])
+        self.assertEqual(index.prefix("/c/"), [])
+        self.assertEqual(len(index.prefix("")), 5)
+        index.remove("/a/2")
+        index.remove("/a/4")
+        self.assertEqual(index.prefix("/a/"), ["/a/1", "/a/3"])
+        self.assertEqual(list(index), ["/a/1", "/a/3", "/ab/1", "/b/1"])
+
+    def test_112_key_index_chunks(self):
+        index = KeyIndex(["/a/%03d" % i for i in range(0, 100, 2)])
+        index.CHUNK = 4
+        keys = set("/a/%03d" % i for i in range(0, 100, 2))
+        rand = random.Random(12)
+        for i in range(2000):
+            key = "/%s/%03d" % (rand.choice("abc"), rand.randint(0, 150))
+            if rand.random() < 0.6:
+                index.add(key)
+                keys.add(key)
+            else:
+                index.remove(key)
+                keys.discard(key)
+            self.assertEqual(len(index), len(keys))
+        self.assertEqual(list(index), sorted(keys))
+        self.assertTrue(max(len(chunk) for chunk in index.chunks) <= 8)
+        self.assertEqual(index.maxes, [chunk[-1] for chunk in index.chunks])
+        for prefix in ["/a/", "/b/0", "/c/1", "/d/", "/", ""]:
+            self.assertEqual(index.prefix(prefix), sorted(key for key in keys if key.startswith(prefix)))
+        for key in list(keys):
+            index.remove(key)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.prefix("/a/"), [])
+
+    def test_111_regex_prefix(self):
+        self.assertEqual(regex_prefix(".*\\.devices\\..*"), "")
+        self.assertEqual(regex_prefix("^host1\\.devices\\..*"), "host1.devices.")
+        self.assertEqual(regex_prefix("^host1"), "host1")
+        self.assertEqual(regex_prefix("^hosts?\\."), "host")
+        self.assertEqual(regex_prefix("^host[12]"), "host")
+        self.assertEqual(regex_prefix("^host1|host2"), "")
+        self.assertEqual(regex_prefix("^host\\d"), "host")
+
+    def test_115_service_priority_queue(self):
+        service = Service("test.service")
+        now = time.time()
+        service.queue(["low1"], now)
+        service.queue(["high"], now, priority=5)
+        service.queue(["expired"], now, deadline=now - 1, priority=9)
+        service.queue(["low2"], now)
+        self.assertEqual(len(service.requests), 4)
+        self.assertEqual(service.next_request(now), (now, ["high"]))
+        self.assertEqual(service.next_request(now), (now, ["low1"]))
+        self.assertEqual(service.next_request(now), (now, ["low2"]))
+        self.assertEqual(service.next_request(now), None)
+        self.assertEqual(service.expired_count.get(), 1)
+        service.queue(["alive"], now, deadline=now + 10)
+        service.queue(["expired"], now, deadline=now - 1)
+        service.drop_expired(now)
+        self.assertEqual(len(service.requests), 1)
+        self.assertEqual(service.expired_count.get(), 2)
+
+    def test_116_client_header(self):
+        self.assertEqual(MDP.client_header("echo"), [MDP.C_CLIENT, "echo"])
+        self.assertEqual(MDP.client_header("echo", deadline=500), [MDP.C_CLIENT_QOS, "500", "", "echo"])
+        self.assertEqual(MDP.client_header("echo", priority=2), [MDP.C_CLIENT_QOS, "", "2", "echo"])
+
+    def test_120_kv_persistence(self):
+        proxy = Proxy(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, data_dir='.raspy_test2')
+        for i in range(10):
+            proxy.update(KVMsg(0, key="/test/key%s" % i, body="value%s" % i))
+        proxy.update(KVMsg(0, key="/test/key3", body="value33"))
+        proxy.update(KVMsg(0, key="/test/key5"))
+        self.assertEqual(proxy.sequence, 12)
+        proxy.journal.close()
+        proxy.ctx.destroy(0)
+        proxy = Proxy(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, data_dir='.raspy_test2')
+        self.assertEqual(proxy.sequence, 12)
+        self.assertEqual(len(proxy.kvmap), 9)
+        self.assertEqual(proxy.kvmap["/test/key3"].body, "value33")
+        self.assertFalse("/test/key5" in proxy.kvmap)
+        self.assertEqual(len(proxy.index.prefix("/test/")), 9)
+        proxy.compact()
+        proxy.update(KVMsg(0, key="/test/key9"))
+        proxy.journal.close()
+        proxy.ctx.destroy(0)
+        proxy = Proxy(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, data_dir='.raspy_test2')
+        self.assertEqual(proxy.sequence, 13)
+        self.assertEqual(len(proxy.kvmap), 8)
+        self.assertEqual(proxy.kvmap["/test/key3"].body, "value33")
+        proxy.update(KVMsg(0, key="/test/key10", body="value10"))
+        self.assertEqual(proxy.sequence, 14)
+        proxy.journal.close()
+        proxy.ctx.destroy(0)
+
+    def test_130_titanic_storage(self):
+        for name in STORAGES:
+            storage = STORAGES[name]('.raspy_test2/%s' % name)
+            for i in range(10):
+                storage.put_request("%032x" % i, ["echo", "request%s" % i])
+            for i in range(5):
+                storage.put_reply("%032x" % i, ["reply%s" % i])
+            storage.close_request("%032x" % 0)
+            self.assertFalse(storage.has_request("%032x" % 0))
+            self.assertEqual(storage.get_request("%032x" % 0), None)
+            self.assertEqual(storage.get_request("%032x" % 1), ["echo", "request1"])
+            self.assertEqual(storage.get_reply("%032x" % 1), ["reply1"])
+            self.assertEqual(storage.get_reply("%032x" % 6), None)
+            self.assertTrue(storage.has_request("%032x" % 6))
+            storage.close()
+            storage = STORAGES[name]('.raspy_test2/%s' % name)
+            self.assertFalse(storage.has_request("%032x" % 0))
+            self.assertEqual(storage.get_reply("%032x" % 4), ["reply4"])
+            self.assertEqual(storage.get_request("%032x" % 9), ["echo", "request9"])
+            storage.close()
+
+    def test_131_titanic_journal_compact(self):
+        storage = STORAGES['journal']('.raspy_test2')
+        for i in range(100):
+            storage.put_request("%032x" % i, ["echo", "request%s" % i])
+            storage.put_reply("%032x" % i, ["reply%s" % i])
+            if i % 2 == 0:
+                storage.close_request("%032x" % i)
+        storage.compact()
+        storage.put_request("%032x" % 100, ["echo", "request100"])
+        storage.close()
+        storage = STORAGES['journal']('.raspy_test2')
+        self.assertEqual(len(storage.index), 51)
+        self.assertEqual(storage.get_reply("%032x" % 99), ["reply99"])
+        self.assertFalse(storage.has_request("%032x" % 98))
+        storage.close()
+
+    def test_132_titanic_pending_queue(self):
+        os.makedirs('.raspy_test2')
+        with open('.raspy_test2/queue', 'w') as f:
+            f.write("+%032x\n-%032x\n" % (1000, 1001))
+        queue = PendingQueue('.raspy_test2')
+        self.assertFalse(os.path.exists('.raspy_test2/queue'))
+        self.assertEqual(queue.uuids(), ["%032x" % 1001])
+        queue.COMPACT_MIN = 10
+        for i in range(100):
+            queue.add("%032x" % i)
+        for i in range(0, 100, 3):
+            queue.done("%032x" % i)
+        queue.done("%032x" % 1001)
+        self.assertEqual(len(queue), 66)
+        queue.close()
+        queue = PendingQueue('.raspy_test2')
+        self.assertEqual(len(queue), 66)
+        self.assertEqual(queue.uuids()[0], "%032x" % 1)
+        queue.close()
+
+    def test_133_titanic_dispatcher(self):
+        storage = CountingStorage()
+        queue = PendingQueue('.raspy_test2')
+        for i in range(30):
+            storage.requests["slow%02d" % i] = ["slow.service", "request%s" % i]
+            queue.add("slow%02d" % i)
+        for i in range(5):
+            storage.requests["dead%02d" % i] = ["dead.service", "request%s" % i]
+            queue.add("dead%02d" % i)
+        queue.add("closed")
+        client = FakeAsyncClient()
+        dispatcher = Dispatcher(client, storage, queue, window=10)
+        self.assertEqual(storage.reads, 36)
+        self.assertEqual(queue.uuids()[-1], "dead04")
+        storage.reads = 0
+        dispatcher.dispatch()
+        # The services are checked before any read
+        self.assertEqual(storage.reads, 0)
+        self.assertEqual(sorted(sent[0:2] for sent in client.sent), [("mmi.service", ["dead.service"]), ("mmi.service", ["slow.service"])])
+        for service, request, future in client.sent:
+            future.set_result([MDP.T_OK] if request == ["slow.service"] else [MDP.T_NOTFOUND])
+        client.sent = []
+        dispatcher.dispatch()
+        # Only the requests which fill the window are read
+        self.assertEqual(storage.reads, 10)
+        self.assertEqual([request for service, request, future in client.sent], [["request%s" % i] for i in range(10)])
+        dispatcher.dispatch()
+        self.assertEqual(storage.reads, 10)
+        client.sent[0][2].set_result(["reply0"])
+        client.sent[1][2].set_result(None)
+        self.assertEqual(storage.replies, {"slow00" : ["reply0"]})
+        stats = dispatcher.stats()
+        self.assertEqual(stats["slow.service"]["depth"], 29)
+        self.assertEqual(stats["slow.service"]["inflight"], 8)
+        self.assertEqual(stats["dead.service"]["depth"], 5)
+        # The request without reply is sent again after the backoff
+        dispatcher.services["slow.service"].retry_at = 0
+        dispatcher.services["slow.service"].checked_until = time.time() + 60
+        dispatcher.services["slow.service"].available = True
+        dispatcher.dispatch()
+        self.assertEqual(storage.reads, 12)
+        self.assertEqual([request for service, request, future in client.sent[10:]], [["request1"], ["request10"]])
+        # A whole window without reply backs off once
+        state = dispatcher.services["slow.service"]
+        self.assertEqual(state.backoff, Dispatcher.BACKOFF_MIN)
+        for service, request, future in client.sent:
+            if not future.done():
+                future.set_result(None)
+        self.assertEqual(state.inflight, 0)
+        self.assertEqual(state.backoff, 2*Dispatcher.BACKOFF_MIN)
+        # The cached mmi.service is refreshed while the requests are dispatched
+        state.retry_at = 0
+        state.checked_until = 0
+        state.available = True
+        client.sent = []
+        dispatcher.dispatch()
+        self.assertEqual(client.sent[0][0:2], ("mmi.service", ["slow.service"]))
+        self.assertEqual(len(client.sent), 1 + 10)
+        # Until it says that the service is down
+        client.sent[0][2].set_result([MDP.T_NOTFOUND])
+        self.assertFalse(state.available)
+        self.assertEqual(state.backoff, 4*Dispatcher.BACKOFF_MIN)
+        queue.close()
+
+    def test_140_config_store(self):
+        store = ConfigStore('.raspy_test2', flush_interval=60)
+        store.set("testservice", "section1", "key1", "value1")
+        store.mset("testservice", {"section1" : {"key2" : "value2"}, "section2" : {"key3" : "value3"}})
+        self.assertEqual(store.get("testservice", "section1", "key1"), "value1")
+        self.assertEqual(store.get("testservice", "section2", "key3"), "value3")
+        self.assertEqual(store.get("testservice", "section2", "badkey"), None)
+        self.assertFalse(os.path.exists(store.filename("testservice")))
+        store.flush()
+        self.assertFalse(os.path.exists(store.filename("testservice")))
+        store.flush(force=True)
+        self.assertTrue(os.path.exists(store.filename("testservice")))
+        store = ConfigStore('.raspy_test2', flush_interval=0)
+        self.assertEqual(store.mget("testservice"), \
+            {"section1" : {"key1" : "value1", "key2" : "value2"}, "section2" : {"key3" : "value3"}})
+        store.remove("testservice")
+        self.assertFalse(os.path.exists(store.filename("testservice")))
+
+class FakeClock(object):
+    """A clock for tests"""
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+class FakeMajorDomoClient(object):
+    """Titanic services for tests : the requests are pending until their reply is set"""
+    def __init__(self):
+        self.replies = {}
+        self.closed = []
+    def send(self, service, request):
+        if service == "titanic.close":
+            self.closed += request
+            return [MDP.T_OK]
+        frames = [self.replies.get(uuid, [MDP.T_PENDING]) for uuid in request]
+        if len(request) == 1:
+            return list(frames[0])
+        reply = []
+        for uuid, frame in zip(request, frames):
+            reply += [uuid, frame[0], "%s" % (len(frame)-1)] + frame[1:]
+        return reply
+    def destroy(self):
+        pass
+
+class FakeAsyncClient(object):
+    """An asynchronous client for tests : the futures are resolved by the test"""
+    def __init__(self):
+        self.sent = []
+    def send_async(self, service, request):
+        future = MajorDomoFuture(self, service, "%x" % len(self.sent))
+        self.sent.append((service, request, future))
+        return future
+
+class CountingStorage(object):
+    """A storage for tests which counts the reads of the requests"""
+    def __init__(self):
+        self.requests = {}
+        self.replies = {}
+        self.reads = 0
+    def get_request(self, uuid):
+        self.reads += 1
+        request = self.requests.get(uuid)
+        return None if request is None else list(request)
+    def put_reply(self, uuid, reply):
+        self.replies[uuid] = reply
+
+class TestTitanicClient(TestRasPyIP):
+    """
+    Test the scheduler of the titanic client with a fake clock
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.client = TitanicClient(broker_ip=self.broker_ip, broker_port=self.broker_port, poll=125, recheck=1000, clock=self.clock)
+        self.client.client.destroy()
+        self.client.client = FakeMajorDomoClient()
+
+    def tearDown(self):
+        self.client.destroy()
+
+    def test_100_poll_backoff(self):
+        self.client.track("uuid1")
+        self.assertEqual(self.client.due(self.clock()), [])
+        self.assertEqual(self.client.timeout(self.clock()), 125)
+        schedule = []
+        for i in range(48):
+            self.clock.now += 0.125
+            if self.client.due(self.clock()) == ["uuid1"]:
+                schedule.append(self.clock.now - 1000.0)
+        self.assertEqual(schedule, [0.125, 0.375, 0.875, 1.875, 2.875, 3.875, 4.875, 5.875])
+        self.assertEqual(self.client.timeout(self.clock()), 875)
+
+    def test_110_poll_metrics(self):
+        self.client.track("uuid1")
+        self.client.track("uuid2")
+        self.clock.now += 0.125
+        self.client.fetch(self.client.due(self.clock()))
+        stats = self.client.stats()
+        self.assertEqual(stats['polls'], 1)
+        self.assertEqual(stats['empty_polls'], 2)
+        self.assertEqual(stats['pending'], 2)
+        self.client.client.replies["uuid1"] = [MDP.T_OK, "reply1"]
+        self.clock.now += 0.25
+        self.client.fetch(self.client.due(self.clock()))
+        stats = self.client.stats()
+        self.assertEqual(stats['polls'], 2)
+        self.assertEqual(stats['empty_polls'], 3)
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['latency_avg'], 0.375)
+        self.assertEqual(stats['latency_max'], 0.375)
+        self.assertEqual(stats['pending'], 1)
+        self.assertEqual(self.client.client.closed, ["uuid1"])
+        self.assertEqual(self.client.status("uuid1"), [MDP.T_OK])
+        self.assertEqual(self.client.status("uuid2"), [MDP.T_PENDING])
+
+    def test_120_monotonic_clock(self):
+        self.assertFalse(mdcliapi.monotonic is time.time)
+        last = mdcliapi.monotonic()
+        for i in range(1000):
+            now = mdcliapi.monotonic()
+            self.assertTrue(now >= last)
+            last = now
+        time.sleep(0.05)
+        self.assertTrue(0.04 < mdcliapi.monotonic() - last < 1)
+
 class TestMajordomo(TestExecutive):
     service=''
 
@@ -140,6 +560,180 @@ class TestMajordomo(TestExecutive):
         self.assertFalse("titanic.store" in reply)
         self.assertEqual(reply[-1], MDP.T_OK)
 
+    def test_103_mmi_discovery_live(self):
+        # A request to a service without worker creates it in the broker
+        reply = self.mdclient.send("mmi.service", ["titanic.nothing"])
+        self.assertEqual(reply[-1], MDP.T_NOTFOUND)
+        client = MajorDomoClient("tcp://%s:%s"%(self.broker_ip,self.broker_port))
+        client.timeout = 100
+        client.retries = 1
+        self.assertEqual(client.send("titanic.nothing", ["request"], deadline=100), None)
+        client.destroy()
+        reply = self.mdclient.send("mmi.discovery", ["^titanic\\."])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.assertTrue("titanic.request" in reply)
+        self.assertFalse("titanic.nothing" in reply)
+        self.assertEqual(reply[:-1], sorted(reply[:-1]))
+        reply = self.mdclient.send("mmi.discovery", ["(bad"])
+        self.assertEqual(reply[-1], MDP.T_NOTIMPLEMENTED)
+
+    def test_110_mmi_stats(self):
+        request = ["get"] + ["badservice"] + ["badsection"] + ["badkey"]
+        for i in range(5):
+            reply = self.mdclient.send("titanic.store", request)
+            self.assertNotEqual(reply, None)
+        reply = self.mdclient.send("mmi.stats", ["titanic.store"])
+        self.assertNotEqual(reply, None)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        stats = json.loads(reply[0])
+        self.assertEqual(stats["requests"], 5)
+        self.assertEqual(stats["replies"], 5)
+        self.assertEqual(stats["queue"], 0)
+        self.assertEqual(stats["workers"], 1)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(stats["latency"]["count"], 5)
+        reply = self.mdclient.send("mmi.stats", [""])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        stats = json.loads(reply[0])
+        self.assertTrue("titanic.store" in stats)
+        self.assertTrue("titanic.request" in stats)
+        reply = self.mdclient.send("mmi.stats", ["badservice"])
+        self.assertEqual(reply[-1], MDP.T_NOTFOUND)
+
+    def test_112_overload(self):
+        self.broker.MAX_QUEUE = 2
+        client = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip,self.broker_port))
+        client.retries = 1
+        futures = [client.send_async("overload.service", ["request"], deadline=200) for i in range(2)]
+        future = client.send_async("overload.service", ["request"], priority=1)
+        self.assertEqual(future.result(), [MDP.T_OVERLOAD])
+        time.sleep(0.3)
+        # The expired requests make room for a new one
+        future = client.send_async("overload.service", ["request"])
+        reply = self.mdclient.send("mmi.stats", ["overload.service"])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        stats = json.loads(reply[0])
+        self.assertEqual(stats["overload"], 1)
+        self.assertEqual(stats["expired"], 2)
+        self.assertEqual(stats["queue"], 1)
+        client.destroy()
+
+    def test_111_stats_published(self):
+        subscriber = KvSubscriberClient(hostname=self.hostname, subtree="/stats/broker/", broker_ip=self.broker_ip, broker_port=self.broker_port)
+        subscriber_thread = threading.Thread(target=subscriber.run)
+        subscriber_thread.daemon = True
+        subscriber_thread.start()
+        time.sleep(self.sleep)
+        self.broker.stats_at = 0
+        reply = self.mdclient.send("mmi.service", ["titanic.store"])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        time.sleep(self.sleep)
+        self.assertTrue("/stats/broker/titanic.store" in subscriber.kvmap)
+        stats = json.loads(subscriber.kvmap["/stats/broker/titanic.store"].body)
+        self.assertEqual(stats["workers"], 1)
+        subscriber.shutdown()
+        time.sleep(self.sleep/4.0)
+        subscriber.destroy()
+
+    def test_200_async_client_many(self):
+        client = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip,self.broker_port))
+        futures = [client.send_async("mmi.service", ["titanic.request"]) for i in range(100)]
+        futures += [client.send_async("mmi.service", ["badservice"]) for i in range(100)]
+        replies = [future.result() for future in futures]
+        self.assertTrue(all([future.done() for future in futures]))
+        self.assertEqual([reply[-1] for reply in replies[:100]], [MDP.T_OK]*100)
+        self.assertEqual([reply[-1] for reply in replies[100:]], [MDP.T_NOTFOUND]*100)
+        client.destroy()
+
+    def test_201_async_client_worker(self):
+        request = ["set"] + ["testservice"] + ["testsection"] + ["testkey"] + ['testvalue']
+        reply = self.mdclient.send("titanic.store", request)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        client = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip,self.broker_port))
+        request = ["get"] + ["testservice"] + ["testsection"] + ["testkey"]
+        futures = [client.send_async("titanic.store", request) for i in range(20)]
+        for future in futures:
+            reply = future.result()
+            self.assertNotEqual(reply, None)
+            self.assertEqual(reply[-2], 'testvalue')
+            self.assertEqual(reply[-1], MDP.T_OK)
+        reply = client.send("titanic.store", ["delete"] + ["testservice"])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        client.destroy()
+
+    def test_202_async_client_timeout(self):
+        client = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip,self.broker_port))
+        client.timeout = 100
+        client.retries = 2
+        future = client.send_async("noworker.service", ["action"])
+        self.assertEqual(future.result(), None)
+        self.assertTrue(future.done())
+        #The socket is still usable
+        reply = client.send("mmi.service", ["titanic.request"])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        client.destroy()
+
+    def test_210_worker_without_copy(self):
+        worker = MajorDomoWorker("tcp://%s:%s"%(self.broker_ip,self.broker_port), "nocopy.service")
+        worker.copy = False
+        requests = []
+        def run():
+            reply = None
+            while True:
+                request = worker.recv(reply)
+                if request is None:
+                    break
+                requests.append(request)
+                # The frames are sent back without copy
+                reply = request
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        time.sleep(self.sleep/2.0)
+        body = "x" * 1048576
+        reply = self.mdclient.send("nocopy.service", ["echo", body])
+        self.assertEqual(reply, ["echo", body])
+        self.assertTrue(isinstance(requests[0][1], zmq.Frame))
+        self.assertEqual(requests[0][1].bytes, body)
+        worker.shutdown()
+        thread.join()
+        worker.destroy()
+
+class TestTitanicUpgrade(TestExecutive):
+    """
+    Start titanic over the data_dir of a previous version : a queue file
+    and a pickle file per request and per reply
+    """
+    pending = "%032x" % 1
+    replied = "%032x" % 2
+
+    def setUp(self):
+        try:
+            shutil.rmtree('.raspy_test')
+        except:
+            pass
+        legacy = STORAGES['file']('.raspy_test/queue')
+        legacy.put_request(self.pending, ["nowhere.service", "request1"])
+        legacy.put_request(self.replied, ["echo.service", "request2"])
+        legacy.put_reply(self.replied, ["reply2"])
+        with open('.raspy_test/queue/queue', 'w') as f:
+            f.write("-%s\n+%s\n" % (self.pending, self.replied))
+        TestExecutive.setUp(self)
+
+    def test_100_titanic_upgrade(self):
+        self.assertEqual(sorted(os.listdir('.raspy_test/queue')), ["journal", "pending"])
+        time.sleep(self.sleep)
+        reply = self.mdclient.send("titanic.reply", [self.pending])
+        self.assertEqual(reply, [MDP.T_PENDING])
+        self.assertEqual(self.titanic.queue.uuids(), [self.pending])
+        reply = self.mdclient.send("titanic.reply", [self.replied])
+        self.assertEqual(reply, [MDP.T_OK, "reply2"])
+        # The requests are in the journal
+        storage = STORAGES['journal']('.raspy_test/queue')
+        self.assertEqual(storage.get_request(self.pending), ["nowhere.service", "request1"])
+        self.assertEqual(storage.get_reply(self.replied), ["reply2"])
+        storage.close()
+
 class TestTitanic(TestExecutive):
     service="titanic"
 
@@ -161,6 +755,25 @@ class TestTitanic(TestExecutive):
         self.assertNotEqual(reply, None)
         self.assertEqual(reply[-1], MDP.T_OK)
 
+    def test_103_mmi_titanic_stats(self):
+        request = ["titanic.stats"]
+        reply = self.mdclient.send("mmi.service", request)
+        self.assertNotEqual(reply, None)
+        self.assertEqual(reply[-1], MDP.T_OK)
+
+    def test_104_titanic_stats(self):
+        reply = self.mdclient.send("titanic.request", ["nowhere.service", "action"])
+        self.assertEqual(reply[0], "200")
+        uuid = reply[1]
+        time.sleep(self.sleep*2)
+        reply = self.mdclient.send("titanic.stats", [""])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        stats = json.loads(reply[0])
+        self.assertEqual(stats["nowhere.service"]["depth"], 1)
+        self.assertEqual(stats["nowhere.service"]["available"], False)
+        reply = self.mdclient.send("titanic.close", [uuid])
+        self.assertEqual(reply[-1], MDP.T_OK)
+
     def test_110_titanic_request(self):
 
         def long_worker(stopevent):
@@ -204,13 +817,14 @@ class TestTitanic(TestExecutive):
         uuid3 = client.request(hostname="localhost", service="test.long", data=["wait"])
         self.assertNotEqual(uuid3, None)
         stopevent.wait(self.sleep/2)
-        reply = client.status(uuid)
+        # The requests are dispatched at once : the last one waits for the 2 others
+        reply = client.status(uuid3)
         try :
             self.assertEqual(reply[-1], MDP.T_PENDING)
             stopevent.wait(self.sleep*4.0)
         except :
             stopevent.wait(self.sleep*5.0)
-            reply = client.status(uuid)
+            reply = client.status(uuid3)
             self.assertEqual(reply[-1], MDP.T_PENDING)
             stopevent.wait(self.sleep*5.0)
         reply = client.status(uuid)
@@ -245,6 +859,49 @@ class TestTitanic(TestExecutive):
         self.worker_long_thread = None
         client = None
 
+    def test_111_titanic_batch_reply(self):
+        uuids = []
+        for i in range(2):
+            reply = self.mdclient.send("titanic.request", ["titanic.store", "get", "badservice", "badsection", "key%s" % i])
+            self.assertEqual(reply[0], MDP.T_OK)
+            uuids.append(reply[1])
+        time.sleep(self.sleep*2)
+        client = TitanicClient(broker_ip=self.broker_ip, broker_port=self.broker_port)
+        replies = client.replies(uuids + ["bad_uuid"])
+        self.assertEqual(replies[uuids[0]][0], MDP.T_OK)
+        self.assertEqual(replies[uuids[0]][-1], MDP.T_NOTFOUND)
+        self.assertEqual(replies[uuids[1]][-2], "key1")
+        self.assertEqual(replies["bad_uuid"], [MDP.T_UNKNOWN])
+        reply = self.mdclient.send("titanic.close", uuids)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        replies = client.replies(uuids)
+        self.assertEqual(replies[uuids[0]], [MDP.T_UNKNOWN])
+        self.assertEqual(replies[uuids[1]], [MDP.T_UNKNOWN])
+        client.destroy()
+
+    def test_112_titanic_client_notify(self):
+        results = []
+        def callback(reply, args, kwargs):
+            results.append(reply)
+        # Don't poll : only the completion events can wake up the client
+        client = TitanicClient(broker_ip=self.broker_ip, broker_port=self.broker_port, poll=100000, recheck=100000)
+        client_thread = threading.Thread(target=client.run)
+        client_thread.daemon = True
+        client_thread.start()
+        time.sleep(self.sleep)
+        uuid = client.request(hostname="titanic", service="store", data=["get", "badservice", "badsection", "badkey"], callback=callback)
+        self.assertNotEqual(uuid, None)
+        for i in range(10):
+            if results:
+                break
+            time.sleep(self.sleep)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][-1], MDP.T_NOTFOUND)
+        self.assertFalse(uuid in client.requests)
+        client.shutdown()
+        time.sleep(self.sleep/4.0)
+        client.destroy()
+
     def test_200_mmi_titanic_store(self):
         request = ["titanic.store"]
         reply = self.mdclient.send("mmi.service", request)
@@ -300,6 +957,27 @@ class TestTitanic(TestExecutive):
         self.assertNotEqual(reply, None)
         self.assertEqual(reply[-1], MDP.T_OK)
 
+    def test_203_titanic_store_mget(self):
+        sections = {"section1" : {"key1" : "value1", "key2" : "value2"}, "section2" : {"key3" : "value3"}}
+        request = ["mset"] + ["testservice"] + [json.dumps(sections)]
+        reply = self.mdclient.send("titanic.store", request)
+        self.assertNotEqual(reply, None)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        request = ["get"] + ["testservice"] + ["section2"] + ["key3"]
+        reply = self.mdclient.send("titanic.store", request)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.assertEqual(reply[-2], 'value3')
+        request = ["mget"] + ["testservice"]
+        reply = self.mdclient.send("titanic.store", request)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.assertEqual(json.loads(reply[-2]), sections)
+        request = ["delete"] + ["testservice"]
+        reply = self.mdclient.send("titanic.store", request)
+        self.assertEqual(reply[-1], MDP.T_OK)
+        request = ["mget"] + ["testservice"]
+        reply = self.mdclient.send("titanic.store", request)
+        self.assertEqual(json.loads(reply[-2]), {})
+
 class TestKV(TestExecutive):
     subtree='/test/'
 
@@ -339,6 +1017,59 @@ class TestKV(TestExecutive):
         self.assertTrue("%skey1"%self.subtree in self.subscriber.kvmap)
         self.stopClient()
 
+    def test_102_kv_delete(self):
+        self.startClient(self.subtree)
+        self.publisher.send(self.subtree, "key1", "value1")
+        self.publisher.send(self.subtree, "key2", "value2")
+        time.sleep(self.sleep)
+        self.assertTrue("%skey1"%self.subtree in self.subscriber.kvmap)
+        self.publisher.send(self.subtree, "key1", "")
+        time.sleep(self.sleep)
+        self.assertFalse("%skey1"%self.subtree in self.subscriber.kvmap)
+        self.assertFalse("%skey1"%self.subtree in self.broker.proxy_thread.kvmap)
+        self.assertEqual(self.broker.proxy_thread.index.prefix(self.subtree), ["%skey2"%self.subtree])
+        self.stopClient()
+        self.startClient(self.subtree)
+        time.sleep(self.sleep)
+        self.assertFalse("%skey1"%self.subtree in self.subscriber.kvmap)
+        self.assertTrue("%skey2"%self.subtree in self.subscriber.kvmap)
+        self.stopClient()
+
+    def test_110_kv_snapshot_large(self):
+        keys = 100000
+        publisher = KvPublisherClient(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port)
+        for i in range(keys):
+            publisher.send(self.subtree, "key%06d" % i, "value%s" % i)
+        publisher.send("/testbad/", "key1", "value1")
+        # The broker also publishes its statistics in the proxy : count our keys only
+        def published():
+            return len([key for key in list(self.broker.proxy_thread.kvmap) \
+                if key.startswith(self.subtree) or key.startswith("/testbad/")])
+        for i in range(60):
+            if published() == keys + 1:
+                break
+            time.sleep(self.sleep)
+        self.assertEqual(published(), keys + 1)
+        subscribers = []
+        def subscribe():
+            subscribers.append(KvSubscriberClient(hostname=self.hostname, subtree=self.subtree, broker_ip=self.broker_ip, broker_port=self.broker_port))
+        threads = [threading.Thread(target=subscribe) for i in range(4)]
+        for thr in threads:
+            thr.daemon = True
+            thr.start()
+        #Updates are still published while snapshots are sent
+        publisher.send(self.subtree, "key_during", "value")
+        for thr in threads:
+            thr.join(60)
+        self.assertEqual(len(subscribers), 4)
+        for subscriber in subscribers:
+            self.assertTrue(len(subscriber.kvmap) >= keys)
+            self.assertTrue("%skey%06d" % (self.subtree, keys - 1) in subscriber.kvmap)
+            self.assertFalse("/testbad/key1" in subscriber.kvmap)
+            subscriber.destroy()
+        self.assertEqual(len(self.broker.proxy_thread.routes), 0)
+        publisher.destroy()
+
 if __name__ == '__main__':
     sys.argv.append('-v')
     unittest.main()
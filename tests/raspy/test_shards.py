@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unittests for the sharded broker.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import sys
+import time
+import json
+import unittest
+import threading
+
+import raspy.common.MDP as MDP
+from raspy.servers.shards import ShardedBroker, service_shard
+from raspy.common.mdcliapi import MajorDomoClient, ShardedMajorDomoClient, shard_endpoint
+from raspy.common.mdwrkapi import MajorDomoWorker
+
+from tests.raspy.common import TestRasPyIP
+
+class TestShards(TestRasPyIP):
+    """
+    Test the sharded broker
+    """
+    shards = 2
+
+    def setUp(self):
+        self.broker = ShardedBroker(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, shards=self.shards)
+        self.broker_thread = threading.Thread(target=self.broker.run)
+        self.broker_thread.daemon = True
+        self.broker_thread.start()
+        self.workers = []
+        time.sleep(self.sleep)
+        self.mdclient = MajorDomoClient("tcp://%s:%s"%(self.broker_ip,self.broker_port))
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.shutdown()
+        self.broker.shutdown()
+        time.sleep(self.sleep/4.0)
+        self.mdclient.destroy()
+        for worker in self.workers:
+            worker.destroy()
+        self.broker.destroy()
+
+    def start_echo(self, service, broker=None):
+        """Start an echo worker for service"""
+        worker = MajorDomoWorker(broker or "tcp://%s:%s"%(self.broker_ip,self.broker_port), service)
+        self.workers.append(worker)
+        def run():
+            reply = None
+            while True:
+                request = worker.recv(reply)
+                if request is None:
+                    break
+                reply = request
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def test_100_service_shard(self):
+        names = ["%s.service%s" % (self.hostname, i) for i in range(1000)]
+        shards = [service_shard(name, 4) for name in names]
+        self.assertEqual(sorted(set(shards)), [0, 1, 2, 3])
+        self.assertTrue(min([shards.count(i) for i in range(4)]) > 150)
+        self.assertEqual(shards, [service_shard(name, 4) for name in names])
+
+    def test_110_requests(self):
+        services = ["echo.service%s" % i for i in range(4)]
+        self.assertEqual(len(set([service_shard(service, self.shards) for service in services])), self.shards)
+        for service in services:
+            self.start_echo(service)
+        time.sleep(self.sleep)
+        for service in services:
+            reply = self.mdclient.send(service, ["hello", service])
+            self.assertEqual(reply, ["hello", service])
+            reply = self.mdclient.send("mmi.service", [service])
+            self.assertEqual(reply[-1], MDP.T_OK)
+        reply = self.mdclient.send("mmi.service", ["badservice"])
+        self.assertEqual(reply[-1], MDP.T_NOTFOUND)
+
+    def test_120_mmi_across_shards(self):
+        services = ["echo.service%s" % i for i in range(4)]
+        for service in services:
+            self.start_echo(service)
+        time.sleep(self.sleep)
+        reply = self.mdclient.send("mmi.discovery", ["^echo"])
+        self.assertEqual(reply, services + [MDP.T_OK])
+        for service in services:
+            self.mdclient.send(service, ["hello"])
+        reply = self.mdclient.send("mmi.stats", [""])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        stats = json.loads(reply[0])
+        for service in services:
+            self.assertEqual(stats[service]["requests"], 1)
+        reply = self.mdclient.send("mmi.stats", [services[0]])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        self.assertEqual(json.loads(reply[0])["replies"], 1)
+        reply = self.mdclient.send("mmi.directory", [""])
+        self.assertEqual(reply[-1], MDP.T_OK)
+        for service in services:
+            self.assertTrue(service in reply[:-1])
+
+    def test_130_direct_to_shards(self):
+        front = "tcp://%s:%s"%(self.broker_ip,self.broker_port)
+        services = ["echo.service%s" % i for i in range(4)]
+        for service in services:
+            endpoint = shard_endpoint(front, service)
+            self.assertEqual(endpoint, "tcp://%s:%s"%(self.broker_ip, \
+                self.broker_port + ShardedBroker.SHARD_PORT + service_shard(service, self.shards)))
+            self.start_echo(service, endpoint)
+        client = ShardedMajorDomoClient(front)
+        try:
+            self.assertEqual(len(client.clients), self.shards)
+            time.sleep(self.sleep)
+            for service in services:
+                reply = client.send(service, ["hello", service])
+                self.assertEqual(reply, ["hello", service])
+                # The workers of the shards are known by the front and the clients of a broker
+                reply = client.send("mmi.service", [service])
+                self.assertEqual(reply[-1], MDP.T_OK)
+                reply = self.mdclient.send(service, ["hello"])
+                self.assertEqual(reply, ["hello"])
+            reply = client.send("mmi.discovery", ["^echo"])
+            self.assertEqual(reply, services + [MDP.T_OK])
+        finally:
+            client.destroy()
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
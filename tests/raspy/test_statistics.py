@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unittests for the statistics.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import sys
+import unittest
+import threading
+
+from raspy.common.statistics import SNMPCounter, SNMPGauge, SNMPHistogram, SNMPString
+
+from tests.common import TestRasPy
+
+class TestStatistics(TestRasPy):
+
+    def test_100_counter(self):
+        counter = SNMPCounter(oid="test.counter", overflow=1000)
+        counter.set()
+        counter.set(10)
+        self.assertEqual(counter.get(), 11)
+        counter.set(1000)
+        self.assertEqual(counter.get(), 11)
+
+    def test_101_counter_threads(self):
+        counter = SNMPCounter(oid="test.counter")
+        def run():
+            for i in range(10000):
+                counter.set()
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thr in threads:
+            thr.start()
+        for thr in threads:
+            thr.join()
+        self.assertEqual(counter.get(), 40000)
+
+    def test_110_gauge(self):
+        gauge = SNMPGauge(oid="test.gauge")
+        gauge.set(10)
+        gauge.set(5)
+        self.assertEqual(gauge.get(), 5)
+        string = SNMPString(oid="test.string")
+        string.set("value")
+        self.assertEqual(string.get(), "value")
+
+    def test_120_histogram(self):
+        histogram = SNMPHistogram(oid="test.latency")
+        self.assertEqual(histogram.get()['count'], 0)
+        self.assertEqual(histogram.get()['p99'], 0.0)
+        for i in range(100):
+            histogram.set(0.001*(i+1))
+        values = histogram.get()
+        self.assertEqual(values['count'], 100)
+        self.assertAlmostEqual(values['avg'], 0.0505)
+        self.assertAlmostEqual(values['max'], 0.1)
+        self.assertTrue(0.05 <= values['p50'] <= 0.1)
+        self.assertTrue(values['p50'] <= values['p90'] <= values['p99'] <= values['max'])
+        histogram.set(1000)
+        self.assertEqual(histogram.get()['max'], 1000)
+
+    def test_121_histogram_precision(self):
+        histogram = SNMPHistogram(oid="test.latency")
+        for i in range(1000):
+            histogram.set(0.001*(i+1))
+        values = histogram.get()
+        # The percentiles are within a few percents of the latencies
+        self.assertTrue(0.5 <= values['p50'] <= 0.5*1.04)
+        self.assertTrue(0.9 <= values['p90'] <= 0.9*1.04)
+        self.assertTrue(0.99 <= values['p99'] <= 0.99*1.04)
+        for value in [0.0, 1e-6, 63e-6, 64e-6, 1e-3, 0.7, 3600.0]:
+            index = histogram.bucket(value)
+            self.assertTrue(value <= histogram.upper_bound(index) <= max(value*1.04, value+1e-6))
+            self.assertTrue(index == 0 or histogram.upper_bound(index-1) <= value + 1e-12)
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
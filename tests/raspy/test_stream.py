@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unittests for the streamed replies.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import sys
+import time
+import unittest
+import threading
+
+import raspy.common.MDP as MDP
+from raspy.servers.broker import Broker
+from raspy.common.mdcliapi import MajorDomoAsyncClient
+from raspy.common.mdwrkapi import MajorDomoWorker
+
+from tests.raspy.common import TestRasPyIP
+
+class TestStream(TestRasPyIP):
+    """
+    Test the streams between a worker and a client through the broker
+    """
+
+    def setUp(self):
+        self.broker = Broker(hostname=self.hostname, broker_ip=self.broker_ip, broker_port=self.broker_port, proxy=False)
+        thread = threading.Thread(target=self.broker.run)
+        thread.daemon = True
+        thread.start()
+        self.worker = MajorDomoWorker("tcp://%s:%s"%(self.broker_ip, self.broker_port), "stream.service")
+        self.produced = []
+        self.results = []
+        def chunks(count):
+            for i in range(count):
+                self.produced.append(i)
+                yield "chunk%s" % i
+        def run():
+            reply = None
+            while True:
+                request = self.worker.recv(reply)
+                if request is None:
+                    break
+                if request[0] == "stream":
+                    self.results.append(self.worker.stream(chunks(int(request[1])), credit=int(request[2])))
+                    reply = None
+                else:
+                    reply = [MDP.T_NOTIMPLEMENTED]
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        time.sleep(self.sleep/4.0)
+        self.mdclient = MajorDomoAsyncClient("tcp://%s:%s"%(self.broker_ip, self.broker_port))
+
+    def tearDown(self):
+        self.worker.shutdown()
+        self.broker.shutdown()
+        time.sleep(self.sleep/4.0)
+        self.mdclient.destroy()
+        self.worker.destroy()
+        self.broker.destroy()
+
+    def test_100_stream(self):
+        stream = self.mdclient.stream("stream.service", ["stream", "20", "3"])
+        self.assertEqual(list(stream), ["chunk%s" % i for i in range(20)])
+        self.assertEqual(stream.final, MDP.T_OK)
+        time.sleep(self.sleep/4.0)
+        self.assertEqual(self.results, [True])
+        self.assertEqual(self.broker.streams, {})
+        # The worker is waiting again
+        reply = self.mdclient.send("stream.service", ["other"])
+        self.assertEqual(reply, [MDP.T_NOTIMPLEMENTED])
+
+    def test_110_credit(self):
+        stream = self.mdclient.stream("stream.service", ["stream", "20", "3"])
+        self.assertEqual(next(stream), "chunk0")
+        time.sleep(self.sleep/4.0)
+        # No more than credit chunks ahead of the client
+        self.assertEqual(len(self.produced), 4)
+        self.assertEqual(len(self.broker.streams), 1)
+        self.assertEqual(len(list(stream)), 19)
+
+    def test_120_empty(self):
+        stream = self.mdclient.stream("stream.service", ["stream", "0", "3"])
+        self.assertEqual(list(stream), [])
+
+    def test_130_no_stream(self):
+        stream = self.mdclient.stream("stream.service", ["other"])
+        self.assertRaises(MDP.ClientError, list, stream)
+        self.assertEqual(stream.reply, [MDP.T_NOTIMPLEMENTED])
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unittests for the timer wheel.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import sys
+import random
+import math
+import unittest
+
+from raspy.common.timers import TimerWheel
+
+from tests.common import TestRasPy
+
+class TestTimerWheel(TestRasPy):
+
+    def test_100_expire(self):
+        wheel = TimerWheel(tick=1.0, slots=4, levels=2, now=0)
+        wheel.schedule(2.5, "a")
+        wheel.schedule(1, "b")
+        wheel.schedule(10, "c")
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(wheel.expire(0.5), [])
+        self.assertEqual(wheel.expire(1), ["b"])
+        self.assertEqual(wheel.expire(2.9), [])
+        self.assertEqual(wheel.expire(3), ["a"])
+        self.assertEqual(wheel.expire(9.9), [])
+        self.assertEqual(wheel.expire(10), ["c"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_110_past_and_far(self):
+        wheel = TimerWheel(tick=1.0, slots=4, levels=2, now=100)
+        wheel.schedule(50, "past")
+        wheel.schedule(1000, "far")
+        self.assertEqual(wheel.expire(101), ["past"])
+        self.assertEqual(wheel.expire(999), [])
+        self.assertEqual(wheel.expire(1000), ["far"])
+
+    def test_120_random(self):
+        wheel = TimerWheel(tick=1.0, slots=8, levels=3, now=0)
+        pending = {}
+        now = 0.0
+        count = 0
+        for step in range(1000):
+            for i in range(random.randint(0, 3)):
+                at = now + random.uniform(-2, 1000)
+                wheel.schedule(at, count)
+                pending[count] = max(at, wheel.current + 1)
+                count += 1
+            now += random.uniform(0, 10)
+            for item in wheel.expire(now):
+                self.assertTrue(pending.pop(item) <= now)
+            self.assertTrue(min(list(pending.values()) + [now + 1]) > int(now))
+            self.assertEqual(len(wheel), len(pending))
+
+    def test_130_next_due(self):
+        wheel = TimerWheel(tick=1.0, slots=4, levels=2, now=0)
+        self.assertEqual(wheel.next_due(), None)
+        wheel.schedule(10, "c")
+        # Cascaded from level 1 at its slot
+        self.assertEqual(wheel.next_due(), 8)
+        wheel.schedule(2.5, "a")
+        self.assertEqual(wheel.next_due(), 3)
+        self.assertEqual(wheel.expire(3), ["a"])
+        self.assertEqual(wheel.next_due(), 8)
+        self.assertEqual(wheel.expire(8), [])
+        self.assertEqual(wheel.next_due(), 10)
+        self.assertEqual(wheel.expire(10), ["c"])
+        self.assertEqual(wheel.next_due(), None)
+
+    def test_140_random_next_due(self):
+        wheel = TimerWheel(tick=1.0, slots=8, levels=3, now=0)
+        pending = {}
+        now = 0.0
+        count = 0
+        for step in range(1000):
+            for i in range(random.randint(0, 3)):
+                at = now + random.uniform(-2, 1000)
+                wheel.schedule(at, count)
+                pending[count] = max(at, wheel.current + 1)
+                count += 1
+            due = wheel.next_due()
+            if not pending:
+                self.assertEqual(due, None)
+                continue
+            self.assertTrue(now < due <= math.ceil(min(pending.values())))
+            # Nothing expires before the due time
+            self.assertEqual(wheel.expire(due - 0.5), [])
+            now = due
+            for item in wheel.expire(now):
+                self.assertTrue(pending.pop(item) <= now)
+            self.assertEqual(len(wheel), len(pending))
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
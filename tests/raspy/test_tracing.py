@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unittests for the hot path tracing.
+"""
+
+__license__ = """
+    This file is part of RasPy.
+
+    RasPy is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RasPy is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RasPy. If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Sébastien GALLET aka bibi21000'
+__email__ = 'bibi21000@gmail.com'
+
+import os
+import sys
+import unittest
+import logging
+import gc
+import threading
+
+from raspy.common import tracing
+
+from tests.common import TestRasPy
+
+class TestTracing(TestRasPy):
+
+    trace_file = '.raspy_trace'
+
+    def setUp(self):
+        self.logger = logging.getLogger('raspy.test.tracing')
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        tracing.configure()
+        try:
+            os.unlink(self.trace_file)
+        except OSError:
+            pass
+
+    def test_100_guard(self):
+        tracer = tracing.Tracer("TEST", logger=self.logger)
+        self.assertFalse(tracer.enabled)
+        self.logger.setLevel(logging.DEBUG)
+        # The guard is cached until refresh
+        self.assertFalse(tracer.enabled)
+        tracing.refresh()
+        self.assertTrue(tracer.enabled)
+        self.logger.setLevel(logging.INFO)
+        tracing.refresh()
+        self.assertFalse(tracer.enabled)
+
+    def test_110_binary_output(self):
+        tracer = tracing.Tracer("TEST", logger=self.logger)
+        tracing.configure(filename=self.trace_file)
+        self.assertTrue(tracer.enabled)
+        tracer.trace("recv", ["a", "bc"])
+        tracer.trace("send", ["def"])
+        tracer.trace("recv", [])
+        tracing.configure()
+        self.assertFalse(tracer.enabled)
+        events = [(name, size) for timestamp, name, size in tracing.read_trace(self.trace_file)]
+        self.assertEqual(events, [("TEST.recv", 3), ("TEST.send", 3), ("TEST.recv", 0)])
+
+    def test_120_sample(self):
+        tracer = tracing.Tracer("TEST", logger=self.logger)
+        tracing.configure(sample=10, filename=self.trace_file)
+        for i in range(100):
+            tracer.trace("recv", ["%s" % i])
+        tracing.configure()
+        events = list(tracing.read_trace(self.trace_file))
+        self.assertEqual(len(events), 10)
+
+    def test_130_tracers_collected(self):
+        tracer = tracing.Tracer("TEST", logger=self.logger)
+        self.assertTrue(tracer in tracing._tracers)
+        count = len(tracing._tracers)
+        del tracer
+        gc.collect()
+        self.assertEqual(len(tracing._tracers), count - 1)
+        tracing.refresh()
+
+    def test_140_shared_tracer(self):
+        tracer = tracing.Tracer("TEST", logger=self.logger)
+        tracing.configure(sample=7, filename=self.trace_file)
+        def run():
+            for i in range(7000):
+                tracer.trace("recv", ["a"])
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tracing.configure()
+        self.assertEqual(tracer.count, 28000)
+        self.assertEqual(len(list(tracing.read_trace(self.trace_file))), 4000)
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()